@@ -1,7 +1,17 @@
 from django.contrib import admin
 
-from accounts.models import User
+from accounts.models import QueuedEmail, User
 
 # Register your models here.
 
-admin.site.register(User)
\ No newline at end of file
+admin.site.register(User)
+
+@admin.register(QueuedEmail)
+class QueuedEmailAdmin(admin.ModelAdmin):
+    list_display = ('subject', 'recipients', 'status', 'attempts', 'next_attempt_at', 'sent_at')
+    list_filter = ('status',)
+    search_fields = ('subject',)
+    readonly_fields = ('subject', 'body', 'html_body', 'from_email', 'recipients', 'attempts', 'last_error', 'created_at', 'sent_at')
+
+    def has_add_permission(self, request):
+        return False
@@ -0,0 +1,69 @@
+import random
+from datetime import timedelta
+from django.apps import apps
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+
+class DeliveryQueue:
+    """
+    Retry queue over a model of messages waiting to be sent (the queued
+    emails, the WhatsApp outbox), with PENDING/SENT/FAILED `status`,
+    `attempts`, `next_attempt_at`, `last_error` and `sent_at` fields.
+
+    Workers claim the due messages by leasing them: `next_attempt_at` is
+    pushed past the time the batch may take to send, so another worker only
+    retries a message once the lease of the one that died holding it runs
+    out. Failed sends are retried with exponential backoff.
+    """
+
+    def __init__(self, model, claim_lease, base_backoff, max_backoff):
+        # 'app_label.Model', resolved when first used so the models may import the queue
+        self.model_label = model
+        self.claim_lease = claim_lease
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+
+    @property
+    def model(self):
+        return apps.get_model(self.model_label)
+
+    def backoff(self, attempts):
+        """Delay before the next attempt, exponential with jitter"""
+        delay = min(self.base_backoff * 2 ** (attempts - 1), self.max_backoff)
+        return delay * random.uniform(0.8, 1.2)
+
+    def claim(self, limit, lease=None):
+        """Lease the due pending messages to this worker, skipping the ones other workers hold"""
+        model = self.model
+        now = timezone.now()
+        with transaction.atomic():
+            ids = list(
+                model.objects.select_for_update(skip_locked=True)
+                .filter(status=model.PENDING, next_attempt_at__lte=now)
+                .order_by('next_attempt_at', 'id')
+                .values_list('id', flat=True)[:limit]
+            )
+            model.objects.filter(id__in=ids).update(
+                next_attempt_at=now + timedelta(seconds=max(self.claim_lease, lease or 0))
+            )
+        return list(model.objects.filter(id__in=ids).order_by('id'))
+
+    def record_failure(self, message, error, give_up=False):
+        """Count a failed attempt and schedule the next one, or give up on the message"""
+        model = self.model
+        attempts = message.attempts + 1
+        model.objects.filter(id=message.id).update(
+            attempts=F('attempts') + 1,
+            last_error=error[:500],
+            status=model.FAILED if give_up else model.PENDING,
+            next_attempt_at=timezone.now() + timedelta(seconds=self.backoff(attempts)),
+        )
+
+    def record_sent(self, ids, sent_at=None):
+        """Mark the messages sent, counting their last attempt"""
+        model = self.model
+        model.objects.filter(id__in=ids).update(
+            status=model.SENT, sent_at=sent_at or timezone.now(), attempts=F('attempts') + 1, last_error=''
+        )
@@ -0,0 +1,105 @@
+import smtplib
+import socket
+from datetime import timedelta
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.utils import timezone
+from .delivery import DeliveryQueue
+from .models import QueuedEmail
+
+# How long (seconds) a worker owns the emails it claimed before another may retry them
+CLAIM_LEASE = 120
+# Backoff (seconds) of the first retry, doubled on each further attempt up to MAX_BACKOFF
+BASE_BACKOFF = 60
+MAX_BACKOFF = 60 * 60
+# Errors of the mail server or the network, worth retrying later
+SEND_ERRORS = (smtplib.SMTPException, socket.error)
+
+email_queue = DeliveryQueue('accounts.QueuedEmail', CLAIM_LEASE, BASE_BACKOFF, MAX_BACKOFF)
+
+
+def queue_email(subject, body, recipients, from_email=None, html_body=''):
+    """Queue one email, sent later by the worker. Returns the QueuedEmail."""
+    return QueuedEmail.objects.create(
+        subject=subject,
+        body=body,
+        html_body=html_body,
+        from_email=from_email or '',
+        recipients=list(recipients),
+    )
+
+
+def queue_emails(messages):
+    """Queue many emails with one insert. `messages` are dicts of queue_email arguments."""
+    return QueuedEmail.objects.bulk_create([
+        QueuedEmail(
+            subject=message['subject'],
+            body=message['body'],
+            html_body=message.get('html_body', ''),
+            from_email=message.get('from_email') or '',
+            recipients=list(message['recipients']),
+        )
+        for message in messages
+    ])
+
+
+def send_budget():
+    """How many emails may still be sent this minute under EMAIL_SENDS_PER_MINUTE"""
+    if not settings.EMAIL_SENDS_PER_MINUTE:
+        return None
+    recent = QueuedEmail.objects.filter(sent_at__gte=timezone.now() - timedelta(minutes=1)).count()
+    return max(settings.EMAIL_SENDS_PER_MINUTE - recent, 0)
+
+
+def record_failure(email, error):
+    give_up = email.attempts + 1 >= settings.EMAIL_MAX_ATTEMPTS
+    email_queue.record_failure(email, f"{type(error).__name__}: {error}", give_up)
+
+
+def send_queued_emails(batch_size=100, connection=None):
+    """
+    Send the due queued emails over a single connection of EMAIL_BACKEND,
+    opened once for the whole batch instead of once per email, and no more
+    than EMAIL_SENDS_PER_MINUTE a minute. Failed emails are retried with
+    exponential backoff, up to EMAIL_MAX_ATTEMPTS. Returns the number sent.
+    """
+    budget = send_budget()
+    limit = batch_size if budget is None else min(batch_size, budget)
+    if not limit:
+        return 0
+    emails = email_queue.claim(limit)
+    if not emails:
+        return 0
+
+    connection = connection or get_connection(fail_silently=False)
+    try:
+        connection.open()
+    except SEND_ERRORS as error:
+        # The server is unreachable, every claimed email waits for the next try
+        for email in emails:
+            record_failure(email, error)
+        return 0
+
+    sent = []
+    try:
+        for email in emails:
+            message = EmailMultiAlternatives(
+                email.subject,
+                email.body,
+                email.from_email or settings.DEFAULT_FROM_EMAIL,
+                email.recipients,
+                connection=connection,
+            )
+            if email.html_body:
+                message.attach_alternative(email.html_body, 'text/html')
+            try:
+                message.send()
+            except SEND_ERRORS as error:
+                record_failure(email, error)
+                continue
+            sent.append(email.id)
+    finally:
+        connection.close()
+
+    email_queue.record_sent(sent)
+    return len(sent)
@@ -0,0 +1,19 @@
+import time
+from django.core.management.base import BaseCommand
+from accounts.mailer import send_queued_emails
+
+
+class Command(BaseCommand):
+    help = "Send the queued emails over one reused connection. Run it periodically, or keep it running with --interval."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--interval', type=int, default=0, help="Seconds between sends, send once when 0")
+
+    def handle(self, *args, **options):
+        while True:
+            sent = send_queued_emails(batch_size=options['batch_size'])
+            self.stdout.write(self.style.SUCCESS(f"Sent {sent} queued emails"))
+            if not options['interval']:
+                return
+            time.sleep(options['interval'])
@@ -1,6 +1,127 @@
-from rest_framework.pagination import PageNumberPagination
+from rest_framework.exceptions import ValidationError
+from rest_framework.pagination import BasePagination, CursorPagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+MAX_PAGE_SIZE = 1000  # Hard cap on the page size a client can ask for
+
+
+def wants_cursor(request):
+    """Whether the request asks for keyset (cursor) pagination"""
+    return 'cursor' in request.query_params or request.query_params.get('pagination') == 'cursor'
+
+
+def wants_count(request):
+    """`?count=false` skips the COUNT(*) of page number pagination"""
+    return request.query_params.get('count', 'true').lower() not in ('0', 'false', 'no')
+
 
 class CustomPageNumberPagination(PageNumberPagination):
     page_size = 100 # Default page size
     page_size_query_param = 'per_page'  # Query parameter for custom page size
-    max_page_size = 100000  # Maximum allowed page size
\ No newline at end of file
+    max_page_size = MAX_PAGE_SIZE  # Maximum allowed page size
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.counted = wants_count(request)
+        if self.counted:
+            return super().paginate_queryset(queryset, request, view)
+
+        # Without a count, fetch one extra row to know if there is a next page
+        self.request = request
+        page_size = self.get_page_size(request)
+        try:
+            self.page_number = max(int(request.query_params.get(self.page_query_param, 1)), 1)
+        except ValueError:
+            self.page_number = 1
+        offset = (self.page_number - 1) * page_size
+        rows = list(queryset[offset:offset + page_size + 1])
+        self.has_next = len(rows) > page_size
+        return rows[:page_size]
+
+    def get_paginated_response(self, data):
+        if self.counted:
+            return super().get_paginated_response(data)
+        return Response({
+            'next': self.get_uncounted_link(self.page_number + 1) if self.has_next else None,
+            'previous': self.get_uncounted_link(self.page_number - 1) if self.page_number > 1 else None,
+            'results': data,
+        })
+
+    def get_uncounted_link(self, page_number):
+        url = self.request.build_absolute_uri()
+        if page_number == 1:
+            return remove_query_param(url, self.page_query_param)
+        return replace_query_param(url, self.page_query_param, page_number)
+
+
+class KeysetPagination(CursorPagination):
+    """
+    Cursor pagination on (date_added, id): deep pages cost the same as the
+    first one and no COUNT(*) is run. Views may set `cursor_ordering`.
+    """
+    page_size = 100
+    page_size_query_param = 'per_page'
+    max_page_size = MAX_PAGE_SIZE
+    ordering = ('-date_added', '-id')
+
+    def get_ordering(self, request, queryset, view):
+        return getattr(view, 'cursor_ordering', self.ordering)
+
+
+class KeysetOrPageNumberPagination(BasePagination):
+    """
+    Page number pagination by default, keyset pagination when the request
+    passes `cursor` or `pagination=cursor`. Keyset pages follow the cursor
+    ordering only, so asking for another order (`ordering`, or `search`
+    relevance) along with a cursor is rejected rather than ignored.
+    """
+    default_mode = 'page'
+
+    def __init__(self):
+        self.page_pagination = CustomPageNumberPagination()
+        self.cursor_pagination = KeysetPagination()
+        self.active = None
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if wants_cursor(request):
+            reordered = [
+                param for param in (api_settings.ORDERING_PARAM, api_settings.SEARCH_PARAM)
+                if request.query_params.get(param)
+            ]
+            if reordered:
+                raise ValidationError({
+                    param: "Cannot be combined with cursor pagination, use page numbers instead." for param in reordered
+                })
+            self.active = self.cursor_pagination
+        elif self.default_mode == 'page' or self.page_pagination.page_query_param in request.query_params:
+            self.active = self.page_pagination
+        else:
+            return None
+        return self.active.paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        return self.active.get_paginated_response(data)
+
+    def get_paginated_response_schema(self, schema):
+        return self.page_pagination.get_paginated_response_schema(schema)
+
+    def get_schema_operation_parameters(self, view):
+        parameters = self.page_pagination.get_schema_operation_parameters(view)
+        names = {parameter['name'] for parameter in parameters}
+        return parameters + [
+            parameter for parameter in self.cursor_pagination.get_schema_operation_parameters(view)
+            if parameter['name'] not in names
+        ]
+
+    @property
+    def display_page_controls(self):
+        return self.active is not None and self.active.display_page_controls
+
+    def to_html(self):
+        return self.active.to_html() if self.active else ''
+
+
+class OptionalKeysetPagination(KeysetOrPageNumberPagination):
+    """Like KeysetOrPageNumberPagination, but unpaginated unless a page or cursor is asked for"""
+    default_mode = None
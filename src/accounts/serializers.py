@@ -1,4 +1,4 @@
-from django.db.models import Count, Sum, F
+from django.db.models import Count, Sum
 from rest_framework import serializers
 
 from products.models import LovedProduct, Pill, Product
@@ -97,12 +97,12 @@ class UserProfileSerializer(serializers.ModelSerializer):
         return LovedProductSerializer(loved_products, many=True).data
 
     def get_total_spent(self, obj):
+        # Price of the items bought, without shipping or coupons: the frozen subtotal of
+        # the delivered pills (backfilled after migrate for the older ones)
         return Pill.objects.filter(
             user=obj,
             status='d'
-        ).annotate(
-            total_price=Sum(F('items__quantity') * F('items__product__price'))
-        ).aggregate(total_spent=Sum('total_price'))['total_spent'] or 0
+        ).aggregate(total_spent=Sum('subtotal'))['total_spent'] or 0
 
     def get_favorite_category(self, obj):
         favorite = Product.objects.filter(
@@ -1,3 +1,73 @@
-from django.test import TestCase
+import smtplib
+from django.core import mail
+from django.core.mail.backends.locmem import EmailBackend
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APIClient
+from .mailer import queue_email, queue_emails, send_queued_emails
+from .models import QueuedEmail, User
 
-# Create your tests here.
+
+class CountingBackend(EmailBackend):
+    opened = 0
+
+    def open(self):
+        CountingBackend.opened += 1
+        return super().open()
+
+
+class FailingBackend(EmailBackend):
+    def send_messages(self, messages):
+        raise smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+
+
+class EmailQueueTests(TestCase):
+    def test_password_reset_queues_the_otp(self):
+        User.objects.create_user(username='buyer', password='password', email='buyer@example.com')
+
+        response = APIClient(HTTP_HOST='localhost').post(
+            reverse('accounts:password_reset'), {'email': 'buyer@example.com'}, format='json'
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(mail.outbox), 0)
+        email = QueuedEmail.objects.get()
+        self.assertEqual(email.recipients, ['buyer@example.com'])
+        self.assertIn(User.objects.get().otp, email.body)
+
+    def test_batch_is_sent_over_one_connection(self):
+        queue_emails([
+            {'subject': f'Alert {number}', 'body': 'Back in stock', 'recipients': [f'user{number}@example.com']}
+            for number in range(5)
+        ])
+        CountingBackend.opened = 0
+
+        self.assertEqual(send_queued_emails(connection=CountingBackend()), 5)
+        self.assertEqual(CountingBackend.opened, 1)
+        self.assertEqual(len(mail.outbox), 5)
+        self.assertEqual(QueuedEmail.objects.filter(status=QueuedEmail.SENT).count(), 5)
+        self.assertEqual(send_queued_emails(), 0)
+
+    @override_settings(EMAIL_SENDS_PER_MINUTE=2)
+    def test_sends_per_minute_are_capped(self):
+        queue_emails([{'subject': 'Alert', 'body': 'Body', 'recipients': ['user@example.com']}] * 3)
+
+        self.assertEqual(send_queued_emails(), 2)
+        self.assertEqual(send_queued_emails(), 0)
+        self.assertEqual(QueuedEmail.objects.filter(status=QueuedEmail.PENDING).count(), 1)
+
+    @override_settings(EMAIL_MAX_ATTEMPTS=2)
+    def test_failures_back_off_then_give_up(self):
+        queue_email('Alert', 'Body', ['user@example.com'])
+
+        self.assertEqual(send_queued_emails(connection=FailingBackend()), 0)
+        email = QueuedEmail.objects.get()
+        self.assertEqual((email.status, email.attempts), (QueuedEmail.PENDING, 1))
+        self.assertGreater(email.next_attempt_at, timezone.now())
+        self.assertIn('SMTPServerDisconnected', email.last_error)
+
+        QueuedEmail.objects.update(next_attempt_at=timezone.now())
+        send_queued_emails(connection=FailingBackend())
+        email.refresh_from_db()
+        self.assertEqual((email.status, email.attempts), (QueuedEmail.FAILED, 2))
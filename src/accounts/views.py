@@ -3,12 +3,12 @@ from rest_framework.decorators import api_view, permission_classes
 from rest_framework.response import Response
 from rest_framework.permissions import AllowAny,IsAuthenticated,IsAdminUser
 from rest_framework_simplejwt.tokens import RefreshToken
-from django.core.mail import send_mail
 from django.utils import timezone
 from datetime import timedelta
 import random
 from .serializers import UserAddressSerializer, UserProfileSerializer, UserSerializer, PasswordResetRequestSerializer, PasswordResetConfirmSerializer
 from .models import User, UserAddress
+from .mailer import queue_email
 
 from rest_framework import generics
 
@@ -67,12 +67,12 @@ def request_password_reset(request):
             user.otp_created_at = timezone.now()
             user.save()
             
-            send_mail(
+            # Sent by the send_queued_emails worker, the request does not wait for SMTP
+            queue_email(
                 'Password Reset OTP',
                 f'Your OTP for password reset is: {otp}',
-                'from@example.com',
                 [email],
-                fail_silently=False,
+                from_email='from@example.com',
             )
             return Response({'message': 'OTP sent to your email'})
         except User.DoesNotExist:
@@ -0,0 +1,166 @@
+from collections import defaultdict
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, FloatField, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from products.bestsellers import per_row, record_daily_costs
+from products.models import ProductSales, ProductSalesDaily, StockMovement
+from .models import FactWatermark, SkuCost
+
+WATERMARK = 'cost_of_goods'
+# Movements younger than this (seconds) wait for the next periodic run, so a
+# transaction still open when the watermark moves is not skipped
+SAFETY_LAG = 60
+FIFO = 'fifo'
+AVERAGE = 'average'
+# Ledger kinds that move stock in or out for good, reservations and their
+# releases cancel out once a pill is sold or expires
+COSTED_KINDS = [StockMovement.RECEIPT, StockMovement.ADJUSTMENT, StockMovement.SALE, StockMovement.RETURN]
+
+
+def add_units(layers, quantity, unit_cost, method, oldest=False):
+    """Put units into the stock layers, first in line when oldest=True (returned stock)"""
+    if method == AVERAGE:
+        on_hand = sum(units for units, cost in layers)
+        total = sum(units * cost for units, cost in layers) + quantity * unit_cost
+        return [[on_hand + quantity, total / (on_hand + quantity)]]
+    if oldest:
+        return [[quantity, unit_cost]] + layers
+    return layers + [[quantity, unit_cost]]
+
+
+def take_units(layers, quantity, fallback_cost):
+    """
+    Take units from the stock layers, oldest first. Returns the layers left
+    and the cost of the units taken, units missing from the layers (stock
+    older than the ledger) being valued at `fallback_cost`.
+    """
+    cost = 0.0
+    layers = [list(layer) for layer in layers]
+    while quantity and layers:
+        take = min(quantity, layers[0][0])
+        cost += take * layers[0][1]
+        quantity -= take
+        layers[0][0] -= take
+        if not layers[0][0]:
+            layers.pop(0)
+    return layers, cost + quantity * fallback_cost
+
+
+def cost_movements(movements, layers, method):
+    """
+    Run ledger movements (id, kind, pill, sku, quantity, batch price) in
+    order over the layers of their SKUs, updating `layers` in place.
+    Returns the cost of goods taken per (pill, sku) by the sales.
+    """
+    sale_costs = defaultdict(float)
+    for movement_id, kind, pill_id, sku, quantity, batch_price in movements:
+        batch_price = batch_price or 0.0
+        if quantity > 0:
+            layers[sku] = add_units(layers[sku], quantity, batch_price, method, oldest=kind == StockMovement.RETURN)
+        elif quantity < 0:
+            layers[sku], cost = take_units(layers[sku], -quantity, batch_price)
+            if kind == StockMovement.SALE and pill_id is not None:
+                sale_costs[(pill_id, sku)] += cost
+    return sale_costs
+
+
+def save_layers(layers, states, batch_size):
+    """Write the layers of the SKUs back, creating the states met for the first time"""
+    changed, created = [], []
+    for sku, sku_layers in layers.items():
+        if sku in states:
+            states[sku].layers = sku_layers
+            changed.append(states[sku])
+        else:
+            created.append(SkuCost(product_id=sku[0], size=sku[1], color_id=sku[2], layers=sku_layers))
+    SkuCost.objects.bulk_update(changed, ['layers'], batch_size=batch_size)
+    SkuCost.objects.bulk_create(created, batch_size=batch_size)
+
+
+def charge_sales(sale_costs, batch_size):
+    """
+    Spread the cost of the units taken by each pill over its sales of the
+    SKU, and add it to the daily rollups of those sales. Adds to the unit
+    cost already there, so a pill whose movements span two runs is charged
+    in two parts.
+    """
+    if not sale_costs:
+        return
+    sales = defaultdict(list)
+    rows = ProductSales.objects.filter(pill_id__in={pill_id for pill_id, sku in sale_costs}).values_list(
+        'id', 'pill_id', 'product_id', 'size', 'color_id', 'quantity', 'date_sold'
+    )
+    for sale_id, pill_id, product_id, size, color_id, quantity, date_sold in rows:
+        sales[(pill_id, (product_id, size, color_id))].append((sale_id, quantity, timezone.localdate(date_sold)))
+
+    increments = {}
+    daily_costs = defaultdict(float)
+    for (pill_id, sku), cost in sale_costs.items():
+        sold = sum(quantity for sale_id, quantity, day in sales.get((pill_id, sku), ()))
+        for sale_id, quantity, day in sales.get((pill_id, sku), ()):
+            increments[sale_id] = cost / sold
+            daily_costs[(sku[0], day)] += cost * quantity / sold
+    ids = list(increments)
+    for start in range(0, len(ids), batch_size):
+        chunk = {sale_id: increments[sale_id] for sale_id in ids[start:start + batch_size]}
+        ProductSales.objects.filter(id__in=chunk).update(
+            unit_cost=Coalesce(F('unit_cost'), Value(0.0)) + per_row(chunk, FloatField())
+        )
+    record_daily_costs(daily_costs, batch_size)
+
+
+def assign_sale_costs(until=None, method=None, batch_size=1000, rebuild=False):
+    """
+    Assign a cost of goods to the sales and their daily rollups in one pass
+    over the stock ledger: receipts and adjustments add units at the price
+    paid for their batch, sales take them FIFO or at the moving average
+    (settings.COGS_METHOD), returns put them back. Resumes from the last movement costed and the
+    layers left per SKU, so a run only reads the movements recorded since;
+    rebuild=True starts over, needed after changing the method. Only
+    movements created up to `until` are read. Returns the number of
+    movements read.
+    """
+    method = method or getattr(settings, 'COGS_METHOD', FIFO)
+    if rebuild:
+        with transaction.atomic():
+            SkuCost.objects.all().delete()
+            FactWatermark.objects.filter(name=WATERMARK).delete()
+            ProductSales.objects.exclude(unit_cost=None).update(unit_cost=None)
+            ProductSalesDaily.objects.exclude(cost=0).update(cost=0.0)
+
+    read = 0
+    while True:
+        with transaction.atomic():
+            watermark, _ = FactWatermark.objects.select_for_update().get_or_create(name=WATERMARK)
+            movements = StockMovement.objects.filter(id__gt=watermark.last_movement_id)
+            if until is not None:
+                movements = movements.filter(created_at__lte=until)
+            batch = movements.order_by('id').values_list(
+                'id', 'kind', 'pill_id', 'product_id', 'size', 'color_id', 'quantity', 'availability__native_price'
+            )[:batch_size]
+            rows = [
+                (movement_id, kind, pill_id, (product_id, size, color_id), quantity, batch_price)
+                for movement_id, kind, pill_id, product_id, size, color_id, quantity, batch_price in batch
+            ]
+            if not rows:
+                return read
+
+            costed_rows = [row for row in rows if row[1] in COSTED_KINDS]
+            skus = {row[3] for row in costed_rows}
+            states = {
+                (state.product_id, state.size, state.color_id): state
+                for state in SkuCost.objects.filter(product_id__in={sku[0] for sku in skus})
+                if (state.product_id, state.size, state.color_id) in skus
+            }
+            layers = {sku: states[sku].layers if sku in states else [] for sku in skus}
+            sale_costs = cost_movements(costed_rows, layers, method)
+            save_layers(layers, states, batch_size)
+            charge_sales(sale_costs, batch_size)
+
+            watermark.last_movement_id = rows[-1][0]
+            watermark.save()
+        read += len(rows)
+        if len(rows) < batch_size:
+            return read
@@ -0,0 +1,25 @@
+import time
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from analysis.cogs import SAFETY_LAG, assign_sale_costs
+
+
+class Command(BaseCommand):
+    help = "Assign a cost of goods to the new sales and their daily rollups. Run it periodically, or keep it running with --interval."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--interval', type=int, default=0, help="Seconds between runs, run once when 0")
+        parser.add_argument('--rebuild', action='store_true', help="Recompute every sale cost first, needed after changing COGS_METHOD")
+
+    def handle(self, *args, **options):
+        rebuild = options['rebuild']
+        while True:
+            until = timezone.now() - timedelta(seconds=SAFETY_LAG)
+            read = assign_sale_costs(until=until, batch_size=options['batch_size'], rebuild=rebuild)
+            self.stdout.write(self.style.SUCCESS(f"Costed {read} stock movements"))
+            rebuild = False
+            if not options['interval']:
+                return
+            time.sleep(options['interval'])
@@ -1,3 +1,30 @@
 from django.db import models
+from products.models import Color, Product
 
-# Create your models here.
+
+class FactWatermark(models.Model):
+    """Last stock movement read by a ledger consumer (analysis.cogs), so its runs only read newer ones"""
+    name = models.CharField(max_length=50, unique=True)
+    last_movement_id = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.name} at movement {self.last_movement_id}"
+
+
+class SkuCost(models.Model):
+    """
+    Stock of a SKU still on hand as cost layers ([quantity, unit cost],
+    oldest first), where analysis.cogs resumes from on its next run. A
+    single layer with the moving average method.
+    """
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='cost_layers')
+    size = models.CharField(max_length=50, null=True, blank=True)
+    color = models.ForeignKey(Color, on_delete=models.CASCADE, null=True, blank=True)
+    layers = models.JSONField(default=list)
+
+    class Meta:
+        unique_together = [['product', 'size', 'color']]
+
+    def __str__(self):
+        return f"{self.product_id} - {self.size} - {self.color_id}: {sum(quantity for quantity, cost in self.layers)} on hand"
@@ -1,3 +1,108 @@
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APIClient
+from accounts.models import User
+from products.bestsellers import rebuild_daily_sales
+from products.models import Category, Pill, PillItem, Product, ProductAvailability, ProductSales, ProductSalesDaily, StockMovement
+from .cogs import assign_sale_costs
+from .models import SkuCost
 
-# Create your tests here.
+
+class SalesTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='buyer', password='password')
+        self.category = Category.objects.create(name='Category')
+        self.product = Product.objects.create(name='Product', category=self.category, price=100)
+        # Taken oldest batch first: 2 units at 10, then at 20
+        ProductAvailability.objects.create(product=self.product, size='m', quantity=2, native_price=10)
+        ProductAvailability.objects.create(product=self.product, size='m', quantity=10, native_price=20)
+
+    def deliver(self, quantity):
+        pill = Pill.objects.create(user=self.user)
+        pill.items.set([PillItem.objects.create(product=self.product, quantity=quantity, size='m')])
+        pill.status = 'd'
+        pill.save()
+        return pill
+
+
+class SalesRollupTests(SalesTestCase):
+    def rollup(self):
+        daily = ProductSalesDaily.objects.get()
+        return daily.quantity, daily.revenue, daily.cost
+
+    def test_rollups_follow_sales_costs_and_returns(self):
+        first = self.deliver(3)
+        self.deliver(1)
+        self.assertEqual(self.rollup(), (4, 400, 0))
+        self.assertEqual(ProductSalesDaily.objects.get().category, self.category)
+
+        assign_sale_costs()
+        self.assertEqual(self.rollup(), (4, 400, 2 * 10 + 2 * 20))
+
+        first.status = 'r'
+        first.save()
+        self.assertEqual(self.rollup(), (1, 100, 20))
+
+        rebuild_daily_sales()
+        self.assertEqual(self.rollup(), (1, 100, 20))
+        self.assertEqual(ProductSalesDaily.objects.get().category, self.category)
+
+    def test_analysis_endpoints_read_the_rollups(self):
+        self.deliver(3)
+        assign_sale_costs()
+        client = APIClient(HTTP_HOST='localhost')
+
+        response = client.get(reverse('sales-trends'))
+        self.assertEqual(response.data['daily_sales'][0]['total_cost'], 40)
+        self.assertEqual(response.data['product_sales'][0]['total_revenue'], 300)
+
+        today = timezone.localdate().isoformat()
+        response = client.get(reverse('cost-revenue-analysis'), {'start_date': today, 'end_date': today})
+        self.assertEqual((response.data['sales_revenue'], response.data['gross_profit']), (300, 260))
+
+        response = client.get(reverse('category-analytics'))
+        self.assertEqual((response.data['results'][0]['total_sales'], response.data['results'][0]['revenue']), (3, 300))
+
+    def test_product_performance_export(self):
+        self.deliver(3)
+        client = APIClient(HTTP_HOST='localhost')
+        client.force_authenticate(User.objects.create_superuser(username='admin', password='password'))
+
+        response = client.get(reverse('product-analytics-export'), {'category': self.category.id})
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertTrue(lines[0].startswith('ID,Product,Category'))
+        self.assertIn('Product,Category,,100.0,100.0,9,9,3,300.0', lines[1])
+
+
+class CostOfGoodsTests(SalesTestCase):
+    def test_fifo_costs_are_assigned_incrementally(self):
+        first = self.deliver(3)
+        assign_sale_costs()
+        self.assertEqual(ProductSales.objects.get(pill=first).unit_cost, (2 * 10 + 20) / 3)
+        self.assertEqual(SkuCost.objects.get().layers, [[9, 20]])
+        costed = StockMovement.objects.count()
+
+        # A new batch and a return, then the next run only reads them
+        ProductAvailability.objects.create(product=self.product, size='m', quantity=5, native_price=30)
+        first.status = 'r'
+        first.save()
+        second = self.deliver(12)
+        self.assertEqual(assign_sale_costs(), StockMovement.objects.count() - costed)
+        # The returned stock goes first, then the 9 left at 20
+        self.assertEqual(ProductSales.objects.get(pill=second).unit_cost, (2 * 10 + 10 * 20) / 12)
+        self.assertEqual(SkuCost.objects.get().layers, [[5, 30]])
+
+    @override_settings(COGS_METHOD='average')
+    def test_moving_average_costs(self):
+        pill = self.deliver(3)
+        ProductAvailability.objects.create(product=self.product, size='m', quantity=9, native_price=40)
+        second = self.deliver(1)
+        assign_sale_costs()
+
+        average = (2 * 10 + 10 * 20) / 12
+        self.assertAlmostEqual(ProductSales.objects.get(pill=pill).unit_cost, average)
+        self.assertAlmostEqual(ProductSales.objects.get(pill=second).unit_cost, (9 * average + 9 * 40) / 18)
+
+        assign_sale_costs(method='fifo', rebuild=True)
+        self.assertEqual(ProductSales.objects.get(pill=second).unit_cost, 20)
@@ -1,9 +1,10 @@
 from django.urls import path
-from .views import ProductCostRevenueAnalysisView, ProductPerformanceView, CategoryPerformanceView, SalesTrendsView
+from .views import ProductCostRevenueAnalysisView, ProductPerformanceExportView, ProductPerformanceView, CategoryPerformanceView, SalesTrendsView
 
 
 urlpatterns = [
     path('products/', ProductPerformanceView.as_view(), name='product-analytics'),
+    path('products/export/', ProductPerformanceExportView.as_view(), name='product-analytics-export'),
     path('categories/', CategoryPerformanceView.as_view(), name='category-analytics'),
     path('sales/', SalesTrendsView.as_view(), name='sales-trends'),
     path('cost-revenue-analysis/', ProductCostRevenueAnalysisView.as_view(), name='cost-revenue-analysis'),
@@ -10,12 +10,23 @@ from datetime import datetime
 from django.db.models.functions import Coalesce
 from django.db.models.functions import TruncDay, TruncWeek, TruncMonth, TruncYear,TruncDate
 from analysis.serializers import CategoryAnalyticsSerializer, InventoryAlertSerializer, ProductAnalyticsSerializer, SalesTrendSerializer
-from products.models import Category, Discount, Pill, Product, ProductAvailability, ProductSales
+from products.exports import ExportMixin
+from products.models import Category, Discount, Pill, Product, ProductAvailability, ProductSales, ProductSalesDaily
 from rest_framework import generics, filters
 from rest_framework.response import Response
 from django_filters import rest_framework as django_filters
 from datetime import datetime
 
+def facts_between(start_date=None, end_date=None):
+    """Daily sales rollups of the days between two dates (inclusive), of all time without them"""
+    facts = ProductSalesDaily.objects.all()
+    if start_date:
+        facts = facts.filter(day__gte=start_date)
+    if end_date:
+        facts = facts.filter(day__lte=end_date)
+    return facts
+
+
 class ProductAnalyticsFilter(django_filters.FilterSet):
     start_date = django_filters.DateFilter(field_name='date_added', lookup_expr='gte')
     end_date = django_filters.DateFilter(field_name='date_added', lookup_expr='lte')
@@ -52,6 +63,9 @@ class ProductPerformanceView(generics.ListAPIView):
         start_date = self.request.query_params.get('start_date')
         end_date = self.request.query_params.get('end_date')
         low_stock_threshold = self.request.query_params.get('low_stock_threshold')
+        product_facts = facts_between(start_date, end_date).filter(
+            product=OuterRef('pk')
+        ).order_by().values('product')
 
         queryset = queryset.annotate(
             total_available=Coalesce(Sum('availabilities__quantity'), 0),
@@ -60,25 +74,14 @@ class ProductPerformanceView(generics.ListAPIView):
                     filter=Q(availabilities__date_added__range=(start_date, end_date))
                     if start_date and end_date else Q()
                 ), 0),
-            total_sold=Coalesce(
-                Sum('sales__quantity',
-                    filter=Q(sales__date_sold__range=(start_date, end_date))
-                    if start_date and end_date else Q()
-                ), 0),
-            revenue=Coalesce(
-                Sum(
-                    ExpressionWrapper(
-                        F('sales__quantity') * F('sales__price_at_sale'),
-                        output_field=FloatField()
-                    ),
-                    filter=Q(sales__date_sold__range=(start_date, end_date))
-                    if start_date and end_date else Q()
-                ), 
-                0.0,
-                output_field=FloatField()
-            ),
-            average_rating=Coalesce(Avg('ratings__star_number'), 0.0),
-            total_ratings=Count('ratings'),
+            total_sold=Coalesce(Subquery(
+                product_facts.annotate(total=Sum('quantity')).values('total'), output_field=IntegerField()
+            ), 0),
+            revenue=Coalesce(Subquery(
+                product_facts.annotate(total=Sum('revenue')).values('total'), output_field=FloatField()
+            ), 0.0),
+            average_rating=F('rating_average'),
+            total_ratings=F('rating_count'),
             has_discount=Case(
                 When(discounts__discount_end__gte=timezone.now(), then=True),
                 default=False,
@@ -110,20 +113,34 @@ class ProductPerformanceView(generics.ListAPIView):
 
 
 
+class ProductPerformanceExportView(ExportMixin, ProductPerformanceView):
+    """The product performance rows, with the same filters and ordering, as CSV or XLSX"""
+    permission_classes = [IsAdminUser]
+    export_filename = 'product-performance'
+    export_fields = (
+        ('ID', 'id'), ('Product', 'name'), ('Category', 'category__name'), ('Brand', 'brand__name'),
+        ('Price', 'price'), ('Price After Discount', 'price_after_discount'), ('Available', 'total_available'),
+        ('Added', 'total_added'), ('Sold', 'total_sold'), ('Revenue', 'revenue'),
+        ('Average Rating', 'average_rating'), ('Ratings', 'total_ratings'),
+    )
+
+
+
 
 class CategoryPerformanceView(generics.ListAPIView):
     serializer_class = CategoryAnalyticsSerializer
     
     def get_queryset(self):
+        category_facts = ProductSalesDaily.objects.filter(category=OuterRef('pk')).order_by().values('category')
         return Category.objects.annotate(
             total_products=Count('products'),
             total_sales=Coalesce(
-                Sum('products__sales__quantity'),
+                Subquery(category_facts.annotate(total=Sum('quantity')).values('total')),
                 0,
                 output_field=IntegerField()
             ),
             revenue=Coalesce(
-                Sum(F('products__sales__quantity') * F('products__sales__price_at_sale')),
+                Subquery(category_facts.annotate(total=Sum('revenue')).values('total')),
                 0,
                 output_field=FloatField()
             )
@@ -194,27 +211,22 @@ class SalesTrendsView(APIView):
     def get(self, request):
         start_date = request.query_params.get('start_date')
         end_date = request.query_params.get('end_date')
-        
+        facts = facts_between(start_date, end_date)
+
         # Get daily sales trends
-        daily_sales = ProductSales.objects.filter(
-            date_sold__range=[start_date, end_date]
-        ).annotate(
-            day=TruncDay('date_sold')
-        ).values('day').annotate(
+        daily_sales = facts.values('day').annotate(
             total_sales=Sum('quantity'),
-            total_revenue=Sum(F('quantity') * F('price_at_sale')),
-            total_cost=Sum(F('quantity') * F('product__availabilities__native_price'))
+            total_revenue=Sum('revenue'),
+            total_cost=Sum('cost')
         ).order_by('day')
         
         # Get product-wise sales
-        product_sales = ProductSales.objects.filter(
-            date_sold__range=[start_date, end_date]
-        ).values(
+        product_sales = facts.values(
             'product__name', 'product__id'
         ).annotate(
             total_sales=Sum('quantity'),
-            total_revenue=Sum(F('quantity') * F('price_at_sale')),
-            total_cost=Sum(F('quantity') * F('product__availabilities__native_price'))
+            total_revenue=Sum('revenue'),
+            total_cost=Sum('cost')
         ).order_by('-total_revenue')
         
         return Response({
@@ -236,18 +248,20 @@ class ProductCostRevenueAnalysisView(APIView):
         end_date = request.query_params.get('end_date')
         
         # Calculate total cost of purchased inventory
-        inventory_cost = ProductAvailability.objects.filter(
-            date_added__range=[start_date, end_date]
-        ).aggregate(
+        inventory = ProductAvailability.objects.all()
+        if start_date and end_date:
+            inventory = inventory.filter(date_added__range=[start_date, end_date])
+        inventory_cost = inventory.aggregate(
             total_cost=Sum(F('quantity') * F('native_price'))
         )['total_cost'] or 0
         
-        # Calculate total revenue from sales
-        sales_revenue = ProductSales.objects.filter(
-            date_sold__range=[start_date, end_date]
-        ).aggregate(
-            total_revenue=Sum(F('quantity') * F('price_at_sale'))
-        )['total_revenue'] or 0
+        # Calculate total revenue and cost of goods sold from the daily sales rollups
+        totals = facts_between(start_date, end_date).aggregate(
+            total_revenue=Sum('revenue'),
+            total_cost=Sum('cost')
+        )
+        sales_revenue = totals['total_revenue'] or 0
+        cost_of_goods = totals['total_cost'] or 0
         
         # Calculate profit
         profit = sales_revenue - inventory_cost
@@ -255,8 +269,9 @@ class ProductCostRevenueAnalysisView(APIView):
         return Response({
             'inventory_cost': inventory_cost,
             'sales_revenue': sales_revenue,
+            'cost_of_goods_sold': cost_of_goods,
+            'gross_profit': sales_revenue - cost_of_goods,
             'profit': profit,
             'start_date': start_date,
             'end_date': end_date
         })
-
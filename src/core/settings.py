@@ -83,10 +83,20 @@ WSGI_APPLICATION = 'core.wsgi.application'
 
 
 #^ DATABASES
+#* Writers take the SQLite lock when their transaction begins and wait for it up to `timeout` seconds,
+#* instead of failing with "database is locked" when two of them race. The test database is a file,
+#* not in memory, so the concurrency tests (products.tests.StockContentionTests) run their threads on it
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'OPTIONS': {
+            'timeout': 30,
+            'transaction_mode': 'IMMEDIATE',
+        },
+        'TEST': {
+            'NAME': BASE_DIR / 'test_db.sqlite3',
+        },
     }
 }
 
@@ -144,24 +154,61 @@ DATA_UPLOAD_MAX_NUMBER_FIELDS=50000
 
 
 #^ < ==========================Email========================== >
-EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
+#* SMTP by default, console or filebased (writing to EMAIL_FILE_PATH) for local testing
+EMAIL_BACKEND = os.getenv('EMAIL_BACKEND', 'django.core.mail.backends.smtp.EmailBackend')
+EMAIL_FILE_PATH = os.getenv('EMAIL_FILE_PATH', os.path.join(BASE_DIR, 'sent_emails'))
 EMAIL_HOST = 'smtp.gmail.com'
 EMAIL_PORT = 587
 EMAIL_USE_TLS = True
 EMAIL_HOST_USER = 'platraincloud@gmail.com'
 EMAIL_HOST_PASSWORD = 'meczfpooichwkudl'
+EMAIL_TIMEOUT = int(os.getenv('EMAIL_TIMEOUT', 10))
+DEFAULT_FROM_EMAIL = os.getenv('DEFAULT_FROM_EMAIL', 'from@example.com')
+
+#* Queued emails (accounts.mailer): attempts before an email fails, emails sent per minute (0 for no cap)
+EMAIL_MAX_ATTEMPTS = int(os.getenv('EMAIL_MAX_ATTEMPTS', 6))
+EMAIL_SENDS_PER_MINUTE = int(os.getenv('EMAIL_SENDS_PER_MINUTE', 60))
 
 #^ < ==========================CACHES CONFIG========================== >
 
-# CACHES = {
-#     'default': {
-#         'BACKEND': 'django_redis.cache.RedisCache',
-#         'LOCATION': 'redis://127.0.0.1:6379/1',  
-#         'OPTIONS': {
-#             'CLIENT_CLASS': 'django_redis.client.DefaultClient',
-#         }
-#     }
-# }
+#* Redis when REDIS_URL is set (needs django-redis), local memory otherwise
+#* Run more than one worker with a shared cache (Redis): the in-process copies of the discounts,
+#* shipping rates and recommendation arrays (products.process_cache) are invalidated in the other
+#* workers through it. With local memory they only catch up with an edit after their max age.
+if os.getenv('REDIS_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django_redis.cache.RedisCache',
+            'LOCATION': os.getenv('REDIS_URL'),
+            'OPTIONS': {
+                'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+            }
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
+#* Lifetime (seconds) of the cached catalog responses, see products.cache
+CATALOG_CACHE_TIMEOUT = int(os.getenv('CATALOG_CACHE_TIMEOUT', 60 * 15))
+
+#* Lifetime (seconds) of the stock reserved at checkout, see products.inventory. Waiting cash on delivery
+#* pills keep their reservation until they are delivered or canceled
+STOCK_RESERVATION_TTL = int(os.getenv('STOCK_RESERVATION_TTL', 60 * 15))
+
+#* Age (seconds) past which the best-seller rankings are ignored and summed from the daily rollups,
+#* see products.bestsellers. Refresh them more often, e.g. hourly from cron with
+#* `manage.py refresh_best_sellers`, or keep `manage.py refresh_best_sellers --interval 3600` running
+BEST_SELLERS_MAX_AGE = int(os.getenv('BEST_SELLERS_MAX_AGE', 60 * 60 * 3))
+
+#* Costing of the units sold, 'fifo' or 'average' (moving average), see analysis.cogs
+COGS_METHOD = os.getenv('COGS_METHOD', 'fifo')
+
+#* Node id (0-99) embedded in the pill numbers of this server, derived from the host and process when unset
+PILL_NUMBER_NODE = os.getenv('PILL_NUMBER_NODE')
 
 
 #^ < ==========================REST FRAMEWORK SETTINGS========================== >
@@ -231,6 +278,19 @@ CORS_ALLOW_METHODS = [
 #* WHATSAPP CREDENTIALS
 WHATSAPP_TOKEN = os.getenv('WHATSAPP_TOKEN')
 WHATSAPP_ID = os.getenv('WHATSAPP_ID')
+WHATSAPP_API_URL = os.getenv('WHATSAPP_API_URL')
+
+#* Gateway the outbox worker sends through, products.whatsapp.FakeWhatsAppGateway records messages locally
+WHATSAPP_GATEWAY = os.getenv('WHATSAPP_GATEWAY', 'products.whatsapp.WhatsAppGateway')
+
+#* Connect and read timeouts (seconds) and pooled connections of the gateway
+WHATSAPP_TIMEOUT = (float(os.getenv('WHATSAPP_CONNECT_TIMEOUT', 3.05)), float(os.getenv('WHATSAPP_READ_TIMEOUT', 10)))
+WHATSAPP_POOL_SIZE = int(os.getenv('WHATSAPP_POOL_SIZE', 10))
+
+#* Outbox limits: attempts before a message fails, seconds between two messages to a phone, messages per second
+WHATSAPP_MAX_ATTEMPTS = int(os.getenv('WHATSAPP_MAX_ATTEMPTS', 8))
+WHATSAPP_PER_PHONE_INTERVAL = int(os.getenv('WHATSAPP_PER_PHONE_INTERVAL', 5))
+WHATSAPP_RATE_PER_SECOND = int(os.getenv('WHATSAPP_RATE_PER_SECOND', 10))
 
 # ^ < ==========================AWS CONFIG========================== >
 
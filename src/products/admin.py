@@ -1,8 +1,10 @@
 
-from django.contrib import admin
+from django.contrib import admin, messages
+from django.utils import timezone
+from django.core.exceptions import ValidationError
 from .models import (
-    Category, PayRequest, PillItem, PriceDropAlert, ProductSales, SpinWheelDiscount, SpinWheelResult, StockAlert, SubCategory, Brand, Product, ProductImage, 
-    Color, ProductAvailability, Rating, Shipping, Pill, Discount,
+    Category, PayRequest, PillItem, PriceDropAlert, ProductSales, ProductSalesDaily, SpinWheelDiscount, SpinWheelResult, StockAlert, SubCategory, Brand, Product, ProductImage, 
+    Color, ProductAvailability, Rating, Shipping, Pill, Discount, StockMovement, StockReservation, WhatsAppMessage,
     CouponDiscount, PillAddress
 )
 
@@ -60,11 +62,18 @@ admin.site.register(PillItem)
 
 @admin.register(ProductSales)
 class ProductSalesAdmin(admin.ModelAdmin):
-    list_display = ('product', 'quantity', 'size', 'color', 'price_at_sale', 'date_sold', 'pill')
+    list_display = ('product', 'quantity', 'size', 'color', 'price_at_sale', 'unit_cost', 'date_sold', 'pill')
     list_filter = ('date_sold', 'size', 'color')
     search_fields = ('product__name', 'pill__pill_number')
     date_hierarchy = 'date_sold'
-    readonly_fields = ('date_sold',)
+    readonly_fields = ('date_sold', 'unit_cost')
+
+@admin.register(ProductSalesDaily)
+class ProductSalesDailyAdmin(admin.ModelAdmin):
+    list_display = ('day', 'product', 'category', 'brand', 'quantity', 'revenue', 'cost')
+    list_filter = ('day', 'category', 'brand')
+    search_fields = ('product__name',)
+    list_select_related = ('product', 'category', 'brand')
 
 # ProductImage admin
 @admin.register(ProductImage)
@@ -85,6 +94,59 @@ class ProductAvailabilityAdmin(admin.ModelAdmin):
     list_filter = ('size', 'color')
     search_fields = ('product__name', 'color__name')
 
+# StockMovement admin, read-only: the ledger is append-only
+@admin.register(StockMovement)
+class StockMovementAdmin(admin.ModelAdmin):
+    list_display = ('product', 'size', 'color', 'kind', 'quantity', 'pill', 'created_at')
+    list_filter = ('kind', 'created_at')
+    search_fields = ('product__name', 'pill__pill_number')
+    date_hierarchy = 'created_at'
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+# StockReservation admin
+@admin.register(StockReservation)
+class StockReservationAdmin(admin.ModelAdmin):
+    list_display = ('pill', 'availability', 'quantity', 'expires_at', 'created_at')
+    list_filter = ('expires_at',)
+    search_fields = ('pill__pill_number', 'availability__product__name')
+
+    # Reservations hold stock, they are released through the pill status or the sweeper
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+# WhatsAppMessage admin
+@admin.register(WhatsAppMessage)
+class WhatsAppMessageAdmin(admin.ModelAdmin):
+    list_display = ('phone', 'idempotency_key', 'status', 'attempts', 'next_attempt_at', 'sent_at')
+    list_filter = ('status',)
+    search_fields = ('phone', 'idempotency_key', 'pill__pill_number')
+    readonly_fields = ('phone', 'message', 'idempotency_key', 'pill', 'attempts', 'last_error', 'created_at', 'sent_at')
+    actions = ['retry_messages']
+
+    def has_add_permission(self, request):
+        return False
+
+    @admin.action(description="Retry the selected messages")
+    def retry_messages(self, request, queryset):
+        updated = queryset.exclude(status=WhatsAppMessage.SENT).update(
+            status=WhatsAppMessage.PENDING, attempts=0, next_attempt_at=timezone.now()
+        )
+        self.message_user(request, f"{updated} messages queued again.")
+
 # Rating admin
 @admin.register(Rating)
 class RatingAdmin(admin.ModelAdmin):
@@ -116,10 +178,41 @@ class PillAdmin(admin.ModelAdmin):
         'price_without_coupons', 'coupon_discount', 'price_after_coupon_discount',
         'shipping_price', 'final_price'
     )
+    actions = ['mark_under_delivery', 'mark_delivered', 'mark_refused', 'mark_canceled']
+
+    def transition(self, request, queryset, status):
+        try:
+            moved = Pill.transition_many(queryset, status)
+        except ValidationError as error:
+            self.message_user(request, ' '.join(error.messages), messages.ERROR)
+            return
+        self.message_user(request, f"{len(moved)} bills updated.", messages.SUCCESS)
+
+    @admin.action(description='Mark selected bills as under delivery')
+    def mark_under_delivery(self, request, queryset):
+        self.transition(request, queryset, 'u')
+
+    @admin.action(description='Mark selected bills as delivered')
+    def mark_delivered(self, request, queryset):
+        self.transition(request, queryset, 'd')
+
+    @admin.action(description='Mark selected bills as refused')
+    def mark_refused(self, request, queryset):
+        self.transition(request, queryset, 'r')
+
+    @admin.action(description='Mark selected bills as canceled')
+    def mark_canceled(self, request, queryset):
+        self.transition(request, queryset, 'c')
+
+    # Unfrozen pills compute their totals from the items and the address
+    list_select_related = ('pilladdress',)
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).prefetch_related('items__product')
 
     # Custom method to display the coupon discount in the list_display
     def coupon_discount(self, obj):
-        return obj.coupon_discount()
+        return obj.coupon_discount
     coupon_discount.short_description = 'Coupon Discount'
 
     # Custom method to display the price without coupons in the list_display
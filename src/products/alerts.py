@@ -0,0 +1,89 @@
+from django.db import transaction
+from django.db.models import F, Q, Sum
+
+# Alerts notified per batch: one locking read, one email insert and one update each
+BATCH_SIZE = 500
+
+
+def schedule_alert_check(product_ids):
+    """Check the alerts of changed products once the transaction commits"""
+    product_ids = set(product_ids)
+    if product_ids:
+        transaction.on_commit(lambda: dispatch_alerts(product_ids))
+
+
+def in_stock_products(product_ids):
+    """The products of `product_ids` (all when None) with available stock, in one query"""
+    from .models import ProductAvailability
+
+    availabilities = ProductAvailability.objects.all()
+    if product_ids is not None:
+        availabilities = availabilities.filter(product_id__in=product_ids)
+    return set(
+        availabilities.values('product_id').annotate(available=Sum('quantity'))
+        .filter(available__gt=0).values_list('product_id', flat=True)
+    )
+
+
+def notify_in_batches(alerts, build_email, batch_size):
+    """
+    Queue an email per pending alert of the queryset and mark the alerts
+    notified, a batch at a time. Alerts without an email address stay
+    pending, they are still listed by UserActiveAlertsView.
+    """
+    from accounts.mailer import queue_emails
+
+    notified = 0
+    while True:
+        with transaction.atomic():
+            # Another dispatcher may be notifying the same alerts, skip what it holds
+            rows = list(
+                alerts.filter(Q(email__gt='') | Q(user__email__gt=''), is_notified=False)
+                .select_for_update(skip_locked=True, of=('self',))
+                .order_by('id')
+                .values_list('id', 'email', 'user__email', 'product__name', 'product__effective_price', 'product__price')[:batch_size]
+            )
+            queue_emails([
+                build_email(email or user_email, name, effective_price if effective_price is not None else price)
+                for alert_id, email, user_email, name, effective_price, price in rows
+            ])
+            alerts.model.objects.filter(id__in=[row[0] for row in rows]).update(is_notified=True)
+        notified += len(rows)
+        if len(rows) < batch_size:
+            return notified
+
+
+def back_in_stock_email(recipient, name, price):
+    return {
+        'subject': f"{name} is back in stock",
+        'body': f"Good news! {name} is available again.",
+        'recipients': [recipient],
+    }
+
+
+def price_drop_email(recipient, name, price):
+    return {
+        'subject': f"Price drop on {name}",
+        'body': f"The price of {name} dropped to {price:g}.",
+        'recipients': [recipient],
+    }
+
+
+def dispatch_alerts(product_ids=None, batch_size=BATCH_SIZE):
+    """
+    Notify the pending stock and price-drop alerts matched by the given
+    products (every product when None). The matching is set-based, so the
+    cost grows with the changed products, not with the users watching them.
+    Returns the numbers of stock and price-drop alerts notified.
+    """
+    from .models import PriceDropAlert, StockAlert
+
+    stock_alerts = StockAlert.objects.filter(product_id__in=in_stock_products(product_ids))
+    price_alerts = PriceDropAlert.objects.filter(product__effective_price__lt=F('last_price'))
+    if product_ids is not None:
+        price_alerts = price_alerts.filter(product_id__in=product_ids)
+
+    return (
+        notify_in_batches(stock_alerts, back_in_stock_email, batch_size),
+        notify_in_batches(price_alerts, price_drop_email, batch_size),
+    )
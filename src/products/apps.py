@@ -1,6 +1,13 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 
 
 class ProductsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'products'
+
+    def ready(self):
+        from . import search, signals
+        post_migrate.connect(signals.backfill_effective_prices, sender=self)
+        post_migrate.connect(signals.backfill_pill_subtotals, sender=self)
+        post_migrate.connect(search.create_search_schema, sender=self)
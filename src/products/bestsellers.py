@@ -0,0 +1,187 @@
+from collections import defaultdict
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, F, FloatField, IntegerField, Sum, Value, When
+from django.utils import timezone
+
+# Windows (days) with a precomputed ranking, 0 meaning all time
+WINDOWS = (1, 7, 30, 0)
+
+
+def window_start(window, today=None):
+    """First day of a window ending today, None for all time"""
+    if not window:
+        return None
+    today = today or timezone.localdate()
+    return today - timedelta(days=window - 1)
+
+
+def per_row(amounts, output_field):
+    """CASE expression mapping row ids to an amount"""
+    return Case(
+        *[When(id=row_id, then=Value(amount)) for row_id, amount in amounts.items()],
+        output_field=output_field
+    )
+
+
+def daily_rows(keys):
+    """Ids of the daily rollups of (product id, day) keys"""
+    from .models import ProductSalesDaily
+
+    return dict(
+        ((product_id, day), row_id) for row_id, product_id, day in ProductSalesDaily.objects.filter(
+            product_id__in={product_id for product_id, day in keys},
+            day__in={day for product_id, day in keys},
+        ).values_list('id', 'product_id', 'day')
+    )
+
+
+def record_daily_sales(sales, sign=1):
+    """
+    Add (sign=1) or remove (sign=-1) sales from the daily rollups, with one
+    insert of the missing rows and one update for all of them. Removed sales
+    take back the cost of goods assigned to them. Runs in the caller's
+    transaction.
+    """
+    from .models import Product, ProductSalesDaily
+
+    totals = defaultdict(lambda: [0, 0.0, 0.0])
+    for sale in sales:
+        key = (sale.product_id, timezone.localdate(sale.date_sold))
+        totals[key][0] += sign * sale.quantity
+        totals[key][1] += sign * sale.quantity * sale.price_at_sale
+        totals[key][2] += sign * sale.quantity * (sale.unit_cost or 0.0)
+    if not totals:
+        return
+
+    with transaction.atomic():
+        taxonomy = {
+            product_id: (category_id, brand_id) for product_id, category_id, brand_id in
+            Product.objects.filter(id__in={product_id for product_id, day in totals}).values_list('id', 'category_id', 'brand_id')
+        }
+        # Create the missing rows empty first, so concurrent sales never lose an increment
+        ProductSalesDaily.objects.bulk_create([
+            ProductSalesDaily(
+                product_id=product_id, day=day,
+                category_id=taxonomy.get(product_id, (None, None))[0], brand_id=taxonomy.get(product_id, (None, None))[1],
+            )
+            for product_id, day in totals
+        ], ignore_conflicts=True)
+        rows = daily_rows(totals)
+        quantities = {rows[key]: quantity for key, (quantity, revenue, cost) in totals.items()}
+        revenues = {rows[key]: revenue for key, (quantity, revenue, cost) in totals.items()}
+        costs = {rows[key]: cost for key, (quantity, revenue, cost) in totals.items()}
+        ProductSalesDaily.objects.filter(id__in=quantities).update(
+            quantity=F('quantity') + per_row(quantities, IntegerField()),
+            revenue=F('revenue') + per_row(revenues, FloatField()),
+            cost=F('cost') + per_row(costs, FloatField()),
+        )
+
+
+def record_daily_costs(costs, batch_size=1000):
+    """
+    Add the cost of goods assigned to sales ({(product id, day): cost}) to
+    their daily rollups, which their sales created.
+    """
+    from .models import ProductSalesDaily
+
+    rows = daily_rows(costs)
+    amounts = {rows[key]: cost for key, cost in costs.items() if key in rows}
+    ids = list(amounts)
+    for start in range(0, len(ids), batch_size):
+        chunk = {row_id: amounts[row_id] for row_id in ids[start:start + batch_size]}
+        ProductSalesDaily.objects.filter(id__in=chunk).update(cost=F('cost') + per_row(chunk, FloatField()))
+
+
+def rebuild_daily_sales(batch_size=1000):
+    """Recompute the daily rollups of every product from the sales"""
+    from .models import ProductSales, ProductSalesDaily
+
+    totals = defaultdict(lambda: [0, 0.0, 0.0])
+    taxonomy = {}
+    sales = ProductSales.objects.values_list(
+        'product_id', 'product__category_id', 'product__brand_id', 'date_sold', 'quantity', 'price_at_sale', 'unit_cost'
+    )
+    for product_id, category_id, brand_id, date_sold, quantity, price, unit_cost in sales.iterator(chunk_size=batch_size):
+        key = (product_id, timezone.localdate(date_sold))
+        totals[key][0] += quantity
+        totals[key][1] += quantity * price
+        totals[key][2] += quantity * (unit_cost or 0.0)
+        taxonomy[product_id] = (category_id, brand_id)
+
+    with transaction.atomic():
+        ProductSalesDaily.objects.all().delete()
+        ProductSalesDaily.objects.bulk_create(
+            (ProductSalesDaily(
+                product_id=product_id, day=day, category_id=taxonomy[product_id][0], brand_id=taxonomy[product_id][1],
+                quantity=quantity, revenue=revenue, cost=cost,
+            ) for (product_id, day), (quantity, revenue, cost) in totals.items()),
+            batch_size=batch_size
+        )
+
+
+def rank_products(rows):
+    """
+    Rank (product id, category id, brand id, quantity, revenue) rows by
+    units then revenue, overall and within category and brand.
+    """
+    rows = sorted(rows, key=lambda row: (-row[3], -row[4], row[0]))
+    category_ranks = defaultdict(int)
+    brand_ranks = defaultdict(int)
+    ranked = []
+    for rank, (product_id, category_id, brand_id, quantity, revenue) in enumerate(rows, start=1):
+        category_ranks[category_id] += 1
+        brand_ranks[brand_id] += 1
+        ranked.append((product_id, category_id, brand_id, quantity, revenue, rank,
+                       category_ranks[category_id], brand_ranks[brand_id]))
+    return ranked
+
+
+def sales_over(start=None, end=None):
+    """Units and revenue per product between two days, from the daily rollups"""
+    from .models import ProductSalesDaily
+
+    daily = ProductSalesDaily.objects.all()
+    if start:
+        daily = daily.filter(day__gte=start)
+    if end:
+        daily = daily.filter(day__lte=end)
+    return daily.values('product').annotate(
+        total_quantity=Sum('quantity'), total_revenue=Sum('revenue')
+    ).filter(total_quantity__gt=0)
+
+
+def ranking_is_fresh(window):
+    """
+    Whether the window has a ranking refreshed less than BEST_SELLERS_MAX_AGE
+    ago. Otherwise (refresh_best_sellers did not run, or stopped) the
+    rankings are summed from the daily rollups instead.
+    """
+    from .models import BestSeller
+
+    refreshed_at = BestSeller.objects.filter(window=window).order_by('rank').values_list('refreshed_at', flat=True).first()
+    return refreshed_at is not None and timezone.now() - refreshed_at < timedelta(seconds=settings.BEST_SELLERS_MAX_AGE)
+
+
+def refresh_best_sellers(windows=WINDOWS, batch_size=1000):
+    """Recompute the best-seller rankings of the windows from the daily rollups"""
+    from .models import BestSeller
+
+    now = timezone.now()
+    today = timezone.localdate(now)
+    for window in windows:
+        rows = sales_over(window_start(window, today)).values_list(
+            'product', 'product__category', 'product__brand', 'total_quantity', 'total_revenue'
+        )
+        ranked = rank_products(rows)
+        with transaction.atomic():
+            BestSeller.objects.filter(window=window).delete()
+            BestSeller.objects.bulk_create([
+                BestSeller(
+                    window=window, product_id=product_id, category_id=category_id, brand_id=brand_id,
+                    quantity=quantity, revenue=revenue, rank=rank,
+                    category_rank=category_rank, brand_rank=brand_rank, refreshed_at=now,
+                )
+                for product_id, category_id, brand_id, quantity, revenue, rank, category_rank, brand_rank in ranked
+            ], batch_size=batch_size)
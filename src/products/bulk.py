@@ -0,0 +1,128 @@
+from django.db import transaction
+from .alerts import schedule_alert_check
+from .cache import invalidate_tags
+from .discounts import EFFECTIVE_PRICE_FIELDS
+from .imports import to_number
+from .inventory import set_stock_levels
+
+# Rows accepted by one bulk update
+MAX_ROWS = 10000
+
+
+def failed(index, errors):
+    return {'row': index, 'status': 'failed', 'errors': errors}
+
+
+def clean_prices(rows, known_products):
+    """Valid {product id: price} of price rows, and the outcomes of the invalid ones"""
+    prices, outcomes = {}, {}
+    for index, row in enumerate(rows):
+        errors = {}
+        if not isinstance(row, dict):
+            outcomes[index] = failed(index, {'row': "An object is required"})
+            continue
+        product_id = to_number(row.get('id'), 'id', errors, cast=int, minimum=1)
+        price = to_number(row.get('price'), 'price', errors)
+        if product_id is not None and product_id not in known_products:
+            errors['id'] = f"Unknown product {product_id}"
+        elif product_id in prices:
+            errors['id'] = "The product is repriced by an earlier row"
+        if errors:
+            outcomes[index] = failed(index, errors)
+        else:
+            prices[product_id] = (index, price)
+    return prices, outcomes
+
+
+def clean_stock(rows, known_products, known_colors, sizes):
+    """Valid {sku: (row, quantity)} of stock rows, and the outcomes of the invalid ones"""
+    levels, outcomes = {}, {}
+    for index, row in enumerate(rows):
+        errors = {}
+        if not isinstance(row, dict):
+            outcomes[index] = failed(index, {'row': "An object is required"})
+            continue
+        product_id = to_number(row.get('product'), 'product', errors, cast=int, minimum=1)
+        color_id = None
+        if row.get('color') is not None:
+            color_id = to_number(row['color'], 'color', errors, cast=int, minimum=1)
+            if color_id is not None and color_id not in known_colors:
+                errors['color'] = f"Unknown color {color_id}"
+        size = row.get('size') or None
+        if size is not None and (not isinstance(size, str) or size not in sizes):
+            errors['size'] = f"Unknown size \"{size}\""
+        quantity = to_number(row.get('quantity'), 'quantity', errors, cast=int)
+        if product_id is not None and product_id not in known_products:
+            errors['product'] = f"Unknown product {product_id}"
+        sku = (product_id, size if isinstance(size, str) else None, color_id)
+        if sku in levels:
+            errors['product'] = "The SKU is counted by an earlier row"
+        if errors:
+            outcomes[index] = failed(index, errors)
+        else:
+            levels[sku] = (index, quantity)
+    return levels, outcomes
+
+
+def set_prices(prices, batch_size=1000):
+    """
+    Set the price ({product id: price}) of products with one bulk update,
+    refreshing their effective price. Returns the ids of the products whose
+    price changed.
+    """
+    from .models import Product
+
+    changed = []
+    for product in Product.objects.filter(id__in=prices).only('id', 'price', 'category_id', *EFFECTIVE_PRICE_FIELDS):
+        if product.price != prices[product.id]:
+            product.price = prices[product.id]
+            product.update_effective_price()
+            changed.append(product)
+    Product.objects.bulk_update(changed, ['price', *EFFECTIVE_PRICE_FIELDS], batch_size=batch_size)
+    return [product.id for product in changed]
+
+
+def bulk_update_catalog(prices=(), stock=()):
+    """
+    Apply price rows ({id, price}) and stock count rows ({product, size,
+    color, quantity}, the units counted in the warehouse, reserved ones
+    included, see set_stock_levels) in one transaction, with set-based queries instead
+    of a save per row. Invalid rows are skipped. The cached catalog
+    responses and the alerts are refreshed once for all rows. Returns the
+    outcome of every row, 'updated', 'unchanged' or 'failed' with its
+    errors, and the counts of each.
+    """
+    from .models import SIZES_CHOICES, Color, Product
+
+    values = [row.get('id') for row in prices if isinstance(row, dict)]
+    values += [row.get('product') for row in stock if isinstance(row, dict)]
+    product_ids = {int(value) for value in values if str(value).isdigit()}
+    known_products = set(Product.objects.filter(id__in=product_ids).values_list('id', flat=True))
+    known_colors = set(Color.objects.values_list('id', flat=True))
+
+    valid_prices, price_outcomes = clean_prices(prices, known_products)
+    levels, stock_outcomes = clean_stock(stock, known_products, known_colors, {size for size, label in SIZES_CHOICES})
+
+    with transaction.atomic():
+        repriced = set(set_prices({product_id: price for product_id, (index, price) in valid_prices.items()}))
+        movements = set_stock_levels({sku: quantity for sku, (index, quantity) in levels.items()})
+        if repriced:
+            transaction.on_commit(lambda: invalidate_tags('product'))
+            # A lower price may match price-drop alerts
+            schedule_alert_check(repriced)
+
+    for product_id, (index, price) in valid_prices.items():
+        price_outcomes[index] = {'row': index, 'status': 'updated' if product_id in repriced else 'unchanged'}
+    counted = {(movement.product_id, movement.size, movement.color_id) for movement in movements}
+    for sku, (index, quantity) in levels.items():
+        stock_outcomes[index] = {'row': index, 'status': 'updated' if sku in counted else 'unchanged'}
+
+    report = {
+        'prices': [price_outcomes[index] for index in sorted(price_outcomes)],
+        'stock': [stock_outcomes[index] for index in sorted(stock_outcomes)],
+    }
+    for status in ['updated', 'unchanged', 'failed']:
+        report[status] = sum(
+            1 for outcome in report['prices'] + report['stock'] if outcome['status'] == status
+        )
+    return report
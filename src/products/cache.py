@@ -0,0 +1,84 @@
+import hashlib
+import time
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils.http import parse_etags
+from rest_framework import status
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+from .discounts import discount_index
+
+CACHE_TIMEOUT = getattr(settings, 'CATALOG_CACHE_TIMEOUT', 60 * 15)
+TAG_KEY = 'catalog:tag:{}'
+RESPONSE_KEY = 'catalog:response:{}'
+
+
+def get_tag_versions(tags):
+    """Current version of each tag, starting unknown tags at a fresh value"""
+    keys = [TAG_KEY.format(tag) for tag in tags]
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            # A fresh value, so entries cached before an eviction are never served
+            cache.add(key, time.time_ns(), None)
+            versions[key] = cache.get(key)
+    return [versions[key] for key in keys]
+
+
+def invalidate_tags(*tags):
+    """Expire every cached response depending on one of the tags"""
+    for tag in tags:
+        try:
+            cache.incr(TAG_KEY.format(tag))
+        except ValueError:
+            cache.set(TAG_KEY.format(tag), time.time_ns(), None)
+
+
+def invalidate_tags_on_commit(*tags):
+    """Expire the responses once the current transaction commits, so none is cached from the old rows"""
+    transaction.on_commit(lambda: invalidate_tags(*tags))
+
+
+def etag_matches(if_none_match, etag):
+    """Whether an If-None-Match header (a list of ETags or *) matches, compared weakly"""
+    etags = parse_etags(if_none_match)
+    if etags == ['*']:
+        return True
+    return etag.removeprefix('W/') in {tag.removeprefix('W/') for tag in etags}
+
+
+def get_timeout():
+    # Discounted prices change when a discount starts or ends
+    expires_at = discount_index.expires_at()
+    if expires_at is None:
+        return CACHE_TIMEOUT
+    return max(1, min(CACHE_TIMEOUT, int(expires_at - time.time())))
+
+
+class CachedResponseMixin:
+    """
+    Cache the responses of a read-only view, keyed by the full URL (path,
+    query and page) and the versions of `cache_tags`. The cached responses
+    carry an ETag, and a matching If-None-Match gets a 304.
+    """
+    cache_tags = ()
+
+    def get(self, request, *args, **kwargs):
+        versions = get_tag_versions(self.cache_tags)
+        url = request.build_absolute_uri()
+        key = RESPONSE_KEY.format(hashlib.sha1(f"{url}|{versions}".encode()).hexdigest())
+
+        cached = cache.get(key)
+        if cached is None:
+            response = super().get(request, *args, **kwargs)
+            if response.status_code != status.HTTP_200_OK:
+                return response
+            etag = '"{}"'.format(hashlib.sha1(JSONRenderer().render(response.data)).hexdigest())
+            cached = {'data': response.data, 'etag': etag}
+            cache.set(key, cached, get_timeout())
+
+        headers = {'ETag': cached['etag']}
+        if etag_matches(request.headers.get('If-None-Match', ''), cached['etag']):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+        return Response(cached['data'], headers=headers)
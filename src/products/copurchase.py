@@ -0,0 +1,129 @@
+from collections import Counter
+from itertools import permutations
+from django.db import transaction
+from django.db.models import F
+
+# Neighbours kept per product
+TOP_K = 10
+
+
+# Primary key of the single CoPurchaseTotal row
+TOTAL_ID = 1
+
+
+def delivered_pill_count():
+    """Delivered pills counted so far, kept as a running total instead of scanning the sales"""
+    from .models import CoPurchaseTotal
+
+    return CoPurchaseTotal.objects.filter(id=TOTAL_ID).values_list('pills', flat=True).first() or 0
+
+
+def record_co_purchases(product_ids, sign=1):
+    """
+    Add (sign=1) or remove (sign=-1) one delivered pill containing the
+    given products from the co-purchase counts, then refresh the neighbours
+    of those products. Runs in the caller's transaction.
+    """
+    from .models import CoPurchaseCount, CoPurchaseTotal
+
+    product_ids = sorted(set(product_ids))
+    if not product_ids:
+        return
+    # Every ordered pair of the pill plus the diagonal of each product
+    pairs = set(permutations(product_ids, 2)) | {(product_id, product_id) for product_id in product_ids}
+
+    with transaction.atomic():
+        if sign > 0:
+            # Missing rows are inserted at 0 and counted by the update below, so
+            # a row inserted at the same time by another delivery (the conflict
+            # ignored here) is still incremented once it commits
+            existing = set(
+                CoPurchaseCount.objects.filter(product_id__in=product_ids, other_id__in=product_ids)
+                .values_list('product_id', 'other_id')
+            )
+            CoPurchaseCount.objects.bulk_create([
+                CoPurchaseCount(product_id=product_id, other_id=other_id, pills=0)
+                for product_id, other_id in pairs - existing
+            ], ignore_conflicts=True)
+            CoPurchaseTotal.objects.bulk_create([CoPurchaseTotal(id=TOTAL_ID)], ignore_conflicts=True)
+        CoPurchaseCount.objects.filter(product_id__in=product_ids, other_id__in=product_ids).update(
+            pills=F('pills') + sign
+        )
+        CoPurchaseTotal.objects.filter(id=TOTAL_ID).update(pills=F('pills') + sign)
+        if sign < 0:
+            CoPurchaseCount.objects.filter(product_id__in=product_ids, pills__lte=0).delete()
+        refresh_neighbors(product_ids)
+
+
+def refresh_neighbors(product_ids, top_k=TOP_K, total_pills=None):
+    """
+    Rebuild the top-K neighbours of the given products from the co-purchase
+    counts. The lift uses the number of delivered pills at refresh time, so
+    it drifts for products that are not bought for a while until the next
+    rebuild_co_purchases; the ranking by support stays exact.
+    """
+    from .models import CoPurchaseCount, CoPurchaseNeighbor
+
+    product_ids = list(product_ids)
+    if total_pills is None:
+        total_pills = delivered_pill_count()
+
+    top = {}
+    for product_id in product_ids:
+        top[product_id] = list(
+            CoPurchaseCount.objects.filter(product_id=product_id).exclude(other_id=product_id)
+            .order_by('-pills', 'other_id').values_list('other_id', 'pills')[:top_k]
+        )
+    involved = set(product_ids) | {other_id for rows in top.values() for other_id, pills in rows}
+    pill_counts = dict(
+        CoPurchaseCount.objects.filter(product_id__in=involved, other_id=F('product_id'))
+        .values_list('product_id', 'pills')
+    )
+
+    neighbors = []
+    for product_id, rows in top.items():
+        for rank, (other_id, pills) in enumerate(rows, start=1):
+            expected = pill_counts.get(product_id, 0) * pill_counts.get(other_id, 0)
+            neighbors.append(CoPurchaseNeighbor(
+                product_id=product_id,
+                neighbor_id=other_id,
+                rank=rank,
+                support=pills,
+                lift=pills * total_pills / expected if expected else 0.0,
+            ))
+    CoPurchaseNeighbor.objects.filter(product_id__in=product_ids).delete()
+    CoPurchaseNeighbor.objects.bulk_create(neighbors)
+
+
+def rebuild_co_purchases(top_k=TOP_K, batch_size=1000):
+    """
+    Recompute the co-purchase counts, the delivered pill total and the
+    neighbours of every product from the sales, walking the delivered pills
+    one at a time.
+    """
+    from .models import CoPurchaseCount, CoPurchaseTotal, Product, ProductSales
+
+    counts = Counter()
+    pill_id, basket = None, set()
+    sales = ProductSales.objects.order_by('pill_id').values_list('pill_id', 'product_id').distinct()
+    for sale_pill_id, product_id in sales.iterator(chunk_size=batch_size):
+        if sale_pill_id != pill_id:
+            counts.update(permutations(basket, 2))
+            counts.update((product, product) for product in basket)
+            pill_id, basket = sale_pill_id, set()
+        basket.add(product_id)
+    counts.update(permutations(basket, 2))
+    counts.update((product, product) for product in basket)
+
+    with transaction.atomic():
+        CoPurchaseCount.objects.all().delete()
+        CoPurchaseCount.objects.bulk_create(
+            (CoPurchaseCount(product_id=product_id, other_id=other_id, pills=pills)
+             for (product_id, other_id), pills in counts.items()),
+            batch_size=batch_size
+        )
+        total_pills = ProductSales.objects.values('pill_id').distinct().count()
+        CoPurchaseTotal.objects.update_or_create(id=TOTAL_ID, defaults={'pills': total_pills})
+        product_ids = list(Product.objects.values_list('id', flat=True))
+        for start in range(0, len(product_ids), batch_size):
+            refresh_neighbors(product_ids[start:start + batch_size], top_k=top_k, total_pills=total_pills)
@@ -0,0 +1,121 @@
+from django.utils import timezone
+from .alerts import schedule_alert_check
+from .process_cache import ProcessCache
+
+
+class DiscountIndex(ProcessCache):
+    """
+    Process-wide index of the currently active discounts.
+
+    Built with a single query, it maps product ids and category ids to their
+    best active discount and expires itself at the next discount start/end.
+    Discount edits reach the other workers through the shared cache, or
+    after `max_age` seconds without one (see ProcessCache).
+    """
+    generation_key = 'products:discount-index:generation'
+    max_age = 60
+
+    def __init__(self):
+        super().__init__()
+        self._by_product = {}
+        self._by_category = {}
+        self._expires_at = None
+
+    def expired(self):
+        return self._expires_at is not None and timezone.now() >= self._expires_at
+
+    def load(self):
+        from .models import Discount
+
+        now = timezone.now()
+        by_product = {}
+        by_category = {}
+        boundaries = []
+        discounts = Discount.objects.filter(is_active=True, discount_end__gte=now)
+        for discount in discounts:
+            if discount.discount_start > now:
+                # Not started yet, the index must be rebuilt when it does
+                boundaries.append(discount.discount_start)
+                continue
+            boundaries.append(discount.discount_end)
+            if discount.product_id:
+                index, key = by_product, discount.product_id
+            else:
+                index, key = by_category, discount.category_id
+            best, latest_end = index.get(key, (None, None))
+            if best is None or discount.discount > best.discount:
+                best = discount
+            if latest_end is None or discount.discount_end > latest_end:
+                latest_end = discount.discount_end
+            index[key] = (best, latest_end)
+
+        self._by_product = by_product
+        self._by_category = by_category
+        self._expires_at = min(boundaries) if boundaries else None
+
+    def get_current_discount(self, product_id, category_id=None):
+        """Returns the best active discount (either product or category level)"""
+        self.ensure_fresh()
+        product_discount = self._by_product.get(product_id, (None, None))[0]
+        category_discount = self._by_category.get(category_id, (None, None))[0] if category_id else None
+        if product_discount and category_discount:
+            return max(product_discount, category_discount, key=lambda d: d.discount)
+        return product_discount or category_discount
+
+    def get_discount_expiry(self, product_id, category_id=None):
+        """Returns when the latest active product discount ends, falling back to the category's"""
+        self.ensure_fresh()
+        expiry = self._by_product.get(product_id, (None, None))[1]
+        if expiry is None and category_id:
+            expiry = self._by_category.get(category_id, (None, None))[1]
+        return expiry
+
+    def expires_at(self):
+        """Timestamp of the next discount start or end, if any"""
+        self.ensure_fresh()
+        return self._expires_at.timestamp() if self._expires_at else None
+
+    def discounted_product_ids(self):
+        self.ensure_fresh()
+        return list(self._by_product)
+
+    def discounted_category_ids(self):
+        self.ensure_fresh()
+        return list(self._by_category)
+
+
+discount_index = DiscountIndex()
+
+
+EFFECTIVE_PRICE_FIELDS = ['effective_price', 'active_discount_pct', 'discount_ends_at']
+
+
+def refresh_effective_prices(queryset=None, batch_size=1000):
+    """
+    Recompute the materialized effective price of the given products (all by
+    default), writing only the rows that changed. Returns the number updated.
+    """
+    from .models import Product
+
+    if queryset is None:
+        queryset = Product.objects.all()
+
+    updated = []
+    changed = []
+    products = queryset.only('id', 'price', 'category_id', *EFFECTIVE_PRICE_FIELDS)
+    for product in products.iterator(chunk_size=batch_size):
+        before = [getattr(product, field) for field in EFFECTIVE_PRICE_FIELDS]
+        product.update_effective_price()
+        if [getattr(product, field) for field in EFFECTIVE_PRICE_FIELDS] != before:
+            changed.append(product)
+        if len(changed) >= batch_size:
+            Product.objects.bulk_update(changed, EFFECTIVE_PRICE_FIELDS)
+            updated += [product.id for product in changed]
+            changed = []
+
+    if changed:
+        Product.objects.bulk_update(changed, EFFECTIVE_PRICE_FIELDS)
+        updated += [product.id for product in changed]
+    # A lower price may match price-drop alerts
+    schedule_alert_check(updated)
+    return len(updated)
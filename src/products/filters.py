@@ -1,9 +1,12 @@
 
-from .models import Category, Pill, Product, ProductImage
+from .models import Category, Pill, Product, ProductImage, ProductSales
 from django_filters import rest_framework as filters
-from django.db.models import Q, F, FloatField, Case, When,Exists, OuterRef
+from rest_framework.filters import SearchFilter
+from django.db.models import Q, Case, When, Exists, OuterRef, IntegerField
 from django.utils import timezone
 from .models import Product, CouponDiscount
+from .search import search_product_ids
+from accounts.pagination import wants_cursor
 
 class ProductFilter(filters.FilterSet):
     price_min = filters.NumberFilter(method='filter_by_discounted_price_min')
@@ -11,82 +14,23 @@ class ProductFilter(filters.FilterSet):
     color = filters.CharFilter(method='filter_by_color')
     size = filters.CharFilter(method='filter_by_size')
     has_images = filters.BooleanFilter(method='filter_has_images')
+    # `price` sorts by the price after discounts
+    ordering = filters.OrderingFilter(fields=(
+        ('effective_price', 'price'),
+        ('date_added', 'date_added'),
+        ('name', 'name'),
+        ('rating_average', 'rating'),
+    ))
 
     class Meta:
         model = Product
         fields = ['category', 'sub_category', 'brand', 'has_images','is_important']
 
     def filter_by_discounted_price_min(self, queryset, name, value):
-        now = timezone.now()
-
-        # Annotate the queryset with product discounts
-        queryset = queryset.annotate(
-            product_discount_price=Case(
-                When(
-                    Q(discounts__discount_start__lte=now) &
-                    Q(discounts__discount_end__gte=now),
-                    then=F('price') * (1 - F('discounts__discount') / 100)
-                ),
-                default=F('price'),
-                output_field=FloatField()
-            ),
-            category_discount_price=Case(
-                When(
-                    Q(category__discounts__discount_start__lte=now) &
-                    Q(category__discounts__discount_end__gte=now),
-                    then=F('price') * (1 - F('category__discounts__discount') / 100)
-                ),
-                default=F('price'),
-                output_field=FloatField()
-            )
-        ).annotate(
-            final_price=Case(
-                When(
-                    product_discount_price__lt=F('category_discount_price'),
-                    then=F('product_discount_price')
-                ),
-                default=F('category_discount_price'),
-                output_field=FloatField()
-            )
-        )
-
-        return queryset.filter(final_price__gte=value).distinct()
+        return queryset.filter(effective_price__gte=value)
 
     def filter_by_discounted_price_max(self, queryset, name, value):
-        now = timezone.now()
-
-        # Same annotation logic as above
-        queryset = queryset.annotate(
-            product_discount_price=Case(
-                When(
-                    Q(discounts__discount_start__lte=now) &
-                    Q(discounts__discount_end__gte=now),
-                    then=F('price') * (1 - F('discounts__discount') / 100)
-                ),
-                default=F('price'),
-                output_field=FloatField()
-            ),
-            category_discount_price=Case(
-                When(
-                    Q(category__discounts__discount_start__lte=now) &
-                    Q(category__discounts__discount_end__gte=now),
-                    then=F('price') * (1 - F('category__discounts__discount') / 100)
-                ),
-                default=F('price'),
-                output_field=FloatField()
-            )
-        ).annotate(
-            final_price=Case(
-                When(
-                    product_discount_price__lt=F('category_discount_price'),
-                    then=F('product_discount_price')
-                ),
-                default=F('category_discount_price'),
-                output_field=FloatField()
-            )
-        )
-
-        return queryset.filter(final_price__lte=value).distinct()
+        return queryset.filter(effective_price__lte=value)
 
     def filter_by_color(self, queryset, name, value):
         return queryset.filter(availabilities__color__name__iexact=value).distinct()
@@ -105,16 +49,41 @@ class ProductFilter(filters.FilterSet):
     def filter_queryset(self, queryset):
         # Apply the filters first
         queryset = super().filter_queryset(queryset)
+        # Order by `date_added` unless already ordered (by relevance or `ordering`)
+        if not queryset.ordered:
+            queryset = queryset.order_by('-date_added')
+        # Keyset pagination walks the whole result itself, so no slicing
+        if self.request is not None and wants_cursor(self.request):
+            return queryset
         # Get the `limit` parameter from the query string (default to 10 if not provided)
         limit = int(self.request.query_params.get('limit', 10))
-        # Order by `date_added` and slice the queryset
-        return queryset.order_by('-date_added')[:limit]
+        # Slice the queryset
+        return queryset[:limit]
     
     
     
     
     
     
+class ProductSearchFilter(SearchFilter):
+    """
+    Ranked full-text search backed by the product search index (see
+    products.search) instead of LIKE scans over joined tables.
+    """
+    def filter_queryset(self, request, queryset, view):
+        query = ' '.join(self.get_search_terms(request))
+        if not query:
+            return queryset
+
+        product_ids = search_product_ids(query)
+        if not product_ids:
+            return queryset.none()
+        relevance = Case(
+            *[When(id=product_id, then=position) for position, product_id in enumerate(product_ids)],
+            output_field=IntegerField()
+        )
+        return queryset.filter(id__in=product_ids).order_by(relevance)
+
 class CouponDiscountFilter(filters.FilterSet):
     available = filters.BooleanFilter(method='filter_available')
 
@@ -155,8 +124,12 @@ class PillFilter(filters.FilterSet):
     class Meta:
         model = Pill
         fields = ['status', 'paid', 'pill_number', 'pilladdress__government', 'pilladdress__pay_method']
-        
-        
-        
-        
-        
\ No newline at end of file
+
+
+class ProductSalesFilter(filters.FilterSet):
+    start_date = filters.DateFilter(field_name='date_sold', lookup_expr='date__gte', label='Start Date')
+    end_date = filters.DateFilter(field_name='date_sold', lookup_expr='date__lte', label='End Date')
+
+    class Meta:
+        model = ProductSales
+        fields = ['product', 'product__category', 'product__brand', 'size', 'color', 'pill']
@@ -0,0 +1,312 @@
+import codecs
+import csv
+import io
+import json
+from itertools import islice
+from django.db import transaction
+from .alerts import schedule_alert_check
+from .cache import invalidate_tags
+from .recommendations import catalog_arrays
+from .search import index_products
+
+# Rows validated and written together, in one transaction
+BATCH_SIZE = 2000
+# Rows with errors reported in full, the others are only counted
+MAX_REPORTED_ERRORS = 1000
+PRODUCT_FIELDS = ['name', 'category', 'sub_category', 'brand', 'price', 'threshold', 'description', 'is_important']
+# Columns of a CSV import holding JSON lists
+NESTED_FIELDS = ['availabilities', 'descriptions', 'images']
+
+
+class RowError(Exception):
+    """A row of the import is invalid, `errors` maps fields to messages"""
+
+    def __init__(self, errors):
+        self.errors = errors
+        super().__init__(errors)
+
+
+def check_encoding(file, chunk_size=64 * 1024):
+    """
+    Raise UnicodeDecodeError unless the binary file is UTF-8 text, reading
+    it in chunks, then rewind it. Checked before the import starts, so a bad
+    file is refused whole instead of failing after some batches were written.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    while chunk := file.read(chunk_size):
+        decoder.decode(chunk)
+    decoder.decode(b'', final=True)
+    file.seek(0)
+
+
+def read_rows(file, file_format):
+    """
+    Rows (dicts) of an uploaded or opened binary file, read as it goes. CSV
+    files have one product per line, their availabilities, descriptions and
+    images columns holding JSON lists; JSONL files one product object per line.
+    """
+    text = io.TextIOWrapper(file, encoding='utf-8-sig', newline='')
+    if file_format == 'csv':
+        for row in csv.DictReader(text):
+            row = {key: value for key, value in row.items() if value not in ('', None)}
+            for field in NESTED_FIELDS:
+                if field in row:
+                    try:
+                        row[field] = json.loads(row[field])
+                    except ValueError:
+                        row[field] = RowError({field: "Not a JSON list"})
+            yield row
+    else:
+        for line in text:
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                yield RowError({'row': "Not a JSON object"})
+
+
+class Lookups:
+    """Ids of the categories, sub-categories, brands and colors by name, loaded once per import"""
+
+    def __init__(self):
+        from .models import SIZES_CHOICES, Brand, Category, Color, SubCategory
+
+        self.sizes = {size for size, label in SIZES_CHOICES}
+        self.categories = {name.lower(): pk for pk, name in Category.objects.values_list('id', 'name')}
+        self.brands = {name.lower(): pk for pk, name in Brand.objects.values_list('id', 'name')}
+        self.colors = {name.lower(): pk for pk, name in Color.objects.values_list('id', 'name')}
+        self.sub_categories = {
+            (category_id, name.lower()): pk
+            for pk, category_id, name in SubCategory.objects.values_list('id', 'category_id', 'name')
+        }
+
+    @staticmethod
+    def find(names, name, label, field, errors):
+        """Id of a `label` (category, brand, color) by name, or an error under `field`"""
+        pk = names.get(str(name).strip().lower())
+        if pk is None:
+            errors[field] = f"Unknown {label} \"{name}\""
+        return pk
+
+
+def to_number(value, field, errors, cast=float, minimum=0):
+    try:
+        number = cast(value)
+    except (TypeError, ValueError):
+        errors[field] = "A number is required"
+        return None
+    if number < minimum:
+        errors[field] = f"Must be at least {minimum}"
+    return number
+
+
+def to_list(value, field, errors):
+    if isinstance(value, RowError):
+        errors.update(value.errors)
+        return []
+    if value is None:
+        return []
+    if not isinstance(value, list):
+        errors[field] = "A list is required"
+        return []
+    return value
+
+
+def to_text(value, field, errors, max_length):
+    text = str(value)
+    if len(text) > max_length:
+        errors[field] = f"Ensure this field has no more than {max_length} characters."
+    return text
+
+
+def clean_row(row, lookups, known_ids):
+    """
+    Validate a row and resolve its names to ids. Returns the product fields,
+    availabilities, descriptions and images, or raises RowError.
+    """
+    if isinstance(row, RowError):
+        raise row
+    if not isinstance(row, dict):
+        raise RowError({'row': "Not a JSON object"})
+
+    errors = {}
+    fields = {}
+    product_id = row.get('id')
+    if product_id is not None:
+        if isinstance(product_id, bool) or not str(product_id).isdigit():
+            errors['id'] = "A product id is required"
+            product_id = None
+        elif int(product_id) not in known_ids:
+            errors['id'] = f"Unknown product {product_id}"
+        else:
+            product_id = int(product_id)
+    elif not str(row.get('name') or '').strip():
+        errors['name'] = "This field is required."
+
+    for field in PRODUCT_FIELDS:
+        if field not in row:
+            continue
+        value = row[field]
+        if field == 'name':
+            fields['name'] = to_text(str(value).strip(), field, errors, 100)
+        elif field == 'category':
+            fields['category_id'] = lookups.find(lookups.categories, value, 'category', field, errors) if value else None
+        elif field == 'brand':
+            fields['brand_id'] = lookups.find(lookups.brands, value, 'brand', field, errors) if value else None
+        elif field == 'price':
+            fields['price'] = None if value is None else to_number(value, field, errors)
+        elif field == 'threshold':
+            fields['threshold'] = to_number(value, field, errors, cast=int)
+        elif field == 'is_important':
+            fields['is_important'] = str(value).strip().lower() in ('1', 'true', 'yes')
+        elif field == 'description':
+            fields['description'] = to_text(value, field, errors, 1000)
+    if row.get('sub_category'):
+        key = (fields.get('category_id'), str(row['sub_category']).strip().lower())
+        fields['sub_category_id'] = lookups.sub_categories.get(key)
+        if fields['sub_category_id'] is None:
+            errors['sub_category'] = f"Unknown sub category \"{row['sub_category']}\" in this category"
+
+    availabilities = []
+    for index, item in enumerate(to_list(row.get('availabilities'), 'availabilities', errors)):
+        field = f'availabilities.{index}'
+        if not isinstance(item, dict):
+            errors[field] = "An object is required"
+            continue
+        size = item.get('size') or None
+        if size is not None and (not isinstance(size, str) or size not in lookups.sizes):
+            errors[f'{field}.size'] = f"Unknown size \"{size}\""
+        color_id = lookups.find(lookups.colors, item['color'], 'color', f'{field}.color', errors) if item.get('color') else None
+        quantity = to_number(item.get('quantity'), f'{field}.quantity', errors, cast=int)
+        native_price = to_number(item.get('native_price', 0), f'{field}.native_price', errors)
+        availabilities.append({'size': size, 'color_id': color_id, 'quantity': quantity, 'native_price': native_price})
+
+    descriptions = []
+    for index, item in enumerate(to_list(row.get('descriptions'), 'descriptions', errors)):
+        field = f'descriptions.{index}'
+        if not isinstance(item, dict) or not item.get('title') or not item.get('description'):
+            errors[field] = "A title and a description are required"
+            continue
+        order = to_number(item.get('order', index), f'{field}.order', errors, cast=int)
+        title = to_text(item['title'], f'{field}.title', errors, 200)
+        descriptions.append({'title': title, 'description': str(item['description']), 'order': order})
+
+    images = []
+    for index, image in enumerate(to_list(row.get('images'), 'images', errors)):
+        if not isinstance(image, str) or not image.strip():
+            errors[f'images.{index}'] = "A stored image path is required"
+            continue
+        images.append(image.strip())
+
+    if errors:
+        raise RowError(errors)
+    return product_id, fields, availabilities, descriptions, images
+
+
+def write_batch(cleaned, batch_size):
+    """
+    Create or update the products of a batch of clean rows and add their
+    availabilities (recorded as stock receipts), descriptions and images,
+    with one bulk query per model. Returns the ids of the products created,
+    updated and restocked.
+    """
+    from .models import Product, ProductAvailability, ProductDescription, ProductImage, StockMovement
+
+    created = [Product(**fields) for product_id, fields, *nested in cleaned if product_id is None]
+    for product in created:
+        product.update_effective_price()
+    Product.objects.bulk_create(created, batch_size=batch_size)
+
+    updates = {product_id: fields for product_id, fields, *nested in cleaned if product_id is not None}
+    updated = list(Product.objects.filter(id__in=updates))
+    changed_fields = set()
+    for product in updated:
+        for field, value in updates[product.id].items():
+            setattr(product, field, value)
+            changed_fields.add(field)
+        product.update_effective_price()
+    if updated:
+        changed_fields.update(['effective_price', 'active_discount_pct', 'discount_ends_at'])
+        Product.objects.bulk_update(updated, sorted(changed_fields), batch_size=batch_size)
+
+    products = iter(created)
+    availabilities, descriptions, images = [], [], []
+    for product_id, fields, product_availabilities, product_descriptions, product_images in cleaned:
+        product_id = product_id or next(products).id
+        availabilities += [ProductAvailability(product_id=product_id, **item) for item in product_availabilities]
+        descriptions += [ProductDescription(product_id=product_id, **item) for item in product_descriptions]
+        images += [ProductImage(product_id=product_id, image=image) for image in product_images]
+
+    ProductAvailability.objects.bulk_create(availabilities, batch_size=batch_size)
+    # bulk_create skips the post_save signal that records hand-made batches in the ledger
+    StockMovement.objects.bulk_create([
+        StockMovement(
+            availability=availability,
+            product_id=availability.product_id,
+            size=availability.size,
+            color_id=availability.color_id,
+            kind=StockMovement.RECEIPT,
+            quantity=availability.quantity,
+        )
+        for availability in availabilities if availability.quantity
+    ], batch_size=batch_size)
+    ProductDescription.objects.bulk_create(descriptions, batch_size=batch_size)
+    ProductImage.objects.bulk_create(images, batch_size=batch_size)
+
+    restocked = {availability.product_id for availability in availabilities if availability.quantity}
+    return [product.id for product in created], [product.id for product in updated], restocked
+
+
+def import_catalog(rows, batch_size=BATCH_SIZE, dry_run=False):
+    """
+    Validate and load product rows (see read_rows) in batches, each written
+    in one transaction with bulk queries. Invalid rows are skipped and
+    reported by row number, the others are loaded. The search index,
+    recommendations and cached catalog responses are refreshed once at
+    the end rather than per product. Returns the report.
+    """
+    from .models import Product
+
+    lookups = Lookups()
+    report = {'created': 0, 'updated': 0, 'failed': 0, 'errors': []}
+    touched = []
+    rows = iter(rows)
+    number = 0
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            break
+        # Ids of any type may come in, only whole numbers are looked up
+        ids = [row.get('id') for row in batch if isinstance(row, dict)]
+        known_ids = set(Product.objects.filter(id__in={
+            int(product_id) for product_id in ids if str(product_id).isdigit()
+        }).values_list('id', flat=True))
+
+        cleaned = []
+        for row in batch:
+            number += 1
+            try:
+                cleaned.append(clean_row(row, lookups, known_ids))
+            except RowError as error:
+                report['failed'] += 1
+                if len(report['errors']) < MAX_REPORTED_ERRORS:
+                    report['errors'].append({'row': number, 'errors': error.errors})
+        if dry_run or not cleaned:
+            report['created'] += sum(1 for product_id, *rest in cleaned if product_id is None)
+            report['updated'] += sum(1 for product_id, *rest in cleaned if product_id is not None)
+            continue
+
+        with transaction.atomic():
+            created, updated, restocked = write_batch(cleaned, batch_size)
+            # New stock or a lower price may match alerts
+            schedule_alert_check(restocked | set(updated))
+        report['created'] += len(created)
+        report['updated'] += len(updated)
+        touched += created + updated
+
+    if touched:
+        transaction.on_commit(lambda: index_products(touched))
+        catalog_arrays.invalidate_on_commit()
+        transaction.on_commit(lambda: invalidate_tags('product'))
+    return report
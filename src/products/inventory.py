@@ -0,0 +1,362 @@
+from collections import defaultdict
+from datetime import timedelta
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Q, Sum, Value, When
+from django.utils import timezone
+from .alerts import schedule_alert_check
+from .bestsellers import record_daily_sales
+from .cache import invalidate_tags
+from .copurchase import record_co_purchases
+from .recommendations import invalidate_user_recommendations
+
+# How many times a decrement re-reads the batches after losing a race
+MAX_RETRIES = 5
+# Lifetime (seconds) of the stock reserved at checkout
+RESERVATION_TTL = getattr(settings, 'STOCK_RESERVATION_TTL', 60 * 15)
+# Reservations that expire: pills not confirmed yet, and waiting pills paid online until they are paid.
+# Waiting cash on delivery pills and later statuses hold their stock until delivery or cancellation.
+EXPIRING_PILLS = Q(pill__status='i') | Q(pill__status='w', pill__paid=False, pill__pilladdress__pay_method='v')
+
+
+class OutOfStock(ValidationError):
+    """Raised when a SKU does not have the requested quantity"""
+
+    def __init__(self, sku):
+        self.sku = sku
+        super().__init__(f"Not enough inventory for product {sku[0]}")
+
+
+class LostRace(Exception):
+    """Another transaction took from a batch between the read and the update"""
+
+
+def sku_filter(product_id, size, color_id):
+    """Lookup of the availability batches of one SKU (product, size, color)"""
+    return {'product_id': product_id, 'size': size, 'color_id': color_id}
+
+
+def group_items(items):
+    """Total quantity per SKU of pill items"""
+    quantities = {}
+    for item in items:
+        key = (item.product_id, item.size, item.color_id)
+        quantities[key] = quantities.get(key, 0) + item.quantity
+    return quantities
+
+
+def per_batch(amounts):
+    """CASE expression mapping availability ids to an amount"""
+    return Case(
+        *[When(id=batch_id, then=Value(amount)) for batch_id, amount in amounts.items()],
+        output_field=IntegerField()
+    )
+
+
+def plan_takes(quantities):
+    """
+    Read the batches of every SKU at once and split each quantity over them,
+    oldest batch first. Returns {availability id: (sku, quantity)}.
+    """
+    from .models import ProductAvailability
+
+    skus = Q()
+    for sku in quantities:
+        skus |= Q(**sku_filter(*sku))
+    batches = ProductAvailability.objects.filter(skus, quantity__gt=0).order_by('date_added', 'id').values_list(
+        'id', 'product_id', 'size', 'color_id', 'quantity'
+    )
+
+    remaining = dict(quantities)
+    plan = {}
+    for batch_id, product_id, size, color_id, batch_quantity in batches:
+        sku = (product_id, size, color_id)
+        if remaining.get(sku):
+            take = min(batch_quantity, remaining[sku])
+            plan[batch_id] = (sku, take)
+            remaining[sku] -= take
+
+    for sku, quantity in remaining.items():
+        if quantity:
+            raise OutOfStock(sku)
+    return plan
+
+
+def take_stock_many(quantities, kind):
+    """
+    Take the quantities ({sku: quantity}) from the availability batches with
+    one read and a single conditional update
+    (`quantity = quantity - n WHERE quantity >= n` for every batch), instead
+    of a read-modify-write per item. Returns the unsaved movements, one per
+    batch touched, and raises OutOfStock when a SKU runs out. Must run
+    inside a transaction, so a failure leaves no partial decrement.
+    """
+    from .models import ProductAvailability, StockMovement
+
+    if not quantities:
+        return []
+    for attempt in range(MAX_RETRIES):
+        plan = plan_takes(quantities)
+        amounts = per_batch({batch_id: take for batch_id, (sku, take) in plan.items()})
+        try:
+            with transaction.atomic():
+                updated = ProductAvailability.objects.filter(id__in=plan, quantity__gte=amounts).update(
+                    quantity=F('quantity') - amounts
+                )
+                if updated != len(plan):
+                    raise LostRace()
+        except LostRace:
+            # Read the batches again and retry
+            continue
+        return [
+            StockMovement(
+                availability_id=batch_id,
+                product_id=product_id,
+                size=size,
+                color_id=color_id,
+                kind=kind,
+                quantity=-take,
+            )
+            for batch_id, ((product_id, size, color_id), take) in plan.items()
+        ]
+    raise ValidationError("The stock changed too often, please try again")
+
+
+def take_stock(product_id, size, color_id, quantity):
+    """Take `quantity` units of a single SKU, see take_stock_many"""
+    from .models import StockMovement
+
+    return take_stock_many({(product_id, size, color_id): quantity}, StockMovement.SALE)
+
+
+def set_stock_levels(levels):
+    """
+    Bring the stock of SKUs to the units counted in the warehouse
+    ({sku: quantity}). The count includes the units held by open
+    reservations, which were already taken from the available quantity, so
+    the available quantity is set to the count less them (never below 0):
+    missing units are taken from the batches oldest first, extra units are
+    added to the newest batch, or to a new one for a SKU without any. Every
+    change is recorded in the ledger as an adjustment. Returns the saved
+    movements.
+    """
+    from .models import ProductAvailability, StockMovement, StockReservation
+
+    if not levels:
+        return []
+    skus = Q()
+    for sku in levels:
+        skus |= Q(**sku_filter(*sku))
+
+    with transaction.atomic():
+        batches = ProductAvailability.objects.select_for_update().filter(skus).order_by('date_added', 'id').values_list(
+            'id', 'product_id', 'size', 'color_id', 'quantity'
+        )
+        totals = defaultdict(int)
+        newest = {}
+        batch_skus = {}
+        for batch_id, product_id, size, color_id, quantity in batches:
+            totals[(product_id, size, color_id)] += quantity
+            newest[(product_id, size, color_id)] = batch_id
+            batch_skus[batch_id] = (product_id, size, color_id)
+
+        reserved = defaultdict(int)
+        held = StockReservation.objects.filter(availability_id__in=batch_skus).values('availability_id').annotate(
+            quantity=Sum('quantity')
+        ).values_list('availability_id', 'quantity')
+        for batch_id, quantity in held:
+            reserved[batch_skus[batch_id]] += quantity
+        levels = {sku: max(level - reserved[sku], 0) for sku, level in levels.items()}
+
+        missing = {sku: totals[sku] - level for sku, level in levels.items() if totals[sku] > level}
+        movements = take_stock_many(missing, StockMovement.ADJUSTMENT)
+
+        extra = {sku: level - totals[sku] for sku, level in levels.items() if level > totals[sku] and sku in newest}
+        if extra:
+            amounts = {newest[sku]: quantity for sku, quantity in extra.items()}
+            ProductAvailability.objects.filter(id__in=amounts).update(quantity=F('quantity') + per_batch(amounts))
+        created = ProductAvailability.objects.bulk_create([
+            ProductAvailability(product_id=product_id, size=size, color_id=color_id, quantity=level)
+            for (product_id, size, color_id), level in levels.items() if level and (product_id, size, color_id) not in newest
+        ])
+        movements += [
+            StockMovement(
+                availability_id=newest[sku], product_id=sku[0], size=sku[1], color_id=sku[2],
+                kind=StockMovement.ADJUSTMENT, quantity=quantity,
+            )
+            for sku, quantity in extra.items()
+        ] + [
+            StockMovement(
+                availability=batch, product_id=batch.product_id, size=batch.size, color_id=batch.color_id,
+                kind=StockMovement.ADJUSTMENT, quantity=batch.quantity,
+            )
+            for batch in created
+        ]
+        StockMovement.objects.bulk_create(movements)
+        transaction.on_commit(lambda: invalidate_tags('product'))
+        schedule_alert_check(movement.product_id for movement in movements if movement.quantity > 0)
+    return movements
+
+
+def take_pill_stock(pill, items, kind):
+    """Take the stock of pill items, naming the product in the error when one runs out"""
+    try:
+        movements = take_stock_many(group_items(items), kind)
+    except OutOfStock as error:
+        names = {item.product_id: item.product.name for item in items}
+        raise ValidationError(f"Not enough inventory for {names[error.sku[0]]}")
+    for movement in movements:
+        movement.pill = pill
+    return movements
+
+
+def reserve_pill_items(pill, items, ttl=RESERVATION_TTL):
+    """
+    Reserve the stock of a new pill for `ttl` seconds, taking it from the
+    available quantity right away so it cannot be sold twice.
+    """
+    from .models import StockMovement, StockReservation
+
+    expires_at = timezone.now() + timedelta(seconds=ttl)
+    with transaction.atomic():
+        movements = take_pill_stock(pill, items, StockMovement.RESERVATION)
+        StockMovement.objects.bulk_create(movements)
+        StockReservation.objects.bulk_create([
+            StockReservation(
+                pill=pill,
+                availability_id=movement.availability_id,
+                quantity=-movement.quantity,
+                expires_at=expires_at,
+            )
+            for movement in movements
+        ])
+        transaction.on_commit(lambda: invalidate_tags('product'))
+    return movements
+
+
+def release_reservations(reservations):
+    """
+    Put the stock of the given reservations (a queryset) back with a single
+    update and delete them. Returns the number of reservations released.
+    """
+    from .models import ProductAvailability, StockMovement, StockReservation
+
+    with transaction.atomic():
+        # Skip reservations another transaction is already releasing or selling
+        rows = list(
+            reservations.select_for_update(skip_locked=True, of=('self',)).select_related('availability').order_by('id')
+        )
+        if not rows:
+            return 0
+
+        amounts = {}
+        for reservation in rows:
+            amounts[reservation.availability_id] = amounts.get(reservation.availability_id, 0) + reservation.quantity
+        amount = per_batch(amounts)
+        ProductAvailability.objects.filter(id__in=amounts).update(quantity=F('quantity') + amount)
+
+        StockMovement.objects.bulk_create([
+            StockMovement(
+                availability_id=reservation.availability_id,
+                product_id=reservation.availability.product_id,
+                size=reservation.availability.size,
+                color_id=reservation.availability.color_id,
+                kind=StockMovement.RELEASE,
+                quantity=reservation.quantity,
+                pill_id=reservation.pill_id,
+            )
+            for reservation in rows
+        ])
+        StockReservation.objects.filter(id__in=[reservation.id for reservation in rows]).delete()
+        transaction.on_commit(lambda: invalidate_tags('product'))
+        schedule_alert_check(reservation.availability.product_id for reservation in rows)
+    return len(rows)
+
+
+def release_expired_reservations(batch_size=1000):
+    """
+    Release the expired reservations of unconfirmed pills and of waiting
+    pills still unpaid online, in batches. Returns the number released.
+    """
+    from .models import StockReservation
+
+    released = 0
+    while True:
+        expired = StockReservation.objects.filter(
+            EXPIRING_PILLS, expires_at__lte=timezone.now()
+        ).order_by('expires_at', 'id').values_list('id', flat=True)[:batch_size]
+        count = release_reservations(StockReservation.objects.filter(id__in=list(expired)))
+        released += count
+        if count < batch_size:
+            return released
+
+
+def sell_pill_items(pill):
+    """
+    Record the sales of a delivered pill and take its stock, all items in one
+    transaction: either every item is taken or none is. Stock the pill still
+    has reserved is released and taken again as a sale.
+    """
+    from .models import ProductSales, StockMovement
+
+    items = list(pill.items.select_related('product'))
+
+    with transaction.atomic():
+        release_reservations(pill.reservations.all())
+        movements = take_pill_stock(pill, items, StockMovement.SALE)
+        StockMovement.objects.bulk_create(movements)
+        sales = ProductSales.objects.bulk_create([
+            ProductSales(
+                product=item.product,
+                quantity=item.quantity,
+                size=item.size,
+                color_id=item.color_id,
+                price_at_sale=item.unit_price if item.unit_price is not None else item.product.discounted_price(),
+                pill=pill
+            )
+            for item in items
+        ])
+        record_daily_sales(sales)
+        record_co_purchases(item.product_id for item in items)
+        transaction.on_commit(lambda: invalidate_tags('product'))
+        transaction.on_commit(lambda: invalidate_user_recommendations(pill.user_id))
+    return movements
+
+
+def return_pill_items(pill):
+    """
+    Put the stock sold with a pill back into the batches it was taken from
+    and drop its sales records.
+    """
+    from .models import ProductAvailability, ProductSales, StockMovement
+
+    with transaction.atomic():
+        sold = {}
+        for movement in StockMovement.objects.filter(pill=pill, kind__in=[StockMovement.SALE, StockMovement.RETURN]):
+            key = (movement.availability_id, movement.product_id, movement.size, movement.color_id)
+            sold[key] = sold.get(key, 0) - movement.quantity
+
+        movements = []
+        for (availability_id, product_id, size, color_id), quantity in sold.items():
+            if quantity <= 0 or availability_id is None:
+                continue
+            ProductAvailability.objects.filter(id=availability_id).update(quantity=F('quantity') + quantity)
+            movements.append(StockMovement(
+                availability_id=availability_id,
+                product_id=product_id,
+                size=size,
+                color_id=color_id,
+                kind=StockMovement.RETURN,
+                quantity=quantity,
+                pill=pill,
+            ))
+        StockMovement.objects.bulk_create(movements)
+        sales = list(ProductSales.objects.filter(pill=pill))
+        ProductSales.objects.filter(pill=pill).delete()
+        record_daily_sales(sales, sign=-1)
+        record_co_purchases((sale.product_id for sale in sales), sign=-1)
+        transaction.on_commit(lambda: invalidate_user_recommendations(pill.user_id))
+        transaction.on_commit(lambda: invalidate_tags('product'))
+        schedule_alert_check(movement.product_id for movement in movements)
+    return movements
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from products.alerts import dispatch_alerts
+
+
+class Command(BaseCommand):
+    help = "Notify every pending stock and price-drop alert whose product now matches, e.g. after a discount started."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        stock, price = dispatch_alerts(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Notified {stock} stock alerts and {price} price-drop alerts"))
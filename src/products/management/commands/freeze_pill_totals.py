@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from products.models import Pill
+
+
+class Command(BaseCommand):
+    help = (
+        "Store the subtotal of the delivered pills from before totals were, priced by their sales. "
+        "Pills that cannot be priced from their sales are left as they are."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        filled = Pill.backfill_subtotals(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Stored the subtotal of {filled} pills"))
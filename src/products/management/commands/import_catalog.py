@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+from products.imports import BATCH_SIZE, check_encoding, import_catalog, read_rows
+
+
+class Command(BaseCommand):
+    help = "Load a CSV or JSONL file of products with their availabilities, descriptions and images"
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+        parser.add_argument('--dry-run', action='store_true', help="Only validate the rows")
+
+    def handle(self, *args, **options):
+        file_format = 'csv' if options['path'].lower().endswith('.csv') else 'jsonl'
+        with open(options['path'], 'rb') as file:
+            try:
+                check_encoding(file)
+            except UnicodeDecodeError:
+                raise CommandError("The file must be UTF-8 text")
+            report = import_catalog(
+                read_rows(file, file_format), batch_size=options['batch_size'], dry_run=options['dry_run']
+            )
+        for error in report['errors']:
+            self.stderr.write(f"Row {error['row']}: {error['errors']}")
+        self.stdout.write(self.style.SUCCESS(
+            f"Created {report['created']} products, updated {report['updated']}, {report['failed']} rows failed"
+        ))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from products.copurchase import TOP_K, rebuild_co_purchases
+
+
+class Command(BaseCommand):
+    help = "Recompute the co-purchase counts and the frequently-bought-together neighbours of every product"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--top-k', type=int, default=TOP_K)
+
+    def handle(self, *args, **options):
+        rebuild_co_purchases(top_k=options['top_k'], batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS("Co-purchases rebuilt"))
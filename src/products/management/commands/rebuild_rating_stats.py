@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from products.ratings import rebuild_rating_stats
+
+
+class Command(BaseCommand):
+    help = "Recompute the stored rating count, sum, average and histogram of every product"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        rebuild_rating_stats(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS("Rating stats rebuilt"))
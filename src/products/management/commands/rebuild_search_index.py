@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+from products.models import ProductSearchDocument
+from products.search import rebuild_index
+
+
+class Command(BaseCommand):
+    help = "Rebuild the product search documents and full-text index from scratch"
+
+    def handle(self, *args, **options):
+        rebuild_index()
+        count = ProductSearchDocument.objects.count()
+        self.stdout.write(self.style.SUCCESS(f"Indexed {count} products"))
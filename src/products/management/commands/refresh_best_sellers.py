@@ -0,0 +1,23 @@
+import time
+from django.core.management.base import BaseCommand
+from products.bestsellers import rebuild_daily_sales, refresh_best_sellers
+
+
+class Command(BaseCommand):
+    help = "Recompute the best-seller rankings from the daily sales rollups. Run it periodically, or keep it running with --interval."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--interval', type=int, default=0, help="Seconds between refreshes, refresh once when 0")
+        parser.add_argument('--rebuild', action='store_true', help="Recompute the daily rollups from the sales first")
+
+    def handle(self, *args, **options):
+        if options['rebuild']:
+            rebuild_daily_sales(batch_size=options['batch_size'])
+            self.stdout.write(self.style.SUCCESS("Daily sales rebuilt"))
+        while True:
+            refresh_best_sellers(batch_size=options['batch_size'])
+            self.stdout.write(self.style.SUCCESS("Best sellers refreshed"))
+            if not options['interval']:
+                return
+            time.sleep(options['interval'])
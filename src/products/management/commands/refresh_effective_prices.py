@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from products.discounts import discount_index, refresh_effective_prices
+
+
+class Command(BaseCommand):
+    help = "Recompute the materialized effective price of every product. Run it periodically so discounts that start or end are reflected."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        discount_index.invalidate(broadcast=False)
+        updated = refresh_effective_prices(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Updated the effective price of {updated} products"))
@@ -0,0 +1,19 @@
+import time
+from django.core.management.base import BaseCommand
+from products.inventory import release_expired_reservations
+
+
+class Command(BaseCommand):
+    help = "Give back the stock of the expired checkout reservations. Run it periodically, or keep it running with --interval."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--interval', type=int, default=0, help="Seconds between sweeps, sweep once when 0")
+
+    def handle(self, *args, **options):
+        while True:
+            released = release_expired_reservations(batch_size=options['batch_size'])
+            self.stdout.write(self.style.SUCCESS(f"Released {released} expired reservations"))
+            if not options['interval']:
+                return
+            time.sleep(options['interval'])
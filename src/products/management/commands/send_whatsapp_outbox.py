@@ -0,0 +1,19 @@
+import time
+from django.core.management.base import BaseCommand
+from products.outbox import drain_outbox
+
+
+class Command(BaseCommand):
+    help = "Send the queued WhatsApp messages of the outbox. Run it periodically, or keep it running with --interval."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--interval', type=int, default=0, help="Seconds between drains, drain once when 0")
+
+    def handle(self, *args, **options):
+        while True:
+            sent = drain_outbox(batch_size=options['batch_size'])
+            self.stdout.write(self.style.SUCCESS(f"Sent {sent} WhatsApp messages"))
+            if not options['interval']:
+                return
+            time.sleep(options['interval'])
@@ -1,11 +1,17 @@
 import random
 import string
 from accounts.models import User
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.db.models import prefetch_related_objects
 from django.utils import timezone
 from django.core.exceptions import ValidationError
 from django.core.validators import MinValueValidator, MaxValueValidator
-from products.utils import send_whatsapp_message
+from products.outbox import queue_whatsapp_message
+from products.discounts import discount_index
+from products.numbering import pill_numbers
+from products.ratings import STATS_FIELDS as RATING_FIELDS
+from products.shipping import shipping_rates
+from products.inventory import release_reservations, return_pill_items, sell_pill_items
 from core import settings
 
 GOVERNMENT_CHOICES = [
@@ -48,6 +54,21 @@ PILL_STATUS_CHOICES = [
     ('c', 'Canceled'),
 ]
 
+# Pill statuses whose totals are frozen, see Pill.freeze_totals
+TOTALS_STATUSES = ('w', 'p', 'u', 'd')
+TOTALS_FIELDS = ['subtotal', 'shipping', 'total', 'totals_frozen_at']
+
+# Legal pill status changes, from each status to the ones it can move to
+PILL_TRANSITIONS = {
+    'i': {'w', 'p', 'u', 'd', 'r', 'c'},
+    'w': {'p', 'u', 'd', 'r', 'c'},
+    'p': {'u', 'd', 'r', 'c'},
+    'u': {'d', 'r', 'c'},
+    'd': {'r', 'c'},
+    'r': set(),
+    'c': set(),
+}
+
 SIZES_CHOICES = [
     ('s', 'S'),
     ('xs', 'XS'),
@@ -65,13 +86,12 @@ PAYMENT_CHOICES = [
     ('v', 'visa'),
 ]
 
+# Inserts tried with a new pill number when the previous one already exists
+PILL_NUMBER_RETRIES = 3
+
 def generate_pill_number():
-    """Generate a unique 20-digit pill number."""
-    while True:
-        # Generate a random 20-digit string
-        pill_number = ''.join(random.choices(string.digits, k=20))
-        if not Pill.objects.filter(pill_number=pill_number).exists():
-            return pill_number
+    """Generate a unique, time-ordered 20-digit pill number without a query."""
+    return pill_numbers()
 
 
 def create_random_coupon():
@@ -101,6 +121,9 @@ class Brand(models.Model):
     def __str__(self):
         return self.name
 
+# Product fields held in the recommendation arrays, see products.recommendations
+TAXONOMY_FIELDS = ['category_id', 'sub_category_id', 'brand_id']
+
 class Product(models.Model):
     name = models.CharField(max_length=100)
     category = models.ForeignKey(Category, on_delete=models.CASCADE, null=True, blank=True, related_name='products')
@@ -117,27 +140,72 @@ class Product(models.Model):
         help_text="Mark if this product is important/special"
     )
     date_added = models.DateTimeField(auto_now_add=True)
+    # Denormalized from the active discounts, kept fresh by the Discount
+    # signals and the refresh_effective_prices command
+    effective_price = models.FloatField(null=True, blank=True, editable=False, db_index=True)
+    active_discount_pct = models.FloatField(default=0.0, editable=False)
+    discount_ends_at = models.DateTimeField(null=True, blank=True, editable=False)
+    # Rating aggregates, kept up to date by the Rating signals and the
+    # rebuild_rating_stats command
+    rating_count = models.PositiveIntegerField(default=0, editable=False)
+    rating_sum = models.PositiveIntegerField(default=0, editable=False)
+    rating_average = models.FloatField(default=0.0, editable=False, db_index=True)
+    rating_count_1 = models.PositiveIntegerField(default=0, editable=False)
+    rating_count_2 = models.PositiveIntegerField(default=0, editable=False)
+    rating_count_3 = models.PositiveIntegerField(default=0, editable=False)
+    rating_count_4 = models.PositiveIntegerField(default=0, editable=False)
+    rating_count_5 = models.PositiveIntegerField(default=0, editable=False)
+
+    class Meta:
+        indexes = [
+            # Keyset pagination order
+            models.Index(fields=['-date_added', '-id'], name='product_date_added_id_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        self.update_effective_price()
+        if not self._state.adding and not args and kwargs.get('update_fields') is None and not kwargs.get('force_insert'):
+            # The rating aggregates are only written with F() updates (see
+            # products.ratings): an edit must not write back the values it
+            # loaded over the ratings added since
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in RATING_FIELDS
+            ]
+        super().save(*args, **kwargs)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember the stored taxonomy, so the recommendation arrays are only reloaded when it changes
+        loaded = dict(zip(field_names, values))
+        if all(field in loaded for field in TAXONOMY_FIELDS):
+            instance._loaded_taxonomy = tuple(loaded[field] for field in TAXONOMY_FIELDS)
+        # And the stored effective price, so the alerts are only checked when it drops
+        if 'effective_price' in loaded:
+            instance._loaded_effective_price = loaded['effective_price']
+        return instance
+
+    def taxonomy(self):
+        return tuple(getattr(self, field) for field in TAXONOMY_FIELDS)
+
+    def update_effective_price(self):
+        """Store the price after the best active discount so it can be filtered and sorted on"""
+        discount = self.get_current_discount()
+        self.active_discount_pct = discount.discount if discount else 0.0
+        self.discount_ends_at = discount.discount_end if discount else None
+        if self.price is None:
+            self.effective_price = None
+        else:
+            self.effective_price = self.price * (1 - self.active_discount_pct / 100)
 
     def get_current_discount(self):
         """Returns the best active discount (either product or category level)"""
-        now = timezone.now()
-        product_discount = self.discounts.filter(
-            is_active=True,
-            discount_start__lte=now,
-            discount_end__gte=now
-        ).order_by('-discount').first()
-
-        category_discount = None
-        if self.category:
-            category_discount = self.category.discounts.filter(
-                is_active=True,
-                discount_start__lte=now,
-                discount_end__gte=now
-            ).order_by('-discount').first()
-
-        if product_discount and category_discount:
-            return max(product_discount, category_discount, key=lambda d: d.discount)
-        return product_discount or category_discount
+        return discount_index.get_current_discount(self.id, self.category_id)
+
+    def get_discount_expiry(self):
+        """Returns the end date of the current discount"""
+        return discount_index.get_discount_expiry(self.id, self.category_id)
 
     def price_after_product_discount(self):
         last_product_discount = self.discounts.last()
@@ -172,15 +240,18 @@ class Product(models.Model):
         return self.images.all()
 
     def number_of_ratings(self):
-        return self.ratings.count()
+        return self.rating_count
 
     def average_rating(self):
-        ratings = self.ratings.all()
-        if ratings.exists():
-            return round(sum(rating.star_number for rating in ratings) / ratings.count(), 1)
-        return 0.0
+        return round(self.rating_average, 1)
+
+    def rating_histogram(self):
+        """Number of ratings per star number"""
+        return {stars: getattr(self, f'rating_count_{stars}') for stars in range(1, 6)}
 
     def total_quantity(self):
+        if hasattr(self, 'annotated_total_quantity'):
+            return self.annotated_total_quantity
         return sum(availability.quantity for availability in self.availabilities.all())
 
     def available_colors(self):
@@ -200,6 +271,22 @@ class Product(models.Model):
     def __str__(self):
         return self.name
 
+class ProductSearchDocument(models.Model):
+    """Normalized text of a product, kept in sync by products.search"""
+    product = models.OneToOneField(
+        Product,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='search_document'
+    )
+    name = models.TextField(blank=True, default='')
+    taxonomy = models.TextField(blank=True, default='', help_text="Category, sub category and brand names")
+    body = models.TextField(blank=True, default='', help_text="Product description and description sections")
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Search document for product {self.product_id}"
+
 class SpecialProduct(models.Model):
     product = models.ForeignKey(
         Product,
@@ -290,6 +377,13 @@ class ProductAvailability(models.Model):
     def __str__(self):
         return f"{self.product.name} - {self.size} - {self.color.name if self.color else 'No Color'}"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember the stored quantity, so manual edits are recorded in the stock ledger
+        instance._loaded_quantity = dict(zip(field_names, values)).get('quantity')
+        return instance
+
 class ProductSales(models.Model):
     product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='sales')
     quantity = models.PositiveIntegerField()
@@ -298,10 +392,191 @@ class ProductSales(models.Model):
     price_at_sale = models.FloatField()  
     date_sold = models.DateTimeField(auto_now_add=True)
     pill = models.ForeignKey('Pill', on_delete=models.CASCADE, related_name='product_sales')
+    unit_cost = models.FloatField(
+        null=True, blank=True,
+        help_text="Cost of goods of one unit, assigned from the stock ledger by analysis.cogs"
+    )
 
     def __str__(self):
         return f"{self.product.name} - {self.quantity} sold on {self.date_sold}"
 
+class ProductSalesDaily(models.Model):
+    """
+    Units, revenue and cost of goods sold per product and day, with the
+    category and brand of the product when it first sold that day. Kept up
+    to date by products.bestsellers, the cost by analysis.cogs.
+    """
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='daily_sales')
+    category = models.ForeignKey(Category, on_delete=models.SET_NULL, null=True, blank=True, related_name='daily_sales')
+    brand = models.ForeignKey(Brand, on_delete=models.SET_NULL, null=True, blank=True, related_name='daily_sales')
+    day = models.DateField()
+    quantity = models.IntegerField(default=0)
+    revenue = models.FloatField(default=0.0)
+    cost = models.FloatField(default=0.0)
+
+    class Meta:
+        unique_together = [['product', 'day']]
+        indexes = [
+            models.Index(fields=['day', 'product'], name='product_sales_daily_day_idx'),
+            models.Index(fields=['category', 'day'], name='product_sales_daily_cat_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.product_id} on {self.day}: {self.quantity}"
+
+class BestSeller(models.Model):
+    """
+    Ranking of the products sold over a window of days (0 for all time),
+    overall and within their category and brand, see products.bestsellers
+    """
+    window = models.PositiveSmallIntegerField()
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='best_seller_ranks')
+    category = models.ForeignKey(Category, on_delete=models.CASCADE, null=True, blank=True, related_name='+')
+    brand = models.ForeignKey(Brand, on_delete=models.CASCADE, null=True, blank=True, related_name='+')
+    quantity = models.IntegerField()
+    revenue = models.FloatField()
+    rank = models.PositiveIntegerField()
+    category_rank = models.PositiveIntegerField()
+    brand_rank = models.PositiveIntegerField()
+    refreshed_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        unique_together = [['window', 'product']]
+        indexes = [
+            models.Index(fields=['window', 'rank'], name='best_seller_rank_idx'),
+            models.Index(fields=['window', 'category', 'category_rank'], name='best_seller_category_idx'),
+            models.Index(fields=['window', 'brand', 'brand_rank'], name='best_seller_brand_idx'),
+        ]
+
+    def __str__(self):
+        return f"#{self.rank} {self.product_id} over {self.window or 'all'} days"
+
+class CoPurchaseCount(models.Model):
+    """
+    Number of delivered pills containing both products, stored in both
+    directions. The diagonal row (product == other) counts the pills
+    containing the product. Kept up to date by products.copurchase.
+    """
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='co_purchase_counts')
+    other = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='+')
+    pills = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = [['product', 'other']]
+        indexes = [
+            models.Index(fields=['product', '-pills', 'other'], name='co_purchase_count_top_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.product_id} & {self.other_id}: {self.pills} pills"
+
+class CoPurchaseTotal(models.Model):
+    """Number of delivered pills counted in the co-purchase counts, a single row kept by products.copurchase"""
+    pills = models.IntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.pills} delivered pills"
+
+class CoPurchaseNeighbor(models.Model):
+    """Top products bought together with a product, ranked by support, see products.copurchase"""
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='co_purchase_neighbors')
+    neighbor = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='co_purchased_with')
+    rank = models.PositiveSmallIntegerField()
+    support = models.PositiveIntegerField(help_text="Delivered pills containing both products")
+    lift = models.FloatField(help_text="How much more often the products are bought together than by chance")
+
+    class Meta:
+        unique_together = [['product', 'neighbor']]
+        indexes = [
+            models.Index(fields=['product', 'rank'], name='co_purchase_neighbor_rank_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.product_id} -> {self.neighbor_id} (#{self.rank})"
+
+class StockMovement(models.Model):
+    """Append-only ledger of every change to the stock of an availability batch"""
+    RECEIPT = 'receipt'
+    RESERVATION = 'reservation'
+    RELEASE = 'release'
+    SALE = 'sale'
+    RETURN = 'return'
+    ADJUSTMENT = 'adjustment'
+    KIND_CHOICES = [
+        (RECEIPT, 'Receipt'),
+        (RESERVATION, 'Reservation'),
+        (RELEASE, 'Release'),
+        (SALE, 'Sale'),
+        (RETURN, 'Return'),
+        (ADJUSTMENT, 'Adjustment'),
+    ]
+
+    availability = models.ForeignKey(
+        ProductAvailability, on_delete=models.SET_NULL, null=True, blank=True, related_name='movements'
+    )
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='stock_movements')
+    size = models.CharField(max_length=50, null=True, blank=True)
+    color = models.ForeignKey(Color, on_delete=models.SET_NULL, null=True, blank=True)
+    kind = models.CharField(choices=KIND_CHOICES, max_length=12)
+    quantity = models.IntegerField(help_text="Signed change of the stock, negative when stock leaves")
+    pill = models.ForeignKey('Pill', on_delete=models.SET_NULL, null=True, blank=True, related_name='stock_movements')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['product', 'size', 'color', '-created_at'], name='stock_movement_sku_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.get_kind_display()} {self.quantity:+d} of {self.product_id} ({self.size})"
+
+    def save(self, *args, **kwargs):
+        if self.pk:
+            raise ValidationError("Stock movements are append-only")
+        super().save(*args, **kwargs)
+
+class StockReservation(models.Model):
+    """Stock held for a pill from checkout until it is delivered, canceled or the reservation expires"""
+    pill = models.ForeignKey('Pill', on_delete=models.CASCADE, related_name='reservations')
+    availability = models.ForeignKey(ProductAvailability, on_delete=models.CASCADE, related_name='reservations')
+    quantity = models.PositiveIntegerField()
+    expires_at = models.DateTimeField(db_index=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.quantity} of {self.availability_id} for pill {self.pill_id} until {self.expires_at}"
+
+class WhatsAppMessage(models.Model):
+    """Transactional outbox of WhatsApp messages, sent by the send_whatsapp_outbox worker"""
+    PENDING = 'pending'
+    SENT = 'sent'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (SENT, 'Sent'),
+        (FAILED, 'Failed'),
+    ]
+
+    phone = models.CharField(max_length=20)
+    message = models.TextField()
+    idempotency_key = models.CharField(max_length=100, unique=True)
+    pill = models.ForeignKey('Pill', on_delete=models.SET_NULL, null=True, blank=True, related_name='whatsapp_messages')
+    status = models.CharField(choices=STATUS_CHOICES, max_length=10, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at'], name='whatsapp_outbox_due_idx'),
+            models.Index(fields=['phone', '-sent_at'], name='whatsapp_outbox_phone_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.get_status_display()} message to {self.phone} ({self.idempotency_key})"
+
 class Rating(models.Model):
     product = models.ForeignKey(
         Product,
@@ -319,6 +594,20 @@ class Rating(models.Model):
     def __str__(self):
         return f"{self.star_number} stars for {self.product.name} by {self.user.username}"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember the stored values, so the product rating aggregates can be adjusted on save
+        loaded = dict(zip(field_names, values))
+        instance._loaded_rating = (loaded.get('product_id'), loaded.get('star_number'))
+        return instance
+
+    def save(self, *args, **kwargs):
+        # Keep the row and the product rating aggregates in one transaction
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            self._loaded_rating = (self.product_id, self.star_number)
+
 
     def star_ranges(self):
         return range(int(self.star_number)), range(5 - int(self.star_number))
@@ -335,10 +624,18 @@ class PillItem(models.Model):
     quantity = models.PositiveIntegerField(default=1)
     size = models.CharField(max_length=10, choices=SIZES_CHOICES, null=True)
     color = models.ForeignKey(Color, on_delete=models.SET_NULL, null=True, blank=True)
+    unit_price = models.FloatField(
+        null=True, blank=True, editable=False,
+        help_text="Discounted price of one unit when the item was ordered"
+    )
 
     def __str__(self):
         return f"{self.product.name} - {self.quantity} - {self.size} - {self.color.name if self.color else 'No Color'}"
 
+    def line_total(self):
+        unit_price = self.unit_price if self.unit_price is not None else self.product.discounted_price()
+        return unit_price * self.quantity
+
 class Pill(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='pills')
     items = models.ManyToManyField(PillItem, related_name='pills')  # Updated to relate to PillItem
@@ -347,6 +644,11 @@ class Pill(models.Model):
     paid = models.BooleanField(default=False)
     coupon = models.ForeignKey('CouponDiscount', on_delete=models.SET_NULL, null=True, blank=True, related_name='pills')
     coupon_discount = models.FloatField(default=0.0)  # Store the coupon discount as a field
+    # Totals frozen once the pill leaves the initiated status, see freeze_totals
+    subtotal = models.FloatField(null=True, blank=True, editable=False)
+    shipping = models.FloatField(null=True, blank=True, editable=False)
+    total = models.FloatField(null=True, blank=True, editable=False)
+    totals_frozen_at = models.DateTimeField(null=True, blank=True, editable=False)
     pill_number = models.CharField(
         max_length=20, 
         editable=False,
@@ -354,84 +656,248 @@ class Pill(models.Model):
         default=generate_pill_number
     )
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Status and payment as stored, so a save knows the transition without reading the pill again
+        self._loaded_status = None
+        self._loaded_paid = False
+        self._expected_status = None
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        loaded = dict(zip(field_names, values))
+        instance._loaded_status = loaded.get('status')
+        instance._loaded_paid = loaded.get('paid', False)
+        return instance
+
+    @staticmethod
+    def can_transition(old_status, new_status):
+        return old_status is None or old_status == new_status or new_status in PILL_TRANSITIONS[old_status]
+
+    def check_transition(self, new_status):
+        if not self.can_transition(self._loaded_status, new_status):
+            raise ValidationError(
+                f"Cannot move pill {self.pill_number} from {self._loaded_status} to {new_status}"
+            )
+
+    def clean(self):
+        self.check_transition(self.status)
+
     def save(self, *args, **kwargs):
         # Generate pill number if not set
         if not self.pill_number:
             self.pill_number = generate_pill_number()
-        
+
         # Check if this is a new pill
-        is_new = not self.pk
-        
-        # First save to create the pill
-        super().save(*args, **kwargs)
-        
-        if is_new:
-            # Log the initial status
-            PillStatusLog.objects.create(pill=self, status=self.status)
-        else:
-            # Check if status changed
-            old_pill = Pill.objects.get(pk=self.pk)
-            if old_pill.status != self.status:
-                # Log the status change
-                status_log, created = PillStatusLog.objects.get_or_create(
-                    pill=self, 
-                    status=self.status
-                )
-                if not created:
-                    status_log.changed_at = timezone.now()
-                    status_log.save()
-            
-            # Handle delivered status
-            if old_pill.status != 'd' and self.status == 'd':
-                self.process_delivery()
-        
-        # Handle payment status
-        if self.paid and self.status != 'p':
+        is_new = self._state.adding
+        old_status = self._loaded_status
+
+        # Being paid moves an initiated or waiting pill to paid, in the same write
+        paid_now = self.paid and not self._loaded_paid
+        if paid_now and self.status in ('i', 'w'):
             self.status = 'p'
-            super().save(*args, **kwargs)
-            self.send_payment_notification()
+        changed = not is_new and old_status != self.status
+        if changed:
+            self.check_transition(self.status)
+
+        if not is_new and self.status in TOTALS_STATUSES and not self.totals_are_frozen():
+            self.freeze_totals()
+        elif self.totals_are_frozen():
+            # A coupon may have been applied since, the stored parts are kept
+            self.total = self.final_price()
+
+        # One transaction per pill: the status change and the stock it moves
+        # are applied together or not at all
+        with transaction.atomic():
+            if is_new:
+                self._insert(*args, **kwargs)
+                # Log the initial status
+                PillStatusLog.objects.create(pill=self, status=self.status)
+            else:
+                # The update only applies if the stored status is still the loaded one,
+                # so two concurrent transitions (e.g. deliveries) cannot both apply
+                self._expected_status = old_status if changed else None
+                try:
+                    super().save(*args, **kwargs)
+                finally:
+                    self._expected_status = None
+                if changed:
+                    PillStatusLog.objects.create(pill=self, status=self.status)
+                    self.apply_transition(old_status)
+            if paid_now:
+                # Queued with the payment, sent by the outbox worker once it commits
+                self.send_payment_notification()
+
+        self._loaded_status = self.status
+        self._loaded_paid = self.paid
+
+    def _do_update(self, base_qs, using, pk_val, values, update_fields, forced_update):
+        if self._expected_status is None:
+            return super()._do_update(base_qs, using, pk_val, values, update_fields, forced_update)
+        updated = super()._do_update(
+            base_qs.filter(status=self._expected_status), using, pk_val, values, update_fields, forced_update
+        )
+        if not updated:
+            raise ValidationError(f"Pill {self.pill_number} was changed meanwhile, reload it and try again")
+        return updated
+
+    def apply_transition(self, old_status):
+        """Stock side of a status change: sell on delivery, give back on refusal or cancellation"""
+        if self.status == 'd':
+            self.process_delivery()
+        elif self.status in ('r', 'c'):
+            if old_status == 'd':
+                # A delivered pill sent back returns its stock
+                self.process_return()
+            else:
+                self.release_reservations()
+
+    @classmethod
+    def transition_many(cls, pills, status):
+        """
+        Move many pills to `status` at once, e.g. `Pill.transition_many(pills, 'u')`:
+        one UPDATE per current status and all the status logs in one insert.
+        Raises ValidationError if one of the moves is not legal; pills changed
+        meanwhile by someone else are left alone. Returns the pills moved.
+        """
+        by_status = {}
+        for pill in pills:
+            current = pill._loaded_status or pill.status
+            if current != status:
+                by_status.setdefault(current, []).append(pill)
+
+        illegal = [
+            pill.pill_number
+            for current, group in by_status.items() if not cls.can_transition(current, status)
+            for pill in group
+        ]
+        if illegal:
+            raise ValidationError(f"Cannot move pills {', '.join(illegal)} to {status}")
+
+        moved = []
+        with transaction.atomic():
+            for old_status, group in by_status.items():
+                ids = list(
+                    cls.objects.select_for_update()
+                    .filter(pk__in=[pill.pk for pill in group], status=old_status)
+                    .values_list('pk', flat=True)
+                )
+                cls.objects.filter(pk__in=ids).update(status=status)
+                ids = set(ids)
+                for pill in group:
+                    if pill.pk in ids:
+                        pill.status = pill._loaded_status = status
+                        moved.append((pill, old_status))
+
+            PillStatusLog.objects.bulk_create([PillStatusLog(pill=pill, status=status) for pill, _ in moved])
+
+            to_freeze = [pill for pill, _ in moved if status in TOTALS_STATUSES and not pill.totals_are_frozen()]
+            if to_freeze:
+                prefetch_related_objects(to_freeze, 'items__product', 'pilladdress')
+                for pill in to_freeze:
+                    pill.freeze_totals()
+                cls.objects.bulk_update(to_freeze, TOTALS_FIELDS)
+            for pill, old_status in moved:
+                pill.apply_transition(old_status)
+        return [pill for pill, _ in moved]
+
+    def _insert(self, *args, **kwargs):
+        # Pill numbers are generated without a query, so on the rare clash
+        # with an existing number the unique constraint fails and a new one is drawn
+        for attempt in range(PILL_NUMBER_RETRIES):
+            try:
+                with transaction.atomic():
+                    return super().save(*args, **kwargs)
+            except IntegrityError:
+                if attempt == PILL_NUMBER_RETRIES - 1 or not Pill.objects.filter(pill_number=self.pill_number).exists():
+                    raise
+                self.pill_number = generate_pill_number()
 
     def process_delivery(self):
         """Process items when pill is marked as delivered"""
-        for item in self.items.all():
-            # Create sales record
-            ProductSales.objects.create(
-                product=item.product,
-                quantity=item.quantity,
-                size=item.size,
-                color=item.color,
-                price_at_sale=item.product.discounted_price(),
-                pill=self
-            )
-            
-            # Decrease product availability
-            try:
-                availability = ProductAvailability.objects.get(
-                    product=item.product,
-                    size=item.size,
-                    color=item.color
-                )
-                if availability.quantity < item.quantity:
-                    raise ValidationError(f"Not enough inventory for {item.product.name}")
-                availability.quantity -= item.quantity
-                availability.save()
-            except ProductAvailability.DoesNotExist:
-                raise ValidationError(f"No matching availability for {item.product.name}")
+        # Sales records and atomic stock decrements for every item, see products.inventory
+        sell_pill_items(self)
+
+    def process_return(self):
+        """Put back the stock of a delivered pill that was refused or canceled"""
+        return_pill_items(self)
+
+    def release_reservations(self):
+        """Give back the stock reserved for a pill that was refused or canceled"""
+        release_reservations(self.reservations.all())
 
     def send_payment_notification(self):
-        """Send payment confirmation if phone exists"""
+        """Queue the payment confirmation if phone exists"""
         if hasattr(self, 'pilladdress') and self.pilladdress.phone:
             prepare_whatsapp_message(self.pilladdress.phone, self)
 
     class Meta:
         verbose_name_plural = 'Bills'
+        indexes = [
+            # Keyset pagination order
+            models.Index(fields=['-date_added', '-id'], name='pill_date_added_id_idx'),
+        ]
 
     def __str__(self):
         return f"Pill ID: {self.id} - Status: {self.get_status_display()} - Date: {self.date_added}"
 
-    # 1. Price without coupons (sum of product.discounted_price() * quantity)
+    @classmethod
+    def backfill_subtotals(cls, using='default', batch_size=500):
+        """
+        Store the subtotal of the delivered pills from before totals were,
+        and the unit price of their items, from the prices their sales
+        recorded (ProductSales.price_at_sale). A pill with an item its sales
+        do not price is left alone rather than priced at today's prices, and
+        the shipping and total, which nothing recorded, are not frozen.
+        Returns how many pills were filled.
+        """
+        filled = 0
+        last_id = 0
+        while True:
+            pills = list(
+                cls.objects.using(using).filter(status='d', subtotal__isnull=True, id__gt=last_id).order_by('id')[:batch_size]
+            )
+            if not pills:
+                return filled
+            last_id = pills[-1].id
+            prefetch_related_objects(pills, 'items', 'product_sales')
+            priced_pills, priced_items = [], []
+            for pill in pills:
+                prices = {(sale.product_id, sale.size, sale.color_id): sale.price_at_sale for sale in pill.product_sales.all()}
+                items = list(pill.items.all())
+                if not items or any(
+                    item.unit_price is None and (item.product_id, item.size, item.color_id) not in prices for item in items
+                ):
+                    continue
+                for item in items:
+                    if item.unit_price is None:
+                        item.unit_price = prices[(item.product_id, item.size, item.color_id)]
+                        priced_items.append(item)
+                pill.subtotal = sum(item.unit_price * item.quantity for item in items)
+                priced_pills.append(pill)
+            PillItem.objects.using(using).bulk_update(priced_items, ['unit_price'])
+            cls.objects.using(using).bulk_update(priced_pills, ['subtotal'])
+            filled += len(priced_pills)
+
+    def freeze_totals(self):
+        """
+        Snapshot the subtotal and shipping of the pill (the caller saves it),
+        so reads stop recomputing them and later price changes leave the order alone.
+        """
+        # Recompute from the items and the address, not from a previous snapshot
+        self.subtotal = None
+        self.shipping = None
+        self.subtotal = self.price_without_coupons()
+        self.shipping = self.shipping_price()
+        self.totals_frozen_at = timezone.now()
+        self.total = self.final_price()
+
+    # 1. Price without coupons (sum of unit price * quantity)
     def price_without_coupons(self):
-        return sum(item.product.discounted_price() * item.quantity for item in self.items.all())
+        if self.subtotal is not None:
+            return self.subtotal
+        return sum(item.line_total() for item in self.items.all())
 
     # 2. Calculate coupon discount (dynamically calculate based on the coupon)
     def calculate_coupon_discount(self):
@@ -448,18 +914,20 @@ class Pill(models.Model):
 
     # 4. Shipping price (based on PillAddress.government)
     def shipping_price(self):
+        if self.shipping is not None:
+            return self.shipping
         if hasattr(self, 'pilladdress'):
-            try:
-                shipping = Shipping.objects.filter(government=self.pilladdress.government).first()
-                return shipping.shipping_price
-            except Shipping.DoesNotExist:
-                return 0.0
+            # In-memory rates, 0 for a government without one
+            return shipping_rates.get_rate(self.pilladdress.government)
         return 0.0  # Default shipping price if PillAddress is not set
 
     # 5. Final price (price_after_coupon_discount + shipping_price)
     def final_price(self):
         return self.price_after_coupon_discount() + self.shipping_price()
 
+    def totals_are_frozen(self):
+        return self.totals_frozen_at is not None
+
 class Discount(models.Model):
     product = models.ForeignKey(Product, on_delete=models.CASCADE, null=True, blank=True, related_name='discounts')
     category = models.ForeignKey(Category, on_delete=models.CASCADE, null=True, blank=True, related_name='discounts')
@@ -482,6 +950,14 @@ class Discount(models.Model):
         self.full_clean()
         super().save(*args, **kwargs)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember the stored target, so the prices it applied to are refreshed when it moves
+        loaded = dict(zip(field_names, values))
+        instance._loaded_target = (loaded.get('product_id'), loaded.get('category_id'))
+        return instance
+
     @property
     def is_currently_active(self):
         now = timezone.now()
@@ -625,10 +1101,12 @@ class SpinWheelResult(models.Model):
 
     class Meta:
         unique_together = [['user', 'spin_wheel', 'spin_date']]
+        indexes = [
+            models.Index(fields=['user', '-spin_date', '-id'], name='spin_result_user_date_idx'),
+        ]
 
     
 def prepare_whatsapp_message(phone_number, pill):
-    print(f"Preparing WhatsApp message for phone number: {phone_number}")
     # Prepare the WhatsApp message
     message = (
         f"مرحباً {pill.user.username}،\n\n"
@@ -636,8 +1114,10 @@ def prepare_whatsapp_message(phone_number, pill):
         f"رقم الطلب: {pill.pill_number}\n"
     )
 
-    # Send WhatsApp message
-    send_whatsapp_message(
+    # Queue the WhatsApp message, once per pill however often the payment is saved
+    queue_whatsapp_message(
         phone_number=phone_number,
-        message=message
+        message=message,
+        idempotency_key=f"pill-paid:{pill.pk}",
+        pill=pill
     )
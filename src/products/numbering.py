@@ -0,0 +1,85 @@
+import os
+import random
+import socket
+import threading
+import time
+import zlib
+from django.conf import settings
+
+# Pill numbers count milliseconds from 2024-01-01 UTC
+EPOCH_MS = 1704067200000
+TIME_DIGITS = 13
+NODE_DIGITS = 2
+SEQUENCE_DIGITS = 4
+MAX_SEQUENCE = 10 ** SEQUENCE_DIGITS
+
+
+def luhn_digit(digits):
+    """Luhn check digit of a string of digits"""
+    total = 0
+    for position, digit in enumerate(reversed(digits)):
+        value = int(digit)
+        if position % 2 == 0:
+            value *= 2
+            if value > 9:
+                value -= 9
+        total += value
+    return str((10 - total % 10) % 10)
+
+
+def is_valid_pill_number(number):
+    """Whether a string is a well-formed pill number (right length, matching check digit)"""
+    length = TIME_DIGITS + NODE_DIGITS + SEQUENCE_DIGITS + 1
+    return len(number) == length and number.isdigit() and luhn_digit(number[:-1]) == number[-1]
+
+
+class PillNumberGenerator:
+    """
+    20-digit pill numbers generated without touching the database:
+    13 digits of milliseconds, 2 digits of node, 4 digits of sequence and a
+    Luhn check digit. Numbers sort by creation time; the unique constraint
+    on Pill.pill_number catches the rare clash between nodes.
+    """
+
+    def __init__(self, node=None):
+        self._lock = threading.Lock()
+        self._node = node
+        self._pid = None
+        self._node_value = None
+        self._last_ms = 0
+        self._sequence = 0
+
+    def _node_id(self):
+        node = self._node if self._node is not None else getattr(settings, 'PILL_NUMBER_NODE', None)
+        if node is None:
+            # One id per host and process, recomputed after a fork
+            node = zlib.crc32(f"{socket.gethostname()}:{os.getpid()}".encode())
+        return int(node) % 10 ** NODE_DIGITS
+
+    def __call__(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._node_value = self._node_id()
+
+            now_ms = max(int(time.time() * 1000) - EPOCH_MS, self._last_ms)
+            if now_ms == self._last_ms:
+                self._sequence += 1
+                if self._sequence >= MAX_SEQUENCE:
+                    # Sequence exhausted, borrow the next millisecond
+                    now_ms += 1
+                    self._sequence = random.randrange(MAX_SEQUENCE // 2)
+            else:
+                # Start every millisecond at a random point, so numbers are not trivially guessable
+                self._sequence = random.randrange(MAX_SEQUENCE // 2)
+            self._last_ms = now_ms
+
+            payload = (
+                f"{now_ms:0{TIME_DIGITS}d}"
+                f"{self._node_value:0{NODE_DIGITS}d}"
+                f"{self._sequence:0{SEQUENCE_DIGITS}d}"
+            )
+        return payload + luhn_digit(payload)
+
+
+pill_numbers = PillNumberGenerator()
@@ -0,0 +1,103 @@
+import time
+from datetime import timedelta
+from django.conf import settings
+from django.db.models import Max
+from django.utils import timezone
+from accounts.delivery import DeliveryQueue
+from .whatsapp import GatewayError, get_gateway
+
+# Shortest time (seconds) a worker owns the messages it claimed before another
+# may retry them, longer for batches that may take longer to send (see claim_lease)
+CLAIM_LEASE = 60
+# Backoff (seconds) of the first retry, doubled on each further attempt up to MAX_BACKOFF
+BASE_BACKOFF = 30
+MAX_BACKOFF = 60 * 60
+
+outbox = DeliveryQueue('products.WhatsAppMessage', CLAIM_LEASE, BASE_BACKOFF, MAX_BACKOFF)
+
+
+def queue_whatsapp_message(phone_number, message, idempotency_key, pill=None):
+    """
+    Write a WhatsApp message to the outbox, in the caller's transaction. A
+    message whose idempotency key is already queued is not queued again.
+    """
+    from .models import WhatsAppMessage
+
+    WhatsAppMessage.objects.bulk_create([
+        WhatsAppMessage(phone=phone_number, message=message, idempotency_key=idempotency_key, pill=pill)
+    ], ignore_conflicts=True)
+
+
+def claim_lease(batch_size):
+    """
+    Seconds to lease a batch for (CLAIM_LEASE at least): enough to send all
+    of it at WHATSAPP_RATE_PER_SECOND with every call running into
+    WHATSAPP_TIMEOUT, so no other worker claims and sends the messages
+    again meanwhile
+    """
+    timeout = settings.WHATSAPP_TIMEOUT
+    per_message = sum(timeout) if isinstance(timeout, (tuple, list)) else timeout
+    if settings.WHATSAPP_RATE_PER_SECOND:
+        per_message += 1 / settings.WHATSAPP_RATE_PER_SECOND
+    return batch_size * per_message
+
+
+def claim_due_messages(batch_size):
+    """Lease the due pending messages to this worker, skipping the ones other workers hold"""
+    return outbox.claim(batch_size, claim_lease(batch_size))
+
+
+def last_sent_per_phone(phones, since):
+    from .models import WhatsAppMessage
+
+    return dict(
+        WhatsAppMessage.objects.filter(phone__in=phones, status=WhatsAppMessage.SENT, sent_at__gte=since)
+        .values('phone').annotate(last=Max('sent_at')).values_list('phone', 'last')
+    )
+
+
+def drain_outbox(gateway=None, batch_size=100):
+    """
+    Send the due messages of the outbox. Each destination gets at most one
+    message per WHATSAPP_PER_PHONE_INTERVAL seconds and the worker sends at
+    most WHATSAPP_RATE_PER_SECOND messages a second. Failed sends are retried
+    with exponential backoff, up to WHATSAPP_MAX_ATTEMPTS. Returns the number sent.
+    """
+    from .models import WhatsAppMessage
+
+    gateway = gateway or get_gateway()
+    messages = claim_due_messages(batch_size)
+    if not messages:
+        return 0
+
+    interval = timedelta(seconds=settings.WHATSAPP_PER_PHONE_INTERVAL)
+    last_sent = last_sent_per_phone({message.phone for message in messages}, timezone.now() - interval)
+    spacing = 1 / settings.WHATSAPP_RATE_PER_SECOND if settings.WHATSAPP_RATE_PER_SECOND else 0
+    sent = 0
+    next_send = time.monotonic()
+
+    for message in messages:
+        now = timezone.now()
+        last = last_sent.get(message.phone)
+        if last and now - last < interval:
+            # Too soon for this destination, try again once its interval has passed
+            WhatsAppMessage.objects.filter(id=message.id).update(next_attempt_at=last + interval)
+            continue
+
+        wait = next_send - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        next_send = time.monotonic() + spacing
+
+        try:
+            gateway.send(message.phone, message.message, idempotency_key=message.idempotency_key)
+        except GatewayError as error:
+            give_up = not error.retryable or message.attempts + 1 >= settings.WHATSAPP_MAX_ATTEMPTS
+            outbox.record_failure(message, str(error), give_up)
+            continue
+
+        sent_at = timezone.now()
+        outbox.record_sent([message.id], sent_at)
+        last_sent[message.phone] = sent_at
+        sent += 1
+    return sent
@@ -0,0 +1,81 @@
+import threading
+import time
+from django.core.cache import cache
+from django.db import transaction
+
+# How often (seconds) a worker checks the shared generation counters
+GENERATION_CHECK_INTERVAL = 1
+
+
+class ProcessCache:
+    """
+    Base of the process-wide, in-memory copies of a table (the discount
+    index, the shipping rates, the recommendation arrays). A copy is rebuilt
+    on the next lookup once:
+    - it was invalidated in this process,
+    - the generation counter stored in the cache under `generation_key`
+      moved, which another worker does when it invalidates its own copy,
+    - it is older than `max_age` seconds, whatever the counter says.
+
+    The counter only reaches the other workers through a cache they share
+    (Redis, see CACHES in the settings). With the default per-process
+    LocMemCache, the other workers only see a change once their copy gets
+    older than `max_age`.
+
+    Subclasses set `generation_key` and `max_age` and implement `load()`,
+    which swaps in the new copy.
+    """
+    generation_key = None
+    max_age = 60
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._valid = False
+        self._loaded_at = None
+        self._generation = None
+        self._generation_checked_at = None
+
+    def load(self):
+        raise NotImplementedError
+
+    def expired(self):
+        """Whether the copy went out of date on its own, checked on every lookup"""
+        return False
+
+    def invalidate(self, broadcast=True):
+        """Drop the copy so the next lookup reloads it, in every worker when broadcast"""
+        with self._lock:
+            self._valid = False
+        if broadcast:
+            try:
+                cache.incr(self.generation_key)
+            except ValueError:
+                cache.set(self.generation_key, 1, None)
+
+    def invalidate_on_commit(self):
+        """
+        Invalidate once the current transaction commits, so no worker reloads
+        the rows being replaced and keeps them.
+        """
+        transaction.on_commit(self.invalidate)
+
+    def _is_stale(self, now):
+        if not self._valid or now - self._loaded_at >= self.max_age or self.expired():
+            return True
+        if self._generation_checked_at is None or now - self._generation_checked_at >= GENERATION_CHECK_INTERVAL:
+            self._generation_checked_at = now
+            return cache.get(self.generation_key) != self._generation
+        return False
+
+    def ensure_fresh(self):
+        now = time.monotonic()
+        if self._is_stale(now):
+            with self._lock:
+                if self._is_stale(now):
+                    # Read before loading, so a change made during the load triggers another one,
+                    # and available to load() to tag the copy
+                    self._generation = cache.get(self.generation_key)
+                    self.load()
+                    self._generation_checked_at = now
+                    self._loaded_at = now
+                    self._valid = True
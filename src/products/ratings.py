@@ -0,0 +1,55 @@
+from django.db import transaction
+from django.db.models import Case, Count, F, FloatField, Q, Sum, Value, When
+from django.db.models.functions import Cast
+
+STARS = range(1, 6)
+STATS_FIELDS = ['rating_count', 'rating_sum', 'rating_average'] + [f'rating_count_{stars}' for stars in STARS]
+
+
+def adjust_rating_stats(product_id, star_number, sign):
+    """Add (sign=1) or remove (sign=-1) one rating from the stored aggregates of a product"""
+    from .models import Product
+
+    star_number = int(star_number)
+    updates = {
+        'rating_count': F('rating_count') + sign,
+        'rating_sum': F('rating_sum') + sign * star_number,
+        # Column references read the values from before the update
+        'rating_average': Case(
+            When(rating_count__lt=1 - sign, then=Value(0.0)),
+            default=Cast(F('rating_sum') + sign * star_number, FloatField()) / (F('rating_count') + sign),
+            output_field=FloatField()
+        ),
+    }
+    if star_number in STARS:
+        histogram_field = f'rating_count_{star_number}'
+        updates[histogram_field] = F(histogram_field) + sign
+    Product.objects.filter(id=product_id).update(**updates)
+
+
+def rebuild_rating_stats(batch_size=1000):
+    """Recompute the rating aggregates of every product from the Rating table"""
+    from .models import Product, Rating
+
+    aggregates = Rating.objects.order_by().values('product').annotate(
+        count=Count('id'),
+        total=Sum('star_number'),
+        **{f'count_{stars}': Count('id', filter=Q(star_number=stars)) for stars in STARS}
+    )
+    with transaction.atomic():
+        Product.objects.update(**{field: 0 for field in STATS_FIELDS})
+        products = []
+        for row in aggregates.iterator(chunk_size=batch_size):
+            product = Product(
+                id=row['product'],
+                rating_count=row['count'],
+                rating_sum=row['total'],
+                rating_average=row['total'] / row['count'],
+                **{f'rating_count_{stars}': row[f'count_{stars}'] for stars in STARS}
+            )
+            products.append(product)
+            if len(products) >= batch_size:
+                Product.objects.bulk_update(products, STATS_FIELDS)
+                products = []
+        if products:
+            Product.objects.bulk_update(products, STATS_FIELDS)
@@ -0,0 +1,177 @@
+import time
+import numpy as np
+from django.core.cache import cache
+from django.db.models import Sum
+from .process_cache import ProcessCache
+
+# Age (seconds) after which the arrays are reloaded anyway, to pick up new sales
+MAX_AGE = 60 * 10
+USER_VERSION_KEY = 'products:recommendations:user:{}'
+RESULT_KEY = 'products:recommendations:{}:{}:{}:{}'
+RESULT_TIMEOUT = 60 * 15
+TOP_K = 12
+
+# How much each signal weighs in the score of a candidate
+WEIGHTS = {
+    'category': 1.0,
+    'sub_category': 1.5,
+    'brand': 1.0,
+    'co_purchase': 3.0,
+    'popularity': 0.5,
+}
+# How much each seed weighs in the user's profile
+CURRENT_PRODUCT_WEIGHT = 3.0
+LOVED_WEIGHT = 2.0
+PURCHASED_WEIGHT = 1.0
+
+
+def encode(values):
+    """Dense codes (0..n-1) of the values, None coded as n, and n"""
+    codes = {}
+    encoded = np.fromiter(
+        (codes.setdefault(value, len(codes)) if value is not None else -1 for value in values),
+        dtype=np.int32, count=len(values)
+    )
+    encoded[encoded < 0] = len(codes)
+    return encoded, len(codes)
+
+
+class CatalogArrays(ProcessCache):
+    """
+    Process-wide compact arrays of the catalog (product ids, category,
+    sub-category and brand codes, popularity), loaded with two queries and
+    reloaded when products are added, removed or moved to another category,
+    sub-category or brand, or when the arrays get old (see ProcessCache).
+    """
+    generation_key = 'products:recommendations:generation'
+    max_age = MAX_AGE
+
+    def __init__(self):
+        super().__init__()
+        self._current = None
+
+    def load(self):
+        from .models import BestSeller, Product, ProductSalesDaily
+
+        rows = list(Product.objects.order_by('id').values_list('id', 'category_id', 'sub_category_id', 'brand_id'))
+        ids = np.array([row[0] for row in rows], dtype=np.int64)
+        features = {}
+        for position, name in enumerate(['category', 'sub_category', 'brand'], start=1):
+            features[name] = encode([row[position] for row in rows])
+
+        # Units sold of all time, from the best-seller ranking (see products.bestsellers)
+        # or the daily rollups when it was not computed yet
+        sold = dict(BestSeller.objects.filter(window=0).values_list('product', 'quantity'))
+        if not sold:
+            sold = dict(ProductSalesDaily.objects.order_by().values('product').annotate(total=Sum('quantity')).values_list('product', 'total'))
+        popularity = np.log1p(np.array([sold.get(product_id, 0) for product_id in ids.tolist()], dtype=np.float32))
+        if popularity.size and popularity.max() > 0:
+            popularity /= popularity.max()
+
+        self._current = {
+            'ids': ids,
+            'rows': {product_id: row for row, product_id in enumerate(ids.tolist())},
+            'features': features,
+            'popularity': popularity,
+            'version': self._generation,
+        }
+
+    def get(self):
+        self.ensure_fresh()
+        return self._current
+
+
+catalog_arrays = CatalogArrays()
+
+
+def score_products(arrays, seeds, neighbors):
+    """
+    Score every product of the catalog for a profile.
+
+    `seeds` maps product ids to their weight in the profile, `neighbors`
+    are (seed id, neighbour id, support) co-purchase rows of the seeds.
+    """
+    rows = arrays['rows']
+    scores = WEIGHTS['popularity'] * arrays['popularity']
+
+    seed_rows = np.array([rows[product_id] for product_id in seeds if product_id in rows], dtype=np.int64)
+    seed_weights = np.array([weight for product_id, weight in seeds.items() if product_id in rows], dtype=np.float32)
+    if seed_rows.size:
+        total = seed_weights.sum()
+        for name, (codes, size) in arrays['features'].items():
+            # Share of the profile in each value, the same as a dot product of one-hot vectors
+            profile = np.bincount(codes[seed_rows], weights=seed_weights, minlength=size + 1) / total
+            profile[size] = 0
+            scores = scores + WEIGHTS[name] * profile[codes]
+
+    if neighbors:
+        co_purchase = np.zeros(len(arrays['ids']), dtype=np.float32)
+        targets = [(rows[neighbor_id], seeds[seed_id] * support) for seed_id, neighbor_id, support in neighbors if neighbor_id in rows]
+        if targets:
+            np.add.at(co_purchase, [row for row, value in targets], [value for row, value in targets])
+            co_purchase /= co_purchase.max()
+            scores = scores + WEIGHTS['co_purchase'] * co_purchase
+    return scores
+
+
+def top_k(ids, scores, k, exclude=()):
+    """The k best scored ids, best first, ties broken by id"""
+    scores = scores.astype(np.float64, copy=True)
+    for row in exclude:
+        scores[row] = -np.inf
+    k = min(k, int(np.isfinite(scores).sum()))
+    if k <= 0:
+        return []
+    best = np.argpartition(-scores, k - 1)[:k]
+    order = np.lexsort((ids[best], -scores[best]))
+    return ids[best[order]].tolist()
+
+
+def user_version(user_id):
+    key = USER_VERSION_KEY.format(user_id)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, time.time_ns(), None)
+        version = cache.get(key)
+    return version
+
+
+def invalidate_user_recommendations(user_id):
+    """Expire the cached recommendations of a user"""
+    if user_id is None:
+        return
+    try:
+        cache.incr(USER_VERSION_KEY.format(user_id))
+    except ValueError:
+        cache.set(USER_VERSION_KEY.format(user_id), time.time_ns(), None)
+
+
+def recommend_products(user, product_id=None, k=TOP_K):
+    """
+    Ids of the k products to recommend to a user, optionally viewing a
+    product, cached per user until they love or buy something.
+    """
+    from .models import CoPurchaseNeighbor, LovedProduct, ProductSales
+
+    arrays = catalog_arrays.get()
+    key = RESULT_KEY.format(user.id, product_id, user_version(user.id), arrays['version'])
+    cached = cache.get(key)
+    if cached is not None:
+        return cached
+
+    seeds = {}
+    for purchased_id in ProductSales.objects.filter(pill__user=user).values_list('product_id', flat=True).distinct():
+        seeds[purchased_id] = PURCHASED_WEIGHT
+    for loved_id in LovedProduct.objects.filter(user=user).values_list('product_id', flat=True):
+        seeds[loved_id] = seeds.get(loved_id, 0) + LOVED_WEIGHT
+    if product_id is not None:
+        seeds[product_id] = seeds.get(product_id, 0) + CURRENT_PRODUCT_WEIGHT
+
+    neighbors = list(
+        CoPurchaseNeighbor.objects.filter(product_id__in=seeds).values_list('product_id', 'neighbor_id', 'support')
+    ) if seeds else []
+    scores = score_products(arrays, seeds, neighbors)
+    exclude = [arrays['rows'][product_id]] if product_id in arrays['rows'] else []
+    result = top_k(arrays['ids'], scores, k, exclude)
+    cache.set(key, result, RESULT_TIMEOUT)
+    return result
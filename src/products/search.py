@@ -0,0 +1,255 @@
+import re
+import unicodedata
+from django.db import DatabaseError, connection, connections
+
+# Maximum number of ranked product ids a search returns
+MAX_RESULTS = 500
+# Maximum number of terms taken from a search query
+MAX_TERMS = 10
+# Products (re)indexed per batch
+BATCH_SIZE = 500
+
+# Arabic diacritics (tashkeel), Quranic marks and tatweel
+ARABIC_MARKS = re.compile('[\u0610-\u061a\u064b-\u065f\u0670\u06d6-\u06ed\u0640]')
+ARABIC_LETTERS = str.maketrans({
+    'أ': 'ا', 'إ': 'ا', 'آ': 'ا', 'ٱ': 'ا',
+    'ى': 'ي', 'ئ': 'ي', 'ؤ': 'و', 'ة': 'ه',
+    **{chr(0x0660 + digit): str(digit) for digit in range(10)},
+    **{chr(0x06F0 + digit): str(digit) for digit in range(10)},
+})
+NON_WORD = re.compile(r'[\W_]+')
+
+
+def normalize(text):
+    """
+    Lowercase the text, drop punctuation, Arabic diacritics and tatweel, unify
+    the Arabic letter variants and digits, and strip the definite article.
+    """
+    if not text:
+        return ''
+    text = unicodedata.normalize('NFKC', text)
+    text = ARABIC_MARKS.sub('', text).translate(ARABIC_LETTERS).lower()
+    words = []
+    for word in NON_WORD.sub(' ', text).split():
+        if word.startswith('ال') and len(word) > 3:
+            word = word[2:]
+        words.append(word)
+    return ' '.join(words)
+
+
+def build_document(product):
+    """Build the (unsaved) search document of a product"""
+    from .models import ProductSearchDocument
+
+    taxonomy = [product.category, product.sub_category, product.brand]
+    body = [product.description or '']
+    for description in product.descriptions.all():
+        body.extend([description.title, description.description])
+    return ProductSearchDocument(
+        product_id=product.id,
+        name=normalize(product.name),
+        taxonomy=normalize(' '.join(item.name for item in taxonomy if item)),
+        body=normalize(' '.join(body)),
+    )
+
+
+class DocumentSearchBackend:
+    """Fallback backend, matching every term against the search documents"""
+
+    def create_schema(self, cursor):
+        pass
+
+    def is_ready(self, cursor):
+        return True
+
+    def index(self, documents):
+        pass
+
+    def remove(self, product_ids):
+        pass
+
+    def rebuild(self):
+        pass
+
+    def search(self, terms, limit):
+        from django.db.models import Q
+        from .models import ProductSearchDocument
+
+        documents = ProductSearchDocument.objects.all()
+        for term in terms:
+            documents = documents.filter(Q(name__contains=term) | Q(taxonomy__contains=term) | Q(body__contains=term))
+        return list(documents.values_list('product_id', flat=True)[:limit])
+
+
+class SQLiteSearchBackend(DocumentSearchBackend):
+    """FTS5 table mirroring the search documents, ranked with bm25"""
+    table = 'products_search_fts'
+    weights = '10.0, 4.0, 1.0'
+
+    def create_schema(self, cursor):
+        cursor.execute(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {self.table} "
+            "USING fts5(name, taxonomy, body, tokenize='unicode61 remove_diacritics 2')"
+        )
+
+    def is_ready(self, cursor):
+        return self.table in cursor.db.introspection.table_names(cursor)
+
+    def index(self, documents):
+        with connection.cursor() as cursor:
+            cursor.executemany(f"DELETE FROM {self.table} WHERE rowid = %s", [(d.product_id,) for d in documents])
+            cursor.executemany(
+                f"INSERT INTO {self.table} (rowid, name, taxonomy, body) VALUES (%s, %s, %s, %s)",
+                [(d.product_id, d.name, d.taxonomy, d.body) for d in documents]
+            )
+
+    def remove(self, product_ids):
+        with connection.cursor() as cursor:
+            cursor.executemany(f"DELETE FROM {self.table} WHERE rowid = %s", [(pk,) for pk in product_ids])
+
+    def rebuild(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f"DROP TABLE IF EXISTS {self.table}")
+            self.create_schema(cursor)
+
+    def search(self, terms, limit):
+        # Every term must match, as a prefix of a word
+        match = ' '.join(f'"{term}"*' for term in terms)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT rowid FROM {self.table} WHERE {self.table} MATCH %s "
+                f"ORDER BY bm25({self.table}, {self.weights}) LIMIT %s",
+                [match, limit]
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+
+class PostgresSearchBackend(DocumentSearchBackend):
+    """Weighted tsvector over the search documents, backed by a GIN expression index"""
+    vector = (
+        "setweight(to_tsvector('simple', name), 'A') || "
+        "setweight(to_tsvector('simple', taxonomy), 'B') || "
+        "setweight(to_tsvector('simple', body), 'C')"
+    )
+    index_name = 'products_search_document_gin'
+
+    def create_schema(self, cursor):
+        from .models import ProductSearchDocument
+
+        # Outside a transaction (migrate, rebuild_search_index), so writes go on while it builds
+        cursor.execute(
+            f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {self.index_name} "
+            f"ON {ProductSearchDocument._meta.db_table} USING gin (({self.vector}))"
+        )
+
+    def is_ready(self, cursor):
+        cursor.execute("SELECT 1 FROM pg_indexes WHERE indexname = %s", [self.index_name])
+        return cursor.fetchone() is not None
+
+    def search(self, terms, limit):
+        from .models import ProductSearchDocument
+
+        query = ' & '.join(f'{term}:*' for term in terms)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT product_id FROM {ProductSearchDocument._meta.db_table} "
+                f"WHERE {self.vector} @@ to_tsquery('simple', %s) "
+                f"ORDER BY ts_rank({self.vector}, to_tsquery('simple', %s)) DESC LIMIT %s",
+                [query, query, limit]
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+
+BACKENDS = {
+    'sqlite': SQLiteSearchBackend,
+    'postgresql': PostgresSearchBackend,
+}
+_backends = {}
+
+
+def create_search_schema(sender=None, using='default', **kwargs):
+    """
+    Create the full-text table or index of the database, when it supports
+    one. Run after `migrate` (connected in apps.py) and by
+    rebuild_search_index, never while serving requests.
+    """
+    from .models import ProductSearchDocument
+
+    connection = connections[using]
+    backend = BACKENDS.get(connection.vendor, DocumentSearchBackend)()
+    with connection.cursor() as cursor:
+        if ProductSearchDocument._meta.db_table not in connection.introspection.table_names(cursor):
+            return
+        try:
+            backend.create_schema(cursor)
+        except DatabaseError:
+            # SQLite compiled without FTS5, searches use the documents
+            pass
+    _backends.pop(connection.vendor, None)
+
+
+def get_backend():
+    """
+    Pick the search backend matching the default database, or the document
+    backend while its full-text schema is missing (see create_search_schema)
+    """
+    vendor = connection.vendor
+    if vendor not in _backends:
+        backend = BACKENDS.get(vendor, DocumentSearchBackend)()
+        with connection.cursor() as cursor:
+            if not backend.is_ready(cursor):
+                backend = DocumentSearchBackend()
+        _backends[vendor] = backend
+    return _backends[vendor]
+
+
+def index_products(product_ids):
+    """(Re)build the search documents of the given products"""
+    from .models import Product, ProductSearchDocument
+
+    product_ids = list(product_ids)
+    backend = get_backend()
+    for start in range(0, len(product_ids), BATCH_SIZE):
+        batch = product_ids[start:start + BATCH_SIZE]
+        products = Product.objects.filter(id__in=batch).select_related(
+            'category', 'sub_category', 'brand'
+        ).prefetch_related('descriptions')
+        documents = [build_document(product) for product in products]
+        ProductSearchDocument.objects.bulk_create(
+            documents,
+            update_conflicts=True,
+            unique_fields=['product'],
+            update_fields=['name', 'taxonomy', 'body', 'updated_at'],
+        )
+        backend.index(documents)
+
+        # Products deleted in the meantime
+        missing = set(batch) - {document.product_id for document in documents}
+        if missing:
+            remove_products(missing)
+
+
+def remove_products(product_ids):
+    from .models import ProductSearchDocument
+
+    product_ids = list(product_ids)
+    ProductSearchDocument.objects.filter(product_id__in=product_ids).delete()
+    get_backend().remove(product_ids)
+
+
+def rebuild_index():
+    """Rebuild the search documents and index of every product"""
+    from .models import Product, ProductSearchDocument
+
+    create_search_schema()
+    get_backend().rebuild()
+    ProductSearchDocument.objects.all().delete()
+    index_products(Product.objects.values_list('id', flat=True).iterator())
+
+
+def search_product_ids(query, limit=MAX_RESULTS):
+    """Return the ids of the products matching the query, best match first"""
+    terms = normalize(query).split()[:MAX_TERMS]
+    if not terms:
+        return []
+    return get_backend().search(terms, limit)
@@ -1,9 +1,14 @@
 from rest_framework import serializers
 from collections import defaultdict
 from urllib.parse import urljoin
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db import transaction
+from django.db.models import IntegerField, OuterRef, Prefetch, Subquery, Sum
+from django.db.models.functions import Coalesce
 from django.utils import timezone
 from accounts.models import User
-from .models import Category, CouponDiscount, Discount, LovedProduct, PayRequest, PillAddress, PillItem, PillStatusLog, PriceDropAlert, ProductDescription, Shipping, SpecialProduct, SpinWheelDiscount, SpinWheelResult, StockAlert, SubCategory, Brand, Product, ProductImage, ProductAvailability, Rating, Color,Pill
+from .inventory import reserve_pill_items
+from .models import PILL_STATUS_CHOICES, Category, CouponDiscount, Discount, LovedProduct, PayRequest, PillAddress, PillItem, PillStatusLog, PriceDropAlert, ProductDescription, Shipping, SpecialProduct, SpinWheelDiscount, SpinWheelResult, StockAlert, SubCategory, Brand, Product, ProductImage, ProductAvailability, Rating, Color,Pill
 
 
 
@@ -133,6 +138,7 @@ class ProductSerializer(serializers.ModelSerializer):
     main_image = serializers.SerializerMethodField()
     number_of_ratings = serializers.SerializerMethodField()
     average_rating = serializers.SerializerMethodField()
+    rating_histogram = serializers.SerializerMethodField()
     total_quantity = serializers.SerializerMethodField()
     available_colors = serializers.SerializerMethodField()
     available_sizes = serializers.SerializerMethodField()
@@ -150,9 +156,9 @@ class ProductSerializer(serializers.ModelSerializer):
     brand_name = serializers.SerializerMethodField()
 
     # Writable fields
-    category = serializers.PrimaryKeyRelatedField(queryset=Category.objects.all(), required=False)
-    sub_category = serializers.PrimaryKeyRelatedField(queryset=SubCategory.objects.all(), required=False)
-    brand = serializers.PrimaryKeyRelatedField(queryset=Brand.objects.all(), required=False)
+    category = serializers.PrimaryKeyRelatedField(queryset=Category.objects.all(), required=False, write_only=True)
+    sub_category = serializers.PrimaryKeyRelatedField(queryset=SubCategory.objects.all(), required=False, write_only=True)
+    brand = serializers.PrimaryKeyRelatedField(queryset=Brand.objects.all(), required=False, write_only=True)
 
     class Meta:
         model = Product
@@ -160,25 +166,45 @@ class ProductSerializer(serializers.ModelSerializer):
 
             'id', 'name', 'category_id', 'category_name', 'sub_category_id', 'sub_category_name',
             'brand_id', 'brand_name', 'price', 'description', 'date_added', 'discounted_price',
-            'has_discount','current_discount', 'discount_expiry', 'main_image', 'images', 'number_of_ratings', 'average_rating',
-            'total_quantity', 'available_colors', 'available_sizes', 'availabilities','descriptions','threshold', 'is_low_stock','is_important'
-
+            'has_discount','current_discount', 'discount_expiry', 'main_image', 'images', 'number_of_ratings', 'average_rating', 'rating_histogram',
+            'total_quantity', 'available_colors', 'available_sizes', 'availabilities','descriptions','threshold', 'is_low_stock','is_important',
+            'category', 'sub_category', 'brand'
         ]
 
+    @staticmethod
+    def setup_eager_loading(queryset):
+        """
+        Prefetch and annotate everything this serializer reads, so a page of
+        products costs a fixed number of queries whatever its size.
+        """
+        availabilities = ProductAvailability.objects.filter(product=OuterRef('pk')).order_by().values('product')
+        return queryset.select_related(
+            'category', 'sub_category', 'brand'
+        ).prefetch_related(
+            'images',
+            'descriptions',
+            Prefetch('availabilities', queryset=ProductAvailability.objects.select_related('color')),
+        ).annotate(
+            annotated_total_quantity=Coalesce(
+                Subquery(availabilities.annotate(total=Sum('quantity')).values('total')), 0,
+                output_field=IntegerField()
+            ),
+        )
+
     def get_category_id(self, obj):
-        return obj.category.id if obj.category else None
+        return obj.category_id
 
     def get_category_name(self, obj):
         return obj.category.name if obj.category else None
 
     def get_sub_category_id(self, obj):
-        return obj.sub_category.id if obj.sub_category else None
+        return obj.sub_category_id
 
     def get_sub_category_name(self, obj):
         return obj.sub_category.name if obj.sub_category else None
 
     def get_brand_id(self, obj):
-        return obj.brand.id if obj.brand else None
+        return obj.brand_id
 
     def get_brand_name(self, obj):
         return obj.brand.name if obj.brand else None
@@ -204,46 +230,12 @@ class ProductSerializer(serializers.ModelSerializer):
 
     def get_current_discount(self, obj):
         # Get the best active discount (product or category)
-        now = timezone.now()
-        product_discount = obj.discounts.filter(
-            is_active=True,
-            discount_start__lte=now,
-            discount_end__gte=now
-        ).order_by('-discount').first()
-
-        category_discount = None
-        if obj.category:
-            category_discount = obj.category.discounts.filter(
-                is_active=True,
-                discount_start__lte=now,
-                discount_end__gte=now
-            ).order_by('-discount').first()
-
-        if product_discount and category_discount:
-            return max(product_discount.discount, category_discount.discount)
-        elif product_discount:
-            return product_discount.discount
-        elif category_discount:
-            return category_discount.discount
-        return None
+        discount = obj.get_current_discount()
+        return discount.discount if discount else None
 
     def get_discount_expiry(self, obj):
         # Get the expiry date of the current discount
-        now = timezone.now()
-        discount = obj.discounts.filter(
-            is_active=True,
-            discount_start__lte=now,
-            discount_end__gte=now
-        ).order_by('-discount_end').first()
-
-        if not discount and obj.category:
-            discount = obj.category.discounts.filter(
-                is_active=True,
-                discount_start__lte=now,
-                discount_end__gte=now
-            ).order_by('-discount_end').first()
-
-        return discount.discount_end if discount else None
+        return obj.get_discount_expiry()
     
     def get_has_discount(self, obj):
         return obj.has_discount()
@@ -264,6 +256,9 @@ class ProductSerializer(serializers.ModelSerializer):
     def get_average_rating(self, obj):
         return obj.average_rating()
 
+    def get_rating_histogram(self, obj):
+        return obj.rating_histogram()
+
     def get_total_quantity(self, obj):
         return obj.total_quantity()
 
@@ -358,7 +353,7 @@ class PillItemSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = PillItem
-        fields = ['id', 'product', 'quantity', 'size', 'color']
+        fields = ['id', 'product', 'quantity', 'size', 'color', 'unit_price']
 
 class PillItemCreateSerializer(serializers.ModelSerializer):
     class Meta:
@@ -382,6 +377,7 @@ class PillCreateSerializer(serializers.ModelSerializer):
     def get_user_username(self, obj):
         return obj.user.username
 
+    @transaction.atomic
     def create(self, validated_data):
         items_data = validated_data.pop('items')
         pill = Pill.objects.create(**validated_data)
@@ -392,14 +388,25 @@ class PillCreateSerializer(serializers.ModelSerializer):
                 product=item['product'],
                 quantity=item['quantity'],
                 size=item.get('size'),
-                color=item.get('color')
+                color=item.get('color'),
+                unit_price=item['product'].discounted_price()
             ) for item in items_data
         ]
         created_items = PillItem.objects.bulk_create(pill_items)
         pill.items.set(created_items)
+
+        # Hold the stock until the pill is delivered, canceled or the reservation expires
+        try:
+            reserve_pill_items(pill, created_items)
+        except DjangoValidationError as error:
+            raise serializers.ValidationError({'items': error.messages})
         
         return pill
 
+class PillBulkStatusSerializer(serializers.Serializer):
+    pills = serializers.PrimaryKeyRelatedField(queryset=Pill.objects.all(), many=True, allow_empty=False)
+    status = serializers.ChoiceField(choices=PILL_STATUS_CHOICES)
+
 class PillStatusLogSerializer(serializers.ModelSerializer):
     status_display = serializers.SerializerMethodField()
 
@@ -451,9 +458,54 @@ class PillDetailSerializer(serializers.ModelSerializer):
 
     def get_status_display(self, obj):
         return obj.get_status_display()
+
+    def validate_status(self, value):
+        if self.instance is not None and not Pill.can_transition(self.instance.status, value):
+            raise serializers.ValidationError(
+                f"Cannot move from {self.instance.get_status_display()} to {dict(PILL_STATUS_CHOICES)[value]}."
+            )
+        return value
     
     def get_final_price(self, obj):
-        return obj.price_after_coupon_discount() + obj.shipping_price()
+        return obj.final_price()
+
+class PillItemProductSerializer(serializers.ModelSerializer):
+    """Slim product of an order line, the full ProductSerializer costs several queries per product"""
+    main_image = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Product
+        fields = ['id', 'name', 'price', 'main_image']
+
+    def get_main_image(self, obj):
+        main_image = obj.main_image()
+        if main_image:
+            request = self.context.get('request')
+            if request:
+                return request.build_absolute_uri(main_image.image.url)
+            else:
+                return main_image.image.url
+        return None
+
+class PillListItemSerializer(serializers.ModelSerializer):
+    product = PillItemProductSerializer(read_only=True)
+    color = ColorSerializer(read_only=True)
+
+    class Meta:
+        model = PillItem
+        fields = ['id', 'product', 'quantity', 'size', 'color', 'unit_price']
+
+class PillListSerializer(PillDetailSerializer):
+    """PillDetailSerializer for order lists, with slim line items and a fixed number of queries"""
+    items = PillListItemSerializer(many=True, read_only=True)
+
+    @staticmethod
+    def setup_eager_loading(queryset):
+        return queryset.select_related('user', 'coupon', 'pilladdress').prefetch_related(
+            Prefetch('items', PillItem.objects.select_related('product', 'color').prefetch_related('product__images')),
+            'status_logs',
+            'pay_requests',
+        )
 
 class DiscountSerializer(serializers.ModelSerializer):
     product_name = serializers.SerializerMethodField()
@@ -0,0 +1,45 @@
+import hashlib
+from .process_cache import ProcessCache
+
+
+class ShippingRates(ProcessCache):
+    """
+    Process-wide government -> shipping price map, loaded with a single
+    query and reloaded when a Shipping row is saved or deleted (see
+    ProcessCache).
+    """
+    generation_key = 'products:shipping-rates:generation'
+    max_age = 300
+
+    def __init__(self):
+        super().__init__()
+        # (version, rates), swapped in one assignment so readers never mix two loads
+        self._current = (None, {})
+
+    def load(self):
+        from .models import Shipping
+
+        rates = {}
+        # The first row of a government wins, as with .first()
+        for government, price in Shipping.objects.order_by('id').values_list('government', 'shipping_price'):
+            rates.setdefault(government, price)
+        self._current = (hashlib.sha1(repr(sorted(rates.items())).encode()).hexdigest()[:12], rates)
+
+    def get_rate(self, government):
+        """Shipping price of a government, 0 when it has none"""
+        self.ensure_fresh()
+        return self._current[1].get(government, 0.0)
+
+    def snapshot(self):
+        """The version tag and a copy of the rates, read together"""
+        self.ensure_fresh()
+        version, rates = self._current
+        return version, dict(rates)
+
+    def version(self):
+        """Tag changing whenever a rate does, for clients caching the rates"""
+        self.ensure_fresh()
+        return self._current[0]
+
+
+shipping_rates = ShippingRates()
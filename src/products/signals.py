@@ -0,0 +1,175 @@
+from django.db import connections, transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from .alerts import schedule_alert_check
+from .cache import invalidate_tags_on_commit
+from .discounts import discount_index, refresh_effective_prices
+from .models import (
+    Brand, Category, Color, Discount, LovedProduct, Product, ProductAvailability, ProductDescription, ProductImage,
+    Pill, Rating, Shipping, SpecialProduct, StockMovement, SubCategory
+)
+from .ratings import adjust_rating_stats
+from .recommendations import catalog_arrays, invalidate_user_recommendations
+from .search import index_products, remove_products
+from .shipping import shipping_rates
+
+
+@receiver([post_save, post_delete], sender=Discount)
+def discount_changed(sender, instance, **kwargs):
+    discount_index.invalidate_on_commit()
+
+    # Refresh the materialized prices of the products the discount applies to,
+    # and applied to before it moved, once the index sees the change
+    targets = {(instance.product_id, instance.category_id), getattr(instance, '_loaded_target', (None, None))}
+    instance._loaded_target = (instance.product_id, instance.category_id)
+    for product_id, category_id in targets:
+        if product_id:
+            products = Product.objects.filter(id=product_id)
+        elif category_id:
+            products = Product.objects.filter(category_id=category_id)
+        else:
+            continue
+        transaction.on_commit(lambda products=products: refresh_effective_prices(products))
+
+
+def backfill_effective_prices(sender, using='default', **kwargs):
+    """
+    After `migrate`, materialize the effective price of the products stored
+    before it existed (NULL while they have a price). Connected in apps.py.
+    """
+    if Product._meta.db_table not in connections[using].introspection.table_names():
+        return
+    refresh_effective_prices(Product.objects.using(using).filter(effective_price__isnull=True, price__isnull=False))
+
+
+def backfill_pill_subtotals(sender, using='default', **kwargs):
+    """
+    After `migrate`, store the subtotal of the delivered pills from before
+    totals were, priced by their sales, so the amount spent by each user
+    includes them. Connected in apps.py.
+    """
+    if Pill._meta.db_table not in connections[using].introspection.table_names():
+        return
+    Pill.backfill_subtotals(using=using)
+
+
+@receiver([post_save, post_delete], sender=Shipping)
+def shipping_changed(sender, instance, **kwargs):
+    shipping_rates.invalidate_on_commit()
+
+
+@receiver(post_save, sender=Rating)
+def rating_saved(sender, instance, created, **kwargs):
+    old_product_id, old_star_number = getattr(instance, '_loaded_rating', (None, None))
+    if not created:
+        if (old_product_id, old_star_number) == (instance.product_id, instance.star_number):
+            return
+        if old_product_id is not None:
+            adjust_rating_stats(old_product_id, old_star_number, -1)
+    adjust_rating_stats(instance.product_id, instance.star_number, 1)
+
+@receiver(post_delete, sender=Rating)
+def rating_deleted(sender, instance, **kwargs):
+    product_id, star_number = getattr(instance, '_loaded_rating', (instance.product_id, instance.star_number))
+    adjust_rating_stats(product_id, star_number, -1)
+
+
+#* Stock ledger, for batches created or edited by hand (admin, API)
+
+@receiver(post_save, sender=ProductAvailability)
+def record_stock_change(sender, instance, created, **kwargs):
+    loaded_quantity = 0 if created else getattr(instance, '_loaded_quantity', instance.quantity)
+    change = instance.quantity - loaded_quantity
+    instance._loaded_quantity = instance.quantity
+    if change:
+        StockMovement.objects.create(
+            availability=instance,
+            product_id=instance.product_id,
+            size=instance.size,
+            color_id=instance.color_id,
+            kind=StockMovement.RECEIPT if created else StockMovement.ADJUSTMENT,
+            quantity=change,
+        )
+    if change > 0:
+        schedule_alert_check([instance.product_id])
+
+
+#* Stock and price-drop alerts, see products.alerts
+
+@receiver(post_save, sender=Product)
+def check_product_alerts(sender, instance, created, **kwargs):
+    # Stock changes are checked by the availability signals, a product edit only matters
+    # to the price-drop alerts when it lowers the effective price
+    price = instance.effective_price
+    loaded = getattr(instance, '_loaded_effective_price', None)
+    if not created and price is not None and (loaded is None or price < loaded):
+        schedule_alert_check([instance.id])
+    instance._loaded_effective_price = price
+
+
+#* Recommendations, see products.recommendations
+
+@receiver(post_save, sender=Product)
+def reload_catalog_arrays(sender, instance, created, **kwargs):
+    # Only the taxonomy of the products is in the arrays, price or stock edits leave them be
+    taxonomy = instance.taxonomy()
+    if created or getattr(instance, '_loaded_taxonomy', None) != taxonomy:
+        catalog_arrays.invalidate_on_commit()
+    instance._loaded_taxonomy = taxonomy
+
+@receiver(post_delete, sender=Product)
+def drop_from_catalog_arrays(sender, instance, **kwargs):
+    catalog_arrays.invalidate_on_commit()
+
+@receiver([post_save, post_delete], sender=LovedProduct)
+def loved_product_changed(sender, instance, **kwargs):
+    transaction.on_commit(lambda: invalidate_user_recommendations(instance.user_id))
+
+
+#* Search index, updated once the transaction commits so cascades are settled
+
+@receiver(post_save, sender=Product)
+def index_saved_product(sender, instance, **kwargs):
+    transaction.on_commit(lambda: index_products([instance.id]))
+
+@receiver(post_delete, sender=Product)
+def unindex_deleted_product(sender, instance, **kwargs):
+    transaction.on_commit(lambda: remove_products([instance.id]))
+
+@receiver([post_save, post_delete], sender=ProductDescription)
+def index_described_product(sender, instance, **kwargs):
+    transaction.on_commit(lambda: index_products([instance.product_id]))
+
+@receiver(post_save, sender=Category)
+@receiver(post_save, sender=SubCategory)
+@receiver(post_save, sender=Brand)
+def index_renamed_taxonomy(sender, instance, created, **kwargs):
+    if created:
+        return
+    lookup = {Category: 'category', SubCategory: 'sub_category', Brand: 'brand'}[sender]
+    product_ids = list(Product.objects.filter(**{lookup: instance}).values_list('id', flat=True))
+    transaction.on_commit(lambda: index_products(product_ids))
+
+
+#* Response cache tags, see products.cache
+
+CACHE_TAGS = {
+    Product: ['product'],
+    ProductImage: ['product'],
+    ProductAvailability: ['product'],
+    ProductDescription: ['product'],
+    Rating: ['product'],
+    Discount: ['product'],
+    Category: ['category', 'product'],
+    SubCategory: ['category', 'product'],
+    Brand: ['brand', 'product'],
+    Color: ['color', 'product'],
+    SpecialProduct: ['special'],
+}
+
+def invalidate_cached_responses(sender, instance, **kwargs):
+    invalidate_tags_on_commit(*CACHE_TAGS[sender])
+
+for model in CACHE_TAGS:
+    post_save.connect(invalidate_cached_responses, sender=model, dispatch_uid=f'cache-{model.__name__}-save')
+    post_delete.connect(invalidate_cached_responses, sender=model, dispatch_uid=f'cache-{model.__name__}-delete')
@@ -1,3 +1,1360 @@
-from django.test import TestCase
+import csv
+import io
+import json
+import threading
+import zipfile
+from unittest import SkipTest
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import connection, transaction
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db.models import Sum
+from datetime import timedelta
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APIClient
+from accounts.models import QueuedEmail, User
+from accounts.serializers import UserProfileSerializer
+from .alerts import dispatch_alerts
+from .bestsellers import rebuild_daily_sales, refresh_best_sellers
+from .copurchase import delivered_pill_count, rebuild_co_purchases, record_co_purchases
+from .discounts import discount_index
+from .imports import import_catalog, read_rows
+from .recommendations import catalog_arrays, recommend_products
+from .search import SQLiteSearchBackend, get_backend, index_products, normalize, search_product_ids
+from .inventory import release_expired_reservations, reserve_pill_items, take_stock
+from .numbering import PillNumberGenerator, is_valid_pill_number
+from .outbox import claim_due_messages, drain_outbox, queue_whatsapp_message
+from .shipping import shipping_rates
+from .signals import backfill_effective_prices, backfill_pill_subtotals
+from .whatsapp import FakeWhatsAppGateway
+from .models import (
+    BestSeller, Brand, Category, Color, CoPurchaseCount, CoPurchaseNeighbor, CoPurchaseTotal, Discount, LovedProduct, PayRequest, Pill, PillAddress, PillItem, PillStatusLog, PriceDropAlert, Product,
+    Rating,
+    ProductAvailability, ProductDescription, ProductImage, ProductSales, ProductSalesDaily, Shipping, StockAlert, StockMovement, StockReservation,
+    WhatsAppMessage
+)
 
-# Create your tests here.
+
+def create_product(name='Product', price=100):
+    category, _ = Category.objects.get_or_create(name='Category')
+    return Product.objects.create(name=name, category=category, price=price)
+
+
+def create_pill(user, items):
+    pill = Pill.objects.create(user=user)
+    pill.items.set([PillItem.objects.create(**item) for item in items])
+    return pill
+
+
+class PillNumberTests(TestCase):
+    def test_numbers_are_unique_ordered_and_checked(self):
+        generate = PillNumberGenerator(node=7)
+        numbers = [generate() for _ in range(20000)]
+
+        self.assertEqual(len(set(numbers)), len(numbers))
+        self.assertEqual(numbers, sorted(numbers))
+        self.assertTrue(all(is_valid_pill_number(number) for number in numbers))
+        self.assertFalse(is_valid_pill_number(numbers[0][:-1] + str((int(numbers[0][-1]) + 1) % 10)))
+
+    def test_creating_a_pill_does_not_look_up_the_number(self):
+        user = User.objects.create_user(username='buyer', password='password')
+        with CaptureQueriesContext(connection) as queries:
+            Pill.objects.create(user=user)
+        self.assertFalse([query for query in queries if query['sql'].startswith('SELECT') and 'products_pill' in query['sql']])
+
+    def test_clashing_number_is_replaced(self):
+        user = User.objects.create_user(username='buyer', password='password')
+        existing = Pill.objects.create(user=user)
+
+        pill = Pill.objects.create(user=user, pill_number=existing.pill_number)
+        self.assertNotEqual(pill.pill_number, existing.pill_number)
+        self.assertTrue(is_valid_pill_number(pill.pill_number))
+
+
+class PillStatusTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='buyer', password='password')
+
+    def test_status_change_is_one_write(self):
+        pill = Pill.objects.create(user=self.user)
+        pill.status = 'w'
+        pill.save()
+        pill = Pill.objects.get(pk=pill.pk)
+
+        pill.status = 'u'
+        with CaptureQueriesContext(connection) as queries:
+            pill.save()
+
+        statements = [query['sql'].split()[0] for query in queries if 'SAVEPOINT' not in query['sql']]
+        self.assertEqual(statements, ['UPDATE', 'INSERT'])
+        self.assertEqual(list(pill.status_logs.values_list('status', flat=True)), ['i', 'w', 'u'])
+
+    def test_payment_moves_to_paid(self):
+        pill = Pill.objects.create(user=self.user)
+        pill.paid = True
+        pill.save()
+
+        self.assertEqual(Pill.objects.get(pk=pill.pk).status, 'p')
+        # Paid pills can still move on
+        pill.status = 'u'
+        pill.save()
+        self.assertEqual(Pill.objects.get(pk=pill.pk).status, 'u')
+
+    def test_illegal_transition_is_refused(self):
+        pill = Pill.objects.create(user=self.user, status='c')
+        pill.status = 'd'
+        with self.assertRaises(ValidationError):
+            pill.save()
+
+    def test_stale_transition_is_refused(self):
+        pill = Pill.objects.create(user=self.user)
+        stale = Pill.objects.get(pk=pill.pk)
+        pill.status = 'c'
+        pill.save()
+
+        stale.status = 'u'
+        with self.assertRaises(ValidationError):
+            stale.save()
+        self.assertEqual(Pill.objects.get(pk=pill.pk).status, 'c')
+
+    def test_transition_many(self):
+        pills = [Pill.objects.create(user=self.user, status=status) for status in 'iiwwpc']
+
+        with CaptureQueriesContext(connection) as queries:
+            moved = Pill.transition_many(Pill.objects.filter(status__in='iwp'), 'u')
+
+        self.assertEqual(len(moved), 5)
+        # A lock and an update per starting status, one insert for the logs and,
+        # whatever the number of pills, the reads and the update freezing the totals
+        self.assertLessEqual(len([query for query in queries if 'SAVEPOINT' not in query['sql']]), 12)
+        self.assertEqual(Pill.objects.filter(status='u').count(), 5)
+        self.assertEqual(PillStatusLog.objects.filter(status='u').count(), 5)
+        with self.assertRaises(ValidationError):
+            Pill.transition_many([pills[-1]], 'u')
+
+
+class PillTotalsTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='buyer', password='password')
+        self.product = create_product(price=100)
+        ProductAvailability.objects.create(product=self.product, size='m', quantity=10)
+        with self.captureOnCommitCallbacks(execute=True):
+            Shipping.objects.create(government='1', shipping_price=30)
+        self.client = APIClient(HTTP_HOST='localhost')
+        self.client.force_authenticate(self.user)
+
+    def checkout(self):
+        response = self.client.post(reverse('pill-create'), {
+            'items': [{'product': self.product.id, 'quantity': 2, 'size': 'm'}]
+        }, format='json')
+        pill = Pill.objects.get(id=response.data['id'])
+        self.client.post(reverse('pill-create-address', args=[pill.id]), {'government': '1', 'phone': ''}, format='json')
+        return Pill.objects.get(id=pill.id)
+
+    def test_totals_are_frozen_when_waiting(self):
+        pill = self.checkout()
+
+        self.assertEqual(pill.status, 'w')
+        self.assertEqual((pill.subtotal, pill.shipping, pill.total), (200, 30, 230))
+        self.assertEqual(pill.items.get().unit_price, 100)
+
+        # Later price changes do not touch the order
+        self.product.price = 500
+        self.product.save()
+        Shipping.objects.update(shipping_price=50)
+        pill = Pill.objects.get(id=pill.id)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(pill.final_price(), 230)
+        self.assertEqual(len(queries), 0)
+
+    def test_coupon_updates_the_stored_total(self):
+        pill = self.checkout()
+        pill.coupon_discount = 20
+        pill.save()
+
+        self.assertEqual(Pill.objects.get(id=pill.id).total, 210)
+
+    def test_backfill_prices_older_delivered_pills_from_their_sales(self):
+        pill = self.checkout()
+        pill.status = 'd'
+        pill.save()
+        unsold = self.checkout()
+        # Pills stored before totals were, then repriced
+        Pill.objects.filter(id=pill.id).update(subtotal=None, shipping=None, total=None, totals_frozen_at=None)
+        Pill.objects.filter(id=unsold.id).update(status='d', subtotal=None, shipping=None, total=None, totals_frozen_at=None)
+        PillItem.objects.update(unit_price=None)
+        Product.objects.filter(id=self.product.id).update(price=500, effective_price=500)
+
+        backfill_pill_subtotals(sender=None)
+
+        pill = Pill.objects.get(id=pill.id)
+        self.assertEqual((pill.subtotal, pill.items.get().unit_price), (200, 100))
+        # Nothing recorded the shipping of the time
+        self.assertEqual((pill.shipping, pill.total, pill.totals_frozen_at), (None, None, None))
+        # Without sales to price it from, the pill is left alone
+        self.assertIsNone(Pill.objects.get(id=unsold.id).subtotal)
+        self.assertEqual(UserProfileSerializer(self.user).data['total_spent'], 200)
+
+
+class ShippingRatesTests(TestCase):
+    def setUp(self):
+        self.client = APIClient(HTTP_HOST='localhost')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.shipping = Shipping.objects.create(government='1', shipping_price=30)
+
+    def tearDown(self):
+        # The rates are rolled back without signals, the other tests must not see them
+        shipping_rates.invalidate()
+
+    def test_rates_and_etag(self):
+        response = self.client.get(reverse('shipping-rates'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['rates'], {'1': 30})
+        etag = response['ETag']
+        self.assertEqual(etag, f'"{response.data["version"]}"')
+
+        response = self.client.get(reverse('shipping-rates'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+    def test_edits_change_the_etag_on_commit(self):
+        etag = self.client.get(reverse('shipping-rates'))['ETag']
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.shipping.shipping_price = 45
+            self.shipping.save()
+            # Not yet committed, the rates served do not change
+            self.assertEqual(self.client.get(reverse('shipping-rates'), HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        for callback in callbacks:
+            callback()
+
+        response = self.client.get(reverse('shipping-rates'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['rates'], {'1': 45})
+        self.assertNotEqual(response['ETag'], etag)
+
+
+class SearchTests(TestCase):
+    def test_normalize_folds_arabic(self):
+        self.assertEqual(normalize('الْعَرَبِيَّة'), 'عربيه')
+        self.assertEqual(normalize('أحمد إبراهيم آمنة'), 'احمد ابراهيم امنه')
+        self.assertEqual(normalize('مـــحـمد مستشفى'), 'محمد مستشفي')
+        self.assertEqual(normalize('مقاس ٤٢ و۳'), 'مقاس 42 و3')
+        self.assertEqual(normalize('Red T-Shirt, (XL)!'), 'red t shirt xl')
+        self.assertEqual(normalize(''), '')
+
+    def test_results_are_ranked_by_field(self):
+        # The full-text table is created by migrate, not while searching
+        self.assertIsInstance(get_backend(), SQLiteSearchBackend)
+        in_body = create_product(name='Trousers')
+        Product.objects.filter(id=in_body.id).update(description='Goes with any shirt')
+        in_taxonomy = Product.objects.create(name='Blue', category=Category.objects.create(name='Shirts'), price=10)
+        in_name = create_product(name='Cotton shirt')
+        create_product(name='Socks')
+        arabic = create_product(name='الْقَمِيص الأبيض')
+        index_products([in_body.id, in_taxonomy.id, in_name.id, arabic.id])
+
+        self.assertEqual(search_product_ids('shirt'), [in_name.id, in_taxonomy.id, in_body.id])
+        self.assertEqual(search_product_ids('قميص ابيض'), [arabic.id])
+
+        response = APIClient(HTTP_HOST='localhost').get(reverse('product-list'), {'search': 'SHIRT'})
+        self.assertEqual([product['id'] for product in response.data['results']], [in_name.id, in_taxonomy.id, in_body.id])
+
+
+class ProductPaginationTests(TestCase):
+    def setUp(self):
+        self.client = APIClient(HTTP_HOST='localhost')
+        self.products = [create_product(name=f'Product {number}', price=number) for number in range(5)]
+
+    def test_cursor_walks_every_product(self):
+        ids = []
+        response = self.client.get(reverse('product-list'), {'pagination': 'cursor', 'per_page': 2})
+        while True:
+            self.assertEqual(response.status_code, 200)
+            ids += [product['id'] for product in response.data['results']]
+            if not response.data['next']:
+                break
+            response = self.client.get(response.data['next'])
+        self.assertEqual(ids, [product.id for product in reversed(self.products)])
+
+    def test_cursor_rejects_another_order(self):
+        for params in [{'ordering': 'price'}, {'search': 'product'}]:
+            response = self.client.get(reverse('product-list'), {'pagination': 'cursor', **params})
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(list(response.data), list(params))
+
+        response = self.client.get(reverse('product-list'), {'page': 1, 'ordering': 'price', 'limit': 5})
+        self.assertEqual([product['id'] for product in response.data['results']], [product.id for product in self.products])
+
+
+class CachedResponseTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient(HTTP_HOST='localhost')
+        Brand.objects.create(name='First')
+
+    def get(self, **headers):
+        return self.client.get(reverse('brand-list'), **headers)
+
+    def test_if_none_match_lists(self):
+        etag = self.get()['ETag']
+        for header in [etag, f'"other", {etag}', f'W/{etag}', '*']:
+            self.assertEqual(self.get(HTTP_IF_NONE_MATCH=header).status_code, 304, header)
+        for header in ['"other"', etag.strip('"'), f'"x{etag.strip(chr(34))}"']:
+            self.assertEqual(self.get(HTTP_IF_NONE_MATCH=header).status_code, 200, header)
+
+    def test_invalidated_on_commit(self):
+        etag = self.get()['ETag']
+        with self.captureOnCommitCallbacks() as callbacks:
+            Brand.objects.create(name='Second')
+            # Not yet committed, nothing is cached from the uncommitted rows
+            self.assertEqual(self.get(HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        for callback in callbacks:
+            callback()
+
+        response = self.get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([brand['name'] for brand in response.data], ['First', 'Second'])
+
+
+class PillListQueryTests(TestCase):
+    """Order lists run a fixed number of queries, whatever the number of orders"""
+    budget = 6
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='buyer', password='password')
+        self.admin = User.objects.create_superuser(username='admin', password='password', email='admin@example.com')
+        self.color = Color.objects.create(name='Red', degree='1')
+        self.products = [create_product(f'Product {index}') for index in range(3)]
+        for product in self.products:
+            ProductImage.objects.create(product=product, image='products/image.jpg')
+            ProductAvailability.objects.create(product=product, size='m', color=self.color, quantity=1000)
+        self.client = APIClient(HTTP_HOST='localhost')
+
+    def create_pills(self, count):
+        for index in range(count):
+            pill = create_pill(self.user, [
+                {'product': product, 'quantity': 1, 'size': 'm', 'color': self.color} for product in self.products
+            ])
+            PillAddress.objects.create(pill=pill, government='1')
+            if index % 2:
+                pill.status = 'w'
+                pill.save()
+
+    def count_queries(self, url, user):
+        self.client.force_authenticate(user)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_query_budget(self):
+        for url, user in [(reverse('pill-list-create'), self.admin), (reverse('user-pills'), self.user)]:
+            self.create_pills(2)
+            few = self.count_queries(url, user)
+            self.create_pills(10)
+            many = self.count_queries(url, user)
+
+            self.assertEqual(few, many, url)
+            self.assertLessEqual(many, self.budget, url)
+
+
+class ProductListQueryTests(TestCase):
+    """The product list runs a fixed number of queries, whatever the page size"""
+    # The capped count, the page and the images, descriptions and availabilities of its products
+    budget = 5
+
+    def setUp(self):
+        brand = Brand.objects.create(name='Acme')
+        color = Color.objects.create(name='Red', degree='1')
+        for index in range(100):
+            product = create_product(f'Product {index}')
+            Product.objects.filter(id=product.id).update(brand=brand)
+            ProductImage.objects.create(product=product, image='products/image.jpg')
+            ProductDescription.objects.create(product=product, title='Fit', description='True to size')
+            ProductAvailability.objects.create(product=product, size='m', color=color, quantity=10)
+        self.client = APIClient(HTTP_HOST='localhost')
+
+    def tearDown(self):
+        discount_index.invalidate()
+
+    def test_query_budget(self):
+        # Load the in-process discount index first, it is not part of the page
+        self.client.get(reverse('product-list'))
+        # The list is cut to `limit` (10 by default) before it is paginated
+        for per_page in [2, 100]:
+            with self.assertNumQueries(self.budget):
+                response = self.client.get(reverse('product-list'), {'per_page': per_page, 'limit': 100})
+            self.assertEqual(len(response.data['results']), per_page)
+
+
+class RatingStatsTests(TestCase):
+    def setUp(self):
+        self.product = create_product()
+        self.users = [User.objects.create_user(username=f'user{number}', password='password') for number in range(3)]
+
+    def stats(self):
+        product = Product.objects.get(id=self.product.id)
+        return (product.rating_count, product.rating_sum, product.rating_average, product.rating_count_5, product.rating_count_2)
+
+    def test_ratings_adjust_the_stats(self):
+        Rating.objects.create(product=self.product, user=self.users[0], star_number=5)
+        rating = Rating.objects.create(product=self.product, user=self.users[1], star_number=2)
+        self.assertEqual(self.stats(), (2, 7, 3.5, 1, 1))
+
+        rating = Rating.objects.get(id=rating.id)
+        rating.star_number = 5
+        rating.save()
+        self.assertEqual(self.stats(), (2, 10, 5.0, 2, 0))
+
+        rating.delete()
+        Rating.objects.filter(product=self.product).get().delete()
+        self.assertEqual(self.stats(), (0, 0, 0.0, 0, 0))
+
+    def test_product_edits_keep_concurrent_ratings(self):
+        # Loaded before the rating, saved after it
+        product = Product.objects.get(id=self.product.id)
+        Rating.objects.create(product=self.product, user=self.users[0], star_number=5)
+        product.name = 'Renamed'
+        product.save()
+        self.assertEqual(self.stats(), (1, 5, 5.0, 1, 0))
+        self.assertEqual(Product.objects.get(id=self.product.id).name, 'Renamed')
+
+    def test_rebuild_command(self):
+        Rating.objects.create(product=self.product, user=self.users[0], star_number=5)
+        Rating.objects.create(product=self.product, user=self.users[1], star_number=2)
+        Product.objects.filter(id=self.product.id).update(rating_count=9, rating_sum=1, rating_count_5=0)
+
+        call_command('rebuild_rating_stats', stdout=io.StringIO())
+        self.assertEqual(self.stats(), (2, 7, 3.5, 1, 1))
+
+
+class DiscountIndexTests(TestCase):
+    def setUp(self):
+        self.product = create_product()
+        discount_index.invalidate()
+
+    def tearDown(self):
+        # The discounts are rolled back without signals, the index must not keep them
+        discount_index.invalidate()
+
+    def create_discount(self, **fields):
+        now = timezone.now()
+        return Discount.objects.create(
+            product=self.product, discount=10, discount_start=now - timedelta(days=1), discount_end=now + timedelta(days=1), **fields
+        )
+
+    def test_invalidated_on_commit(self):
+        self.assertIsNone(discount_index.get_current_discount(self.product.id))
+        generation = cache.get(discount_index.generation_key)
+        with self.captureOnCommitCallbacks() as callbacks:
+            discount = self.create_discount()
+            # Not yet committed, the other workers must not reload
+            self.assertEqual(cache.get(discount_index.generation_key), generation)
+            self.assertIsNone(discount_index.get_current_discount(self.product.id))
+        for callback in callbacks:
+            callback()
+        self.assertNotEqual(cache.get(discount_index.generation_key), generation)
+        self.assertEqual(discount_index.get_current_discount(self.product.id), discount)
+
+    def effective_prices(self, *products):
+        return [Product.objects.get(id=product.id).effective_price for product in products]
+
+    def test_moving_a_discount_refreshes_both_targets(self):
+        other = create_product(name='Other')
+        with self.captureOnCommitCallbacks(execute=True):
+            discount = self.create_discount()
+        self.assertEqual(self.effective_prices(self.product, other), [90, 100])
+
+        discount = Discount.objects.get(id=discount.id)
+        discount.product = other
+        with self.captureOnCommitCallbacks(execute=True):
+            discount.save()
+        self.assertEqual(self.effective_prices(self.product, other), [100, 90])
+
+        # From a product to a category
+        discount.product = None
+        discount.category = Category.objects.create(name='Discounted')
+        with self.captureOnCommitCallbacks(execute=True):
+            discount.save()
+        self.assertEqual(self.effective_prices(self.product, other), [100, 100])
+
+    def test_missing_effective_prices_are_backfilled_after_migrate(self):
+        Product.objects.filter(id=self.product.id).update(effective_price=None)
+        backfill_effective_prices(sender=None)
+        self.assertEqual(self.effective_prices(self.product), [100])
+
+    def test_reloaded_after_max_age(self):
+        self.assertIsNone(discount_index.get_current_discount(self.product.id))
+        # Written by another worker whose invalidation did not reach this one
+        with self.captureOnCommitCallbacks():
+            discount = self.create_discount()
+        self.assertIsNone(discount_index.get_current_discount(self.product.id))
+        discount_index._loaded_at -= discount_index.max_age
+        self.assertEqual(discount_index.get_current_discount(self.product.id), discount)
+
+
+class StockLedgerTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='buyer', password='password')
+        self.product = create_product()
+        self.color = Color.objects.create(name='Red', degree='1')
+
+    def stock(self):
+        return ProductAvailability.objects.filter(product=self.product).aggregate(total=Sum('quantity'))['total']
+
+    def ledger(self):
+        return StockMovement.objects.filter(product=self.product).aggregate(total=Sum('quantity'))['total']
+
+    def test_receipts_and_adjustments_are_recorded(self):
+        availability = ProductAvailability.objects.create(product=self.product, size='m', color=self.color, quantity=10)
+        availability.quantity = 7
+        availability.save()
+        availability.save()
+
+        kinds = list(StockMovement.objects.order_by('id').values_list('kind', 'quantity'))
+        self.assertEqual(kinds, [(StockMovement.RECEIPT, 10), (StockMovement.ADJUSTMENT, -3)])
+
+    def test_movements_are_append_only(self):
+        availability = ProductAvailability.objects.create(product=self.product, size='m', quantity=1)
+        movement = availability.movements.get()
+        movement.quantity = 5
+        with self.assertRaises(ValidationError):
+            movement.save()
+
+    def test_take_stock_uses_oldest_batches_first(self):
+        first = ProductAvailability.objects.create(product=self.product, size='m', color=self.color, quantity=3)
+        second = ProductAvailability.objects.create(product=self.product, size='m', color=self.color, quantity=5)
+
+        with transaction.atomic():
+            movements = take_stock(self.product.id, 'm', self.color.id, 6)
+
+        self.assertEqual([(m.availability_id, m.quantity) for m in movements], [(first.id, -3), (second.id, -3)])
+        first.refresh_from_db()
+        second.refresh_from_db()
+        self.assertEqual((first.quantity, second.quantity), (0, 2))
+
+    def test_delivery_takes_every_item_in_one_transaction(self):
+        other = create_product('Other')
+        ProductAvailability.objects.create(product=self.product, size='m', color=self.color, quantity=5)
+        ProductAvailability.objects.create(product=other, size='l', quantity=1)
+        pill = create_pill(self.user, [
+            {'product': self.product, 'quantity': 2, 'size': 'm', 'color': self.color},
+            {'product': self.product, 'quantity': 1, 'size': 'm', 'color': self.color},
+            {'product': other, 'quantity': 2, 'size': 'l'},
+        ])
+
+        pill.status = 'd'
+        with self.assertRaises(ValidationError):
+            pill.save()
+
+        # The second item ran out of stock, so nothing was taken or sold
+        self.assertEqual(self.stock(), 5)
+        self.assertFalse(ProductSales.objects.exists())
+        self.assertEqual(Pill.objects.get(pk=pill.pk).status, 'i')
+
+    def test_delivery_and_return(self):
+        ProductAvailability.objects.create(product=self.product, size='m', color=self.color, quantity=5)
+        pill = create_pill(self.user, [{'product': self.product, 'quantity': 3, 'size': 'm', 'color': self.color}])
+
+        pill.status = 'd'
+        pill.save()
+        self.assertEqual(self.stock(), 2)
+        self.assertEqual(self.ledger(), 2)
+        self.assertEqual(pill.product_sales.get().quantity, 3)
+
+        # Saving the delivered pill again does not take the stock twice
+        pill.save()
+        self.assertEqual(self.stock(), 2)
+
+        pill.status = 'r'
+        pill.save()
+        self.assertEqual(self.stock(), 5)
+        self.assertEqual(self.ledger(), 5)
+        self.assertFalse(pill.product_sales.exists())
+
+
+class StockReservationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='buyer', password='password')
+        self.product = create_product()
+        self.availability = ProductAvailability.objects.create(product=self.product, size='m', quantity=5)
+        self.client = APIClient(HTTP_HOST='localhost')
+        self.client.force_authenticate(self.user)
+
+    def checkout(self, quantity):
+        return self.client.post(reverse('pill-create'), {
+            'items': [{'product': self.product.id, 'quantity': quantity, 'size': 'm'}]
+        }, format='json')
+
+    def stock(self):
+        self.availability.refresh_from_db()
+        return self.availability.quantity
+
+    def test_checkout_reserves_stock(self):
+        response = self.checkout(3)
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.stock(), 2)
+        reservation = StockReservation.objects.get()
+        self.assertEqual((reservation.pill_id, reservation.quantity), (response.data['id'], 3))
+
+    def test_checkout_beyond_stock_is_refused(self):
+        response = self.checkout(6)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Pill.objects.exists())
+        self.assertEqual(self.stock(), 5)
+
+    def test_expired_reservations_are_released(self):
+        pill = Pill.objects.get(id=self.checkout(1).data['id'])
+        cash, online, paid = [Pill.objects.get(id=self.checkout(1).data['id']) for _ in range(3)]
+        for waiting, pay_method in [(cash, 'c'), (online, 'v')]:
+            PillAddress.objects.create(pill=waiting, government='1', pay_method=pay_method)
+            waiting.status = 'w'
+            waiting.save()
+        paid.status = 'p'
+        paid.save()
+        StockReservation.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+
+        # The unconfirmed pill and the one waiting for an online payment lose their reservation,
+        # the cash on delivery one waits for its confirmation
+        self.assertEqual(release_expired_reservations(), 2)
+        self.assertEqual(self.stock(), 3)
+        self.assertFalse(pill.reservations.exists())
+        self.assertFalse(online.reservations.exists())
+        self.assertTrue(cash.reservations.exists())
+        self.assertTrue(paid.reservations.exists())
+
+    def test_canceling_releases_stock(self):
+        pill = Pill.objects.get(id=self.checkout(3).data['id'])
+        pill.status = 'c'
+        pill.save()
+
+        self.assertEqual(self.stock(), 5)
+        self.assertFalse(StockReservation.objects.exists())
+
+    def test_delivering_sells_reserved_stock(self):
+        pill = Pill.objects.get(id=self.checkout(5).data['id'])
+        pill.status = 'd'
+        pill.save()
+
+        self.assertEqual(self.stock(), 0)
+        self.assertFalse(StockReservation.objects.exists())
+        self.assertEqual(StockMovement.objects.aggregate(total=Sum('quantity'))['total'], 0)
+        self.assertEqual(pill.product_sales.get().quantity, 5)
+
+
+class WhatsAppOutboxTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='buyer', password='password')
+        self.pill = Pill.objects.create(user=self.user)
+        PillAddress.objects.create(pill=self.pill, government='1', phone='1000000001')
+
+    def test_payment_queues_one_message(self):
+        self.pill.paid = True
+        self.pill.save()
+        self.pill.save()
+
+        message = WhatsAppMessage.objects.get()
+        self.assertEqual((message.phone, message.status), ('1000000001', WhatsAppMessage.PENDING))
+        self.assertIn(self.pill.pill_number, message.message)
+
+        gateway = FakeWhatsAppGateway()
+        self.assertEqual(drain_outbox(gateway), 1)
+        self.assertEqual(drain_outbox(gateway), 0)
+        self.assertEqual([sent['idempotency_key'] for sent in gateway.sent], [f"pill-paid:{self.pill.id}"])
+        message.refresh_from_db()
+        self.assertEqual(message.status, WhatsAppMessage.SENT)
+
+    def test_applying_a_pay_request_queues_one_message(self):
+        admin = User.objects.create_superuser(username='admin', password='password')
+        pay_request = PayRequest.objects.create(pill=self.pill, image='pay_requests/receipt.png')
+        client = APIClient(HTTP_HOST='localhost')
+        client.force_authenticate(admin)
+
+        response = client.put(reverse('apply-pay-request', args=[pay_request.id]))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(WhatsAppMessage.objects.count(), 1)
+        self.assertEqual(Pill.objects.get(id=self.pill.id).status, 'p')
+
+    def test_applying_a_pay_request_keeps_a_later_status(self):
+        # Paid on delivery, after it shipped
+        self.pill.status = 'u'
+        self.pill.save()
+        pay_request = PayRequest.objects.create(pill=self.pill, image='pay_requests/receipt.png')
+        client = APIClient(HTTP_HOST='localhost')
+        client.force_authenticate(User.objects.create_superuser(username='admin', password='password'))
+
+        response = client.put(reverse('apply-pay-request', args=[pay_request.id]))
+
+        self.assertEqual(response.status_code, 200)
+        pill = Pill.objects.get(id=self.pill.id)
+        self.assertEqual((pill.status, pill.paid), ('u', True))
+
+    def test_rolled_back_payment_queues_nothing(self):
+        with self.assertRaises(RuntimeError), transaction.atomic():
+            self.pill.paid = True
+            self.pill.save()
+            raise RuntimeError()
+
+        self.assertFalse(WhatsAppMessage.objects.exists())
+
+    def test_failures_back_off_then_give_up(self):
+        queue_whatsapp_message('1000000002', 'Hello', 'test:retry')
+        gateway = FakeWhatsAppGateway(failures=2)
+
+        self.assertEqual(drain_outbox(gateway), 0)
+        message = WhatsAppMessage.objects.get()
+        self.assertEqual((message.status, message.attempts), (WhatsAppMessage.PENDING, 1))
+        self.assertGreater(message.next_attempt_at, timezone.now())
+        # Not due yet
+        self.assertEqual(drain_outbox(gateway), 0)
+        self.assertEqual(gateway.calls, 1)
+
+        WhatsAppMessage.objects.update(next_attempt_at=timezone.now())
+        with self.settings(WHATSAPP_MAX_ATTEMPTS=2):
+            drain_outbox(gateway)
+        message.refresh_from_db()
+        self.assertEqual((message.status, message.attempts), (WhatsAppMessage.FAILED, 2))
+
+    def test_one_message_per_phone_interval(self):
+        queue_whatsapp_message('1000000003', 'First', 'test:first')
+        queue_whatsapp_message('1000000003', 'Second', 'test:second')
+        queue_whatsapp_message('1000000004', 'Other', 'test:other')
+        gateway = FakeWhatsAppGateway()
+
+        self.assertEqual(drain_outbox(gateway), 2)
+        self.assertEqual([sent['message'] for sent in gateway.sent], ['First', 'Other'])
+        deferred = WhatsAppMessage.objects.get(idempotency_key='test:second')
+        self.assertEqual((deferred.status, deferred.attempts), (WhatsAppMessage.PENDING, 0))
+        self.assertGreater(deferred.next_attempt_at, timezone.now())
+
+    @override_settings(WHATSAPP_TIMEOUT=(2, 8), WHATSAPP_RATE_PER_SECOND=10)
+    def test_claims_outlast_the_slowest_batch(self):
+        for number in range(3):
+            queue_whatsapp_message(f'100000001{number}', 'Hello', f'test:lease:{number}')
+
+        before = timezone.now()
+        claim_due_messages(batch_size=50)
+        # 50 calls of up to 10 seconds, spaced by 0.1 second
+        self.assertGreaterEqual(WhatsAppMessage.objects.earliest('next_attempt_at').next_attempt_at, before + timedelta(seconds=505))
+        self.assertEqual(claim_due_messages(batch_size=50), [])
+
+
+class AlertDispatchTests(TestCase):
+    def setUp(self):
+        self.product = create_product(price=100)
+        self.users = [
+            User.objects.create_user(username=f'user{number}', password='password', email=f'user{number}@example.com')
+            for number in range(10)
+        ]
+
+    def test_restock_notifies_stock_alerts_in_bulk(self):
+        StockAlert.objects.bulk_create([StockAlert(product=self.product, user=user) for user in self.users])
+        StockAlert.objects.create(product=self.product, email='guest@example.com')
+        no_email = StockAlert.objects.create(product=self.product, user=User.objects.create_user(username='anonymous'))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            ProductAvailability.objects.create(product=self.product, size='m', quantity=0)
+        self.assertFalse(QueuedEmail.objects.exists())
+
+        availability = ProductAvailability.objects.get()
+        availability.quantity = 3
+        with CaptureQueriesContext(connection) as queries, self.captureOnCommitCallbacks(execute=True):
+            availability.save()
+
+        self.assertEqual(QueuedEmail.objects.count(), 11)
+        self.assertEqual(StockAlert.objects.filter(is_notified=True).count(), 11)
+        # Alerts without an address stay pending for the in-app list
+        no_email.refresh_from_db()
+        self.assertFalse(no_email.is_notified)
+        # Set-based: the queries do not grow with the number of alerts
+        self.assertLess(len(queries), 15)
+
+    def test_only_a_lower_price_checks_the_alerts(self):
+        # Already below the watched price, so any check would notify it
+        PriceDropAlert.objects.create(product=self.product, user=self.users[0], last_price=200)
+
+        self.product.name = 'Renamed'
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.save()
+        product = Product.objects.get(id=self.product.id)
+        product.price = 120
+        with self.captureOnCommitCallbacks(execute=True):
+            product.save()
+        self.assertFalse(QueuedEmail.objects.exists())
+
+        product.price = 90
+        with self.captureOnCommitCallbacks(execute=True):
+            product.save()
+        self.assertEqual(QueuedEmail.objects.count(), 1)
+
+    def test_price_drop_notifies_matching_alerts(self):
+        PriceDropAlert.objects.create(product=self.product, user=self.users[0], last_price=100)
+        PriceDropAlert.objects.create(product=self.product, user=self.users[1], last_price=50)
+
+        self.product.price = 80
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.product.save()
+        # Nothing is matched before the price change commits
+        self.assertTrue(callbacks)
+        self.assertFalse(QueuedEmail.objects.exists())
+
+        self.assertEqual(dispatch_alerts([self.product.id]), (0, 1))
+        email = QueuedEmail.objects.get()
+        self.assertEqual(email.recipients, ['user0@example.com'])
+        self.assertEqual(
+            list(PriceDropAlert.objects.order_by('last_price').values_list('is_notified', flat=True)), [False, True]
+        )
+
+
+class CoPurchaseTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='buyer', password='password')
+        self.products = [create_product(name=f'Product {number}') for number in range(4)]
+        for product in self.products:
+            ProductAvailability.objects.create(product=product, size='m', quantity=100)
+
+    def deliver(self, *products):
+        pill = create_pill(self.user, [{'product': product, 'quantity': 1, 'size': 'm'} for product in products])
+        pill.status = 'd'
+        pill.save()
+        return pill
+
+    def neighbors(self, product):
+        return list(CoPurchaseNeighbor.objects.filter(product=product).order_by('rank').values_list('neighbor', 'support'))
+
+    def test_deliveries_update_the_neighbors(self):
+        first, second, third, fourth = self.products
+        self.deliver(first, second)
+        self.deliver(first, second, third)
+        pill = self.deliver(first, third)
+        self.deliver(fourth)
+
+        self.assertEqual(self.neighbors(first), [(second.id, 2), (third.id, 2)])
+
+        response = APIClient(HTTP_HOST='localhost').get(reverse('frequently-bought-together'), {'product_id': first.id})
+        self.assertEqual([product['id'] for product in response.data['results']], [second.id, third.id])
+
+        pill.status = 'r'
+        pill.save()
+        self.assertEqual(self.neighbors(first), [(second.id, 2), (third.id, 1)])
+        self.assertEqual(self.neighbors(fourth), [])
+        self.assertEqual(delivered_pill_count(), 3)
+
+    def test_rebuild_matches_the_incremental_counts(self):
+        first, second, third, fourth = self.products
+        self.deliver(first, second)
+        self.deliver(first, second, third)
+        self.deliver(second, fourth)
+        counts = set(CoPurchaseCount.objects.values_list('product', 'other', 'pills'))
+        neighbors = set(CoPurchaseNeighbor.objects.values_list('product', 'neighbor', 'rank', 'support'))
+
+        self.assertEqual(delivered_pill_count(), 3)
+
+        CoPurchaseNeighbor.objects.all().delete()
+        CoPurchaseTotal.objects.update(pills=0)
+        rebuild_co_purchases()
+        self.assertEqual(delivered_pill_count(), 3)
+
+        self.assertEqual(set(CoPurchaseCount.objects.values_list('product', 'other', 'pills')), counts)
+        self.assertEqual(set(CoPurchaseNeighbor.objects.values_list('product', 'neighbor', 'rank', 'support')), neighbors)
+        # 3 pills, 1 of them with first and third, which are in 2 and 1 pills
+        self.assertAlmostEqual(CoPurchaseNeighbor.objects.get(product=first, neighbor=third).lift, 1 * 3 / (2 * 1))
+
+
+class RecommendationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        catalog_arrays.invalidate()
+        self.user = User.objects.create_user(username='buyer', password='password')
+        brand = Brand.objects.create(name='Brand')
+        other_category = Category.objects.create(name='Other')
+        self.viewed = create_product(name='Viewed')
+        self.same_brand = create_product(name='Same brand')
+        self.unrelated = Product.objects.create(name='Unrelated', category=other_category, price=100)
+        self.bought_together = Product.objects.create(name='Bought together', category=other_category, price=100)
+        Product.objects.filter(id__in=[self.viewed.id, self.same_brand.id]).update(brand=brand)
+        CoPurchaseNeighbor.objects.create(product=self.viewed, neighbor=self.bought_together, rank=1, support=5, lift=2.0)
+
+    def test_products_are_ranked_by_affinity(self):
+        ids = recommend_products(self.user, self.viewed.id)
+
+        self.assertEqual(ids, [self.bought_together.id, self.same_brand.id, self.unrelated.id])
+
+        response = APIClient(HTTP_HOST='localhost')
+        response.force_authenticate(self.user)
+        response = response.get(reverse('product-recommendations'), {'product_id': self.viewed.id})
+        self.assertEqual([product['id'] for product in response.data['results']], ids)
+
+    def test_results_are_cached_until_the_user_loves_a_product(self):
+        recommend_products(self.user)
+        with CaptureQueriesContext(connection) as queries:
+            recommend_products(self.user)
+        self.assertEqual(len(queries), 0)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            LovedProduct.objects.create(user=self.user, product=self.unrelated)
+        with CaptureQueriesContext(connection) as queries:
+            ids = recommend_products(self.user, k=2)
+        self.assertTrue(queries)
+        # Loving a product pulls its category up
+        self.assertEqual(ids, [self.unrelated.id, self.bought_together.id])
+
+    def test_arrays_reload_on_taxonomy_changes_only(self):
+        product = Product.objects.get(id=self.unrelated.id)
+        with self.captureOnCommitCallbacks() as callbacks:
+            product.price = 80
+            product.save()
+        self.assertNotIn(catalog_arrays.invalidate, callbacks)
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            product.category = self.viewed.category
+            product.save()
+        self.assertIn(catalog_arrays.invalidate, callbacks)
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            create_product(name='New')
+        self.assertIn(catalog_arrays.invalidate, callbacks)
+
+    def test_popularity_comes_from_the_rollups(self):
+        ProductSalesDaily.objects.create(product=self.unrelated, day=timezone.localdate(), quantity=3, revenue=300)
+        catalog_arrays.invalidate()
+        arrays = catalog_arrays.get()
+        self.assertEqual(arrays['popularity'][arrays['rows'][self.unrelated.id]], 1)
+        self.assertEqual(arrays['popularity'][arrays['rows'][self.viewed.id]], 0)
+
+        # The all-time ranking is read once computed
+        BestSeller.objects.create(
+            window=0, product=self.viewed, quantity=9, revenue=900, rank=1, category_rank=1, brand_rank=1
+        )
+        catalog_arrays.invalidate()
+        arrays = catalog_arrays.get()
+        self.assertEqual(arrays['popularity'][arrays['rows'][self.viewed.id]], 1)
+        self.assertEqual(arrays['popularity'][arrays['rows'][self.unrelated.id]], 0)
+
+
+class BestSellerTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='buyer', password='password')
+        self.category = Category.objects.create(name='Shoes')
+        self.products = [create_product(name=f'Product {number}') for number in range(3)]
+        Product.objects.filter(id=self.products[2].id).update(category=self.category)
+        for product in self.products:
+            ProductAvailability.objects.create(product=product, size='m', quantity=100)
+
+    def deliver(self, **quantities):
+        pill = create_pill(self.user, [
+            {'product': self.products[int(index[1:])], 'quantity': quantity, 'size': 'm'}
+            for index, quantity in quantities.items()
+        ])
+        pill.status = 'd'
+        pill.save()
+        return pill
+
+    def best_sellers(self, **params):
+        response = APIClient(HTTP_HOST='localhost').get(reverse('best-sellers'), params)
+        self.assertEqual(response.status_code, 200)
+        return [product['id'] for product in response.data['results']]
+
+    def test_deliveries_and_returns_update_the_rollups(self):
+        self.deliver(p0=2, p1=1)
+        pill = self.deliver(p0=1)
+        self.assertEqual(ProductSalesDaily.objects.get(product=self.products[0]).quantity, 3)
+        self.assertEqual(ProductSalesDaily.objects.get(product=self.products[0]).revenue, 300)
+
+        pill.status = 'r'
+        pill.save()
+        self.assertEqual(ProductSalesDaily.objects.get(product=self.products[0]).quantity, 2)
+
+    def test_rankings_per_window_and_category(self):
+        first, second, third = self.products
+        self.deliver(p0=5, p1=1, p2=1)
+        self.deliver(p1=2, p2=3)
+        # Old sales only count for all time
+        ProductSales.objects.filter(product=first).update(date_sold=timezone.now() - timedelta(days=10))
+        rebuild_daily_sales()
+        refresh_best_sellers()
+
+        self.assertEqual(self.best_sellers(), [first.id, third.id, second.id])
+        self.assertEqual(self.best_sellers(days=7), [third.id, second.id])
+        self.assertEqual(self.best_sellers(days=30), [first.id, third.id, second.id])
+        self.assertEqual(self.best_sellers(days=7, category=self.category.id), [third.id])
+        self.assertEqual(BestSeller.objects.get(window=0, product=third).category_rank, 1)
+        # Windows without a ranking are summed from the rollups
+        self.assertEqual(self.best_sellers(days=3), [third.id, second.id])
+
+    def test_missing_or_stale_rankings_are_summed_from_the_rollups(self):
+        first, second, third = self.products
+        self.deliver(p0=1, p1=3)
+        # Not refreshed yet
+        self.assertEqual(self.best_sellers(days=7), [second.id, first.id])
+
+        refresh_best_sellers()
+        self.deliver(p0=5)
+        self.assertEqual(self.best_sellers(days=7), [second.id, first.id])
+
+        # The refresh stopped running
+        BestSeller.objects.update(refreshed_at=timezone.now() - timedelta(seconds=settings.BEST_SELLERS_MAX_AGE))
+        self.assertEqual(self.best_sellers(days=7), [first.id, second.id])
+
+
+class ExportTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='buyer', password='password')
+        admin = User.objects.create_superuser(username='admin', password='password', email='admin@example.com')
+        self.product = create_product()
+        ProductAvailability.objects.create(product=self.product, size='m', quantity=10, native_price=40)
+        Shipping.objects.create(government='1', shipping_price=30)
+        self.client = APIClient(HTTP_HOST='localhost')
+        self.client.force_authenticate(admin)
+
+    def create_pill(self, quantity, status='i'):
+        pill = create_pill(self.user, [{'product': self.product, 'quantity': quantity, 'size': 'm'}])
+        PillAddress.objects.create(pill=pill, government='1', phone='0100')
+        pill.status = status
+        pill.save()
+        return pill
+
+    def export(self, name, **params):
+        response = self.client.get(reverse(name), params)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        return b''.join(response.streaming_content)
+
+    def test_csv_exports_honor_the_list_filters(self):
+        self.create_pill(1)
+        delivered = self.create_pill(2, status='d')
+
+        rows = list(csv.DictReader(io.StringIO(self.export('pill-export', status='d').decode())))
+        self.assertEqual([row['Number'] for row in rows], [delivered.pill_number])
+        self.assertEqual((rows[0]['Phone'], rows[0]['Subtotal'], rows[0]['Shipping'], rows[0]['Total']), ('0100', '200.0', '30.0', '230.0'))
+
+        rows = list(csv.DictReader(io.StringIO(self.export('pill-export', status='i').decode())))
+        # Totals of an unfrozen pill are computed like Pill.final_price
+        self.assertEqual(rows[0]['Total'], '130.0')
+
+        rows = list(csv.DictReader(io.StringIO(self.export('product-sales-export', product=self.product.id).decode())))
+        self.assertEqual((rows[0]['Pill'], rows[0]['Quantity'], rows[0]['Unit Price']), (delivered.pill_number, '2', '100.0'))
+
+        rows = list(csv.DictReader(io.StringIO(self.export('product-availability-export', size='m').decode())))
+        self.assertEqual((rows[0]['Product'], rows[0]['Quantity']), ('Product', '8'))
+
+    def test_xlsx_export(self):
+        self.create_pill(1)
+        workbook = zipfile.ZipFile(io.BytesIO(self.export('pill-export', file='xlsx')))
+        self.assertIsNone(workbook.testzip())
+        sheet = workbook.read('xl/worksheets/sheet1.xml').decode()
+        self.assertIn('<t>Number</t>', sheet)
+        self.assertIn('<row r="2">', sheet)
+
+    def test_cells_are_not_run_as_formulas(self):
+        Product.objects.filter(id=self.product.id).update(name='=HYPERLINK("http://example.com")\x01')
+
+        rows = list(csv.DictReader(io.StringIO(self.export('product-availability-export').decode())))
+        self.assertEqual(rows[0]['Product'], '\'=HYPERLINK("http://example.com")\x01')
+
+        workbook = zipfile.ZipFile(io.BytesIO(self.export('product-availability-export', file='xlsx')))
+        sheet = workbook.read('xl/worksheets/sheet1.xml').decode()
+        self.assertIn('<t>\'=HYPERLINK("http://example.com")</t>', sheet)
+        self.assertNotIn('\x01', sheet)
+
+    def test_exports_are_for_admins(self):
+        self.client.force_authenticate(self.user)
+        self.assertEqual(self.client.get(reverse('pill-export')).status_code, 403)
+
+
+class CatalogImportTests(TestCase):
+    def setUp(self):
+        self.category = Category.objects.create(name='Shoes')
+        self.brand = Brand.objects.create(name='Acme')
+        self.color = Color.objects.create(name='Red', degree='1')
+
+    def test_jsonl_import_creates_updates_and_reports_errors(self):
+        existing = create_product()
+        rows = [
+            {'name': 'Runner', 'category': 'shoes', 'brand': 'Acme', 'price': 50,
+             'availabilities': [{'size': 'm', 'color': 'red', 'quantity': 4, 'native_price': 20}],
+             'descriptions': [{'title': 'Fit', 'description': 'True to size'}],
+             'images': ['product_images/runner.jpg']},
+            {'id': existing.id, 'price': 80},
+            {'name': 'Broken', 'category': 'Hats', 'availabilities': [{'size': 'huge', 'quantity': -1}]},
+            {'id': 999999},
+        ]
+        upload = SimpleUploadedFile('catalog.jsonl', '\n'.join(json.dumps(row) for row in rows).encode())
+        client = APIClient(HTTP_HOST='localhost')
+        client.force_authenticate(User.objects.create_superuser(username='admin', password='password'))
+
+        response = client.post(reverse('product-import'), {'file': upload}, format='multipart')
+        self.assertEqual(response.status_code, 207)
+        self.assertEqual((response.data['created'], response.data['updated'], response.data['failed']), (1, 1, 2))
+        self.assertEqual(response.data['errors'][0]['row'], 3)
+        self.assertEqual(
+            set(response.data['errors'][0]['errors']),
+            {'category', 'availabilities.0.size', 'availabilities.0.quantity'}
+        )
+
+        runner = Product.objects.get(name='Runner')
+        self.assertEqual((runner.category, runner.brand, runner.effective_price), (self.category, self.brand, 50))
+        self.assertEqual(runner.availabilities.get().color, self.color)
+        self.assertEqual(StockMovement.objects.get(product=runner).quantity, 4)
+        self.assertEqual(ProductDescription.objects.get(product=runner).title, 'Fit')
+        self.assertEqual(ProductImage.objects.get(product=runner).image.name, 'product_images/runner.jpg')
+        existing.refresh_from_db()
+        self.assertEqual((existing.price, existing.effective_price), (80, 80))
+
+    def test_too_long_text_and_bad_encoding_are_refused(self):
+        client = APIClient(HTTP_HOST='localhost')
+        client.force_authenticate(User.objects.create_superuser(username='admin', password='password'))
+        rows = [
+            {'name': 'N' * 101},
+            {'name': 'Long story', 'description': 'D' * 1001, 'descriptions': [{'title': 'T' * 201, 'description': 'x'}]},
+        ]
+        upload = SimpleUploadedFile('catalog.jsonl', '\n'.join(json.dumps(row) for row in rows).encode())
+
+        response = client.post(reverse('product-import'), {'file': upload}, format='multipart')
+        self.assertEqual(response.status_code, 207)
+        self.assertEqual(response.data['failed'], 2)
+        self.assertEqual(set(response.data['errors'][0]['errors']), {'name'})
+        self.assertEqual(set(response.data['errors'][1]['errors']), {'description', 'descriptions.0.title'})
+        self.assertFalse(Product.objects.exists())
+
+        upload = SimpleUploadedFile('catalog.csv', 'name,price\nCafé,1\n'.encode('latin-1'))
+        response = client.post(reverse('product-import'), {'file': upload}, format='multipart')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Product.objects.exists())
+
+    def test_values_of_the_wrong_type_fail_their_row(self):
+        client = APIClient(HTTP_HOST='localhost')
+        client.force_authenticate(User.objects.create_superuser(username='admin', password='password'))
+        rows = [
+            {'id': [1], 'price': 10},
+            {'id': 1.5, 'price': 10},
+            {'name': 'Odd', 'availabilities': [{'size': ['m'], 'color': 'blue', 'quantity': 1}]},
+        ]
+        upload = SimpleUploadedFile('catalog.jsonl', '\n'.join(json.dumps(row) for row in rows).encode())
+
+        response = client.post(reverse('product-import'), {'file': upload}, format='multipart')
+        self.assertEqual(response.status_code, 207)
+        self.assertEqual(response.data['failed'], 3)
+        self.assertEqual(response.data['errors'][0]['errors'], {'id': "A product id is required"})
+        self.assertEqual(response.data['errors'][1]['errors'], {'id': "A product id is required"})
+        self.assertEqual(response.data['errors'][2]['errors'], {
+            'availabilities.0.size': 'Unknown size "[\'m\']"',
+            'availabilities.0.color': 'Unknown color "blue"',
+        })
+
+    def test_csv_import_in_batches(self):
+        lines = ['name,category,price,availabilities']
+        lines += [f'Product {number},Shoes,{number},"[{{""size"": ""m"", ""quantity"": 1}}]"' for number in range(5)]
+        rows = read_rows(io.BytesIO('\n'.join(lines).encode()), 'csv')
+
+        # The four lookups once, then per batch of 2 rows a savepoint pair and one insert
+        # of products, availabilities and receipts, whatever the number of rows
+        with self.assertNumQueries(4 + 3 * 5):
+            report = import_catalog(rows, batch_size=2)
+        self.assertEqual((report['created'], report['failed']), (5, 0))
+        self.assertEqual(ProductAvailability.objects.filter(product__category=self.category).count(), 5)
+
+        report = import_catalog(read_rows(io.BytesIO(b'name,price\nDry,1\n'), 'csv'), dry_run=True)
+        self.assertEqual(report['created'], 1)
+        self.assertFalse(Product.objects.filter(name='Dry').exists())
+
+
+class BulkUpdateTests(TestCase):
+    def setUp(self):
+        self.products = [create_product(f'Product {number}') for number in range(3)]
+        self.color = Color.objects.create(name='Red', degree='1')
+        product = self.products[0]
+        self.old = ProductAvailability.objects.create(product=product, size='m', quantity=3)
+        self.new = ProductAvailability.objects.create(product=product, size='m', quantity=5)
+        ProductAvailability.objects.create(product=product, size='l', color=self.color, quantity=1)
+        self.client = APIClient(HTTP_HOST='localhost')
+        self.client.force_authenticate(User.objects.create_superuser(username='admin', password='password'))
+
+    def bulk_update(self, **data):
+        return self.client.post(reverse('product-bulk-update'), data, format='json')
+
+    def test_prices_and_stock_counts(self):
+        first, second, third = self.products
+        response = self.bulk_update(
+            prices=[{'id': first.id, 'price': 80}, {'id': second.id, 'price': 100}, {'id': 999999, 'price': 1}],
+            stock=[
+                {'product': first.id, 'size': 'm', 'quantity': 2},
+                {'product': first.id, 'size': 'l', 'color': self.color.id, 'quantity': 4},
+                {'product': third.id, 'size': 's', 'quantity': 7},
+                {'product': first.id, 'size': 'm', 'quantity': 1},
+            ],
+        )
+        self.assertEqual(response.status_code, 207)
+        self.assertEqual((response.data['updated'], response.data['unchanged'], response.data['failed']), (4, 1, 2))
+        self.assertEqual([outcome['status'] for outcome in response.data['prices']], ['updated', 'unchanged', 'failed'])
+        self.assertEqual(response.data['stock'][3]['errors'], {'product': "The SKU is counted by an earlier row"})
+
+        first.refresh_from_db()
+        self.assertEqual((first.price, first.effective_price), (80, 80))
+        # 6 missing units taken oldest batch first, extra units added to the newest batch
+        self.old.refresh_from_db()
+        self.new.refresh_from_db()
+        self.assertEqual((self.old.quantity, self.new.quantity), (0, 2))
+        self.assertEqual(ProductAvailability.objects.get(product=first, size='l').quantity, 4)
+        self.assertEqual(ProductAvailability.objects.get(product=third).quantity, 7)
+        self.assertEqual(
+            sorted(StockMovement.objects.filter(kind=StockMovement.ADJUSTMENT).values_list('quantity', flat=True)),
+            [-3, -3, 3, 7]
+        )
+
+    def test_unknown_sizes_fail_their_row(self):
+        first = self.products[0]
+        response = self.bulk_update(stock=[
+            {'product': first.id, 'size': 'huge', 'quantity': 1},
+            {'product': first.id, 'size': ['m'], 'quantity': 1},
+        ])
+        self.assertEqual(response.data['failed'], 2)
+        self.assertEqual(response.data['stock'][0]['errors'], {'size': 'Unknown size "huge"'})
+        self.assertEqual(set(response.data['stock'][1]['errors']), {'size'})
+        self.assertFalse(ProductAvailability.objects.filter(size='huge').exists())
+
+    def test_counts_include_the_reserved_units(self):
+        first = self.products[0]
+        user = User.objects.create_user(username='buyer', password='password')
+        pill = create_pill(user, [{'product': first, 'quantity': 2, 'size': 'm'}])
+        reserve_pill_items(pill, pill.items.all())
+
+        def available():
+            return ProductAvailability.objects.filter(product=first, size='m').aggregate(Sum('quantity'))['quantity__sum']
+
+        self.assertEqual(available(), 6)
+
+        # The 2 reserved units are still on the shelf
+        response = self.bulk_update(stock=[{'product': first.id, 'size': 'm', 'quantity': 8}])
+        self.assertEqual(response.data['stock'][0]['status'], 'unchanged')
+        self.assertEqual(available(), 6)
+
+        response = self.bulk_update(stock=[{'product': first.id, 'size': 'm', 'quantity': 5}])
+        self.assertEqual(response.data['stock'][0]['status'], 'updated')
+        self.assertEqual(available(), 3)
+
+    def test_queries_do_not_grow_with_the_rows(self):
+        def count(products):
+            with CaptureQueriesContext(connection) as queries:
+                self.bulk_update(prices=[
+                    {'id': product.id, 'price': 50 + number} for number, product in enumerate(products)
+                ])
+            return len(queries)
+
+        few = count(self.products[:1])
+        self.products += [create_product(f'Product {number}') for number in range(3, 10)]
+        self.assertEqual(few, count(self.products))
+
+
+class StockContentionTests(TransactionTestCase):
+    """Many threads taking stock of the same SKU at once"""
+    threads = 20
+
+    @classmethod
+    def setUpClass(cls):
+        # Threads need their own connections to a shared database
+        if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+            raise SkipTest("Needs a database file or server, not in-memory SQLite")
+        super().setUpClass()
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='buyer', password='password')
+        self.product = create_product()
+
+    def run_threads(self, target):
+        barrier = threading.Barrier(self.threads)
+        results = []
+
+        def worker(index):
+            barrier.wait()
+            try:
+                results.append(target(index))
+            except ValidationError:
+                results.append(None)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker, args=(index,)) for index in range(self.threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def assert_ledger_matches_stock(self):
+        stock = ProductAvailability.objects.filter(product=self.product).aggregate(total=Sum('quantity'))['total']
+        ledger = StockMovement.objects.filter(product=self.product).aggregate(total=Sum('quantity'))['total']
+        self.assertEqual(stock, ledger)
+        return stock
+
+    def test_concurrent_decrements_never_oversell(self):
+        ProductAvailability.objects.create(product=self.product, size='m', quantity=30)
+        ProductAvailability.objects.create(product=self.product, size='m', quantity=20)
+
+        def take(index):
+            with transaction.atomic():
+                movements = take_stock(self.product.id, 'm', None, 5)
+                StockMovement.objects.bulk_create(movements)
+            return movements
+
+        results = self.run_threads(take)
+
+        # 50 units in stock, 20 threads asking for 5: exactly 10 succeed
+        self.assertEqual(len([result for result in results if result]), 10)
+        self.assertEqual(self.assert_ledger_matches_stock(), 0)
+
+    def test_concurrent_checkouts_never_oversell(self):
+        ProductAvailability.objects.create(product=self.product, size='m', quantity=15)
+
+        def checkout(index):
+            client = APIClient(HTTP_HOST='localhost')
+            client.force_authenticate(self.user)
+            return client.post(reverse('pill-create'), {
+                'items': [{'product': self.product.id, 'quantity': 3, 'size': 'm'}]
+            }, format='json').status_code
+
+        results = self.run_threads(checkout)
+
+        self.assertEqual(results.count(201), 5)
+        self.assertEqual(results.count(400), self.threads - 5)
+        self.assertEqual(StockReservation.objects.aggregate(total=Sum('quantity'))['total'], 15)
+        self.assertEqual(self.assert_ledger_matches_stock(), 0)
+
+    def test_concurrent_deliveries_never_oversell(self):
+        ProductAvailability.objects.create(product=self.product, size='m', quantity=12)
+        pills = [
+            create_pill(self.user, [{'product': self.product, 'quantity': 2, 'size': 'm'}])
+            for _ in range(self.threads)
+        ]
+
+        def deliver(index):
+            pill = Pill.objects.get(pk=pills[index].pk)
+            pill.status = 'd'
+            pill.save()
+            return pill
+
+        results = self.run_threads(deliver)
+
+        self.assertEqual(len([result for result in results if result]), 6)
+        self.assertEqual(Pill.objects.filter(status='d').count(), 6)
+        self.assertEqual(ProductSales.objects.aggregate(total=Sum('quantity'))['total'], 12)
+        self.assertEqual(self.assert_ledger_matches_stock(), 0)
+
+    def test_concurrent_first_co_purchases_are_all_counted(self):
+        other = create_product(name='Other')
+
+        def deliver(index):
+            with transaction.atomic():
+                record_co_purchases([self.product.id, other.id])
+
+        self.run_threads(deliver)
+        self.assertEqual(CoPurchaseCount.objects.get(product=self.product, other=other).pills, self.threads)
+        self.assertEqual(delivered_pill_count(), self.threads)
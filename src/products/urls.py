@@ -15,6 +15,7 @@ urlpatterns = [
     path('ratings/<int:pk>/', CustomerRatingDetailView.as_view(), name='customer-rating-detail'),
     path('user-pills/', UserPillsView.as_view(), name='user-pills'),
     path('colors/', getColors.as_view(), name='colors'),
+    path('shipping-rates/', ShippingRatesView.as_view(), name='shipping-rates'),
     path('pay-requests/', PayRequestListCreateView.as_view(), name='pay-requests'),
     path('discounts/active/', ProductsWithActiveDiscountAPIView.as_view(), name='active-discounts'),
     path('loved-products/', LovedProductListCreateView.as_view(), name='loved-product-list-create'),
@@ -47,11 +48,16 @@ urlpatterns = [
     path('dashboard/products/', ProductListCreateView.as_view(), name='product-list-create'),
     path('dashboard/products-briefed/', ProductListBreifedView.as_view(), name='product-list-breifed'),
     path('dashboard/products/<int:pk>/', ProductRetrieveUpdateDestroyView.as_view(), name='product-detail'),
+    path('dashboard/products/import/', ProductImportView.as_view(), name='product-import'),
+    path('dashboard/products/bulk-update/', ProductBulkUpdateView.as_view(), name='product-bulk-update'),
     path('dashboard/product-images/', ProductImageListCreateView.as_view(), name='product-image-list-create'),
     path('dashboard/product-images/bulk-upload/', ProductImageBulkCreateView.as_view(), name='product-image-bulk-upload'),
     path('dashboard/product-images/<int:pk>/', ProductImageDetailView.as_view(), name='product-image-detail'),
     path('dashboard/pills/', PillListCreateView.as_view(), name='pill-list-create'),
     path('dashboard/pills/<int:pk>/', PillRetrieveUpdateDestroyView.as_view(), name='pill-detail'),
+    path('dashboard/pills/bulk-status/', PillBulkStatusView.as_view(), name='pill-bulk-status'),
+    path('dashboard/pills/export/', PillExportView.as_view(), name='pill-export'),
+    path('dashboard/sales/export/', ProductSalesExportView.as_view(), name='product-sales-export'),
     path('dashboard/coupons/', CouponListCreateView.as_view(), name='coupon-list-create'),
     path('dashboard/coupons/<int:pk>/', CouponRetrieveUpdateDestroyView.as_view(), name='coupon-detail'),
     path('dashboard/shipping/', ShippingListCreateView.as_view(), name='shipping-list-create'),
@@ -60,6 +66,7 @@ urlpatterns = [
     path('dashboard/ratings/<int:pk>/', RatingDetailView.as_view(), name='rating-detail'),
     path('dashboard/product-availabilities/', ProductAvailabilityListCreateView.as_view(), name='product-availability-list-create'),
     path('dashboard/product-availabilities/<int:pk>/', ProductAvailabilityDetailView.as_view(), name='product-availability-detail'),
+    path('dashboard/product-availabilities/export/', ProductAvailabilityExportView.as_view(), name='product-availability-export'),
     path('dashboard/products/<int:product_id>/availabilities/', ProductAvailabilitiesView.as_view(), name='product-availabilities'),
     path('dashboard/pay-requests/', AdminPayRequestCreateView.as_view(), name='admin-pay-request-create'),
     path('dashboard/pay-requests/<int:id>/apply/', ApplyPayRequestView.as_view(), name='apply-pay-request'),
@@ -2,66 +2,84 @@ from datetime import timedelta
 import random
 from django.shortcuts import get_object_or_404
 from django.utils import timezone
-from django.db.models import Sum, F, Count, Q
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db import transaction
+from django.db.models import Sum, F, FloatField, OuterRef, Q, Prefetch, Subquery
+from django.db.models.functions import Coalesce
 from rest_framework import generics, status
 from rest_framework import filters as rest_filters  # Rename this import
 from django_filters.rest_framework import DjangoFilterBackend
 from collections import defaultdict
 from products.permissions import IsOwner, IsOwnerOrReadOnly
-from .models import Category, Color, CouponDiscount, PillAddress, ProductAvailability, ProductImage, ProductSales, Rating, Shipping, SubCategory, Brand, Product,Pill
+from .models import Category, Color, CouponDiscount, PillAddress, PillItem, ProductAvailability, ProductImage, ProductSales, Rating, Shipping, SubCategory, Brand, Product,Pill
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated, IsAdminUser, AllowAny
 from rest_framework.parsers import MultiPartParser, FormParser
 from rest_framework.views import APIView
 from .serializers import *
-from .filters import CategoryFilter, CouponDiscountFilter, PillFilter, ProductFilter
-from .models import prepare_whatsapp_message
+from .filters import CategoryFilter, CouponDiscountFilter, PillFilter, ProductFilter, ProductSalesFilter, ProductSearchFilter
+from .exports import ExportMixin
+from .bulk import MAX_ROWS, bulk_update_catalog
+from .imports import check_encoding, import_catalog, read_rows
+from .discounts import discount_index
+from .cache import CachedResponseMixin, etag_matches
+from .shipping import shipping_rates
+from .recommendations import recommend_products
+from .bestsellers import WINDOWS, ranking_is_fresh, sales_over, window_start
+from accounts.pagination import KeysetOrPageNumberPagination, OptionalKeysetPagination
 
 
 #^ < ==========================customer endpoints========================== >
 
-class CategoryListView(generics.ListAPIView):
+class CategoryListView(CachedResponseMixin, generics.ListAPIView):
+    cache_tags = ('category',)
     queryset = Category.objects.all()
     serializer_class = CategorySerializer
     filter_backends = [DjangoFilterBackend]
     filterset_class = CategoryFilter 
     
-class SubCategoryListView(generics.ListAPIView):
+class SubCategoryListView(CachedResponseMixin, generics.ListAPIView):
+    cache_tags = ('category',)
     queryset = SubCategory.objects.all()
     serializer_class = SubCategorySerializer
     filter_backends = [DjangoFilterBackend] 
     filterset_fields = ['category']
 
-class BrandListView(generics.ListAPIView):
+class BrandListView(CachedResponseMixin, generics.ListAPIView):
+    cache_tags = ('brand',)
     queryset = Brand.objects.all()
     serializer_class = BrandSerializer
     pagination_class = None
 
 class ProductListView(generics.ListAPIView):
-    queryset = Product.objects.all()
+    queryset = ProductSerializer.setup_eager_loading(Product.objects.all())
     serializer_class = ProductSerializer
-    filter_backends = [DjangoFilterBackend, rest_filters.SearchFilter]
+    filter_backends = [ProductSearchFilter, DjangoFilterBackend]
     filterset_class = ProductFilter
-    search_fields = ['name', 'category__name', 'brand__name', 'description']
+    pagination_class = KeysetOrPageNumberPagination
 
 class Last10ProductsListView(generics.ListAPIView):
-    queryset = Product.objects.all()
+    queryset = ProductSerializer.setup_eager_loading(Product.objects.all())
     serializer_class = ProductSerializer
     filter_backends = [DjangoFilterBackend, rest_filters.SearchFilter]
     filterset_class = ProductFilter
 
-class ProductDetailView(generics.RetrieveAPIView):
-    queryset = Product.objects.all()
+class ProductDetailView(CachedResponseMixin, generics.RetrieveAPIView):
+    cache_tags = ('product',)
+    queryset = ProductSerializer.setup_eager_loading(Product.objects.all())
     serializer_class = ProductSerializer
     lookup_field = 'id'
 
-class ActiveSpecialProductsView(generics.ListAPIView):
+class ActiveSpecialProductsView(CachedResponseMixin, generics.ListAPIView):
+    cache_tags = ('special', 'product')
     serializer_class = SpecialProductSerializer
     permission_classes = [AllowAny]
 
     def get_queryset(self):
         return SpecialProduct.objects.filter(
             is_active=True
+        ).prefetch_related(
+            Prefetch('product', queryset=ProductSerializer.setup_eager_loading(Product.objects.all()))
         ).order_by('-order')[:10] 
 
 class PillCreateView(generics.CreateAPIView):
@@ -167,8 +185,13 @@ class PillAddressCreateUpdateView(generics.CreateAPIView, generics.UpdateAPIView
             serializer.save(pill=pill)
 
             # Update the Pill's status to 'w' (waiting)
-            pill.status = 'w'
-            pill.save()
+            if pill.status == 'i':
+                pill.status = 'w'
+                pill.save()
+            elif pill.status == 'w':
+                # Not paid yet, so the shipping follows the new address
+                pill.freeze_totals()
+                pill.save()
 
         except Pill.DoesNotExist:
             return Response({"error": "Pill does not exist."}, status=status.HTTP_404_NOT_FOUND)
@@ -181,8 +204,13 @@ class PillAddressCreateUpdateView(generics.CreateAPIView, generics.UpdateAPIView
             serializer.save(pill=pill)
 
             # Optionally, you can update the Pill's status to 'w' (waiting) if needed
-            pill.status = 'w'
-            pill.save()
+            if pill.status == 'i':
+                pill.status = 'w'
+                pill.save()
+            elif pill.status == 'w':
+                # Not paid yet, so the shipping follows the new address
+                pill.freeze_totals()
+                pill.save()
 
         except Pill.DoesNotExist:
             return Response({"error": "Pill does not exist."}, status=status.HTTP_404_NOT_FOUND)
@@ -207,22 +235,38 @@ class CustomerRatingDetailView(generics.RetrieveUpdateDestroyAPIView):
     permission_classes = [IsAuthenticated, IsOwner]
     
 class UserPillsView(generics.ListAPIView):
+    serializer_class = PillListSerializer
     permission_classes = [IsAuthenticated]
+    # Unpaginated unless `page` or `cursor` is passed
+    pagination_class = OptionalKeysetPagination
 
-    def get(self, request):
-        # Get the authenticated user
-        user = request.user
-        # Retrieve all pills for the user
-        pills = Pill.objects.filter(user=user)
-        # Serialize the data
-        serializer = PillDetailSerializer(pills, many=True)
-        return Response(serializer.data, status=status.HTTP_200_OK)
+    def get_queryset(self):
+        # Retrieve all pills for the authenticated user
+        return PillListSerializer.setup_eager_loading(
+            Pill.objects.filter(user=self.request.user).order_by('-date_added', '-id')
+        )
 
-class getColors(generics.ListAPIView):
+class getColors(CachedResponseMixin, generics.ListAPIView):
+    cache_tags = ('color',)
     queryset = Color.objects.all()
     serializer_class = ColorSerializer
 
 
+class ShippingRatesView(APIView):
+    """
+    Shipping price of every government, with a version tag. The tag is also
+    the ETag, so clients can cache the rates and revalidate with If-None-Match.
+    """
+    permission_classes = [AllowAny]
+
+    def get(self, request, *args, **kwargs):
+        version, rates = shipping_rates.snapshot()
+        etag = f'"{version}"'
+        if etag_matches(request.headers.get('If-None-Match', ''), etag):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+        return Response({'version': version, 'rates': rates}, headers={'ETag': etag})
+
+
 class PayRequestListCreateView(generics.ListCreateAPIView):
     queryset = PayRequest.objects.all()
     serializer_class = PayRequestSerializer
@@ -247,29 +291,15 @@ class PayRequestListCreateView(generics.ListCreateAPIView):
 
 class ProductsWithActiveDiscountAPIView(APIView):
     def get(self, request):
-        now = timezone.now()
-
-        # Get all product-level discounts that are currently active
-        product_discounts = Discount.objects.filter(
-            is_active=True,
-            discount_start__lte=now,
-            discount_end__gte=now,
-            product__isnull=False
-        ).values_list('product_id', flat=True)
-
-        # Get all category-level discounts that are currently active
-        category_discounts = Discount.objects.filter(
-            is_active=True,
-            discount_start__lte=now,
-            discount_end__gte=now,
-            category__isnull=False
-        ).values_list('category_id', flat=True)
+        # Products and categories with a currently active discount
+        product_discounts = discount_index.discounted_product_ids()
+        category_discounts = discount_index.discounted_category_ids()
 
         # Filter products that either have a direct discount or a discount via their category
-        products = Product.objects.filter(
+        products = ProductSerializer.setup_eager_loading(Product.objects.filter(
             Q(id__in=product_discounts) |
             Q(category_id__in=category_discounts)
-        ).distinct()
+        ))
 
         serializer = ProductSerializer(products, many=True, context={'request': request})
         return Response(serializer.data, status=status.HTTP_200_OK)
@@ -281,7 +311,9 @@ class LovedProductListCreateView(generics.ListCreateAPIView):
 
     def get_queryset(self):
         if self.request.user.is_authenticated:
-            return LovedProduct.objects.filter(user=self.request.user)
+            return LovedProduct.objects.filter(user=self.request.user).prefetch_related(
+                Prefetch('product', queryset=ProductSerializer.setup_eager_loading(Product.objects.all()))
+            )
         return LovedProduct.objects.none()
 
     def perform_create(self, serializer):
@@ -420,13 +452,14 @@ class MarkAlertAsNotifiedView(APIView):
         return Response({'status': 'success'})
 
 
-class NewArrivalsView(generics.ListAPIView):
+class NewArrivalsView(CachedResponseMixin, generics.ListAPIView):
+    cache_tags = ('product',)
     serializer_class = ProductSerializer
     filter_backends = [DjangoFilterBackend]
     filterset_fields = ['category', 'sub_category', 'brand']
 
     def get_queryset(self):
-        queryset = Product.objects.all().order_by('-date_added')
+        queryset = ProductSerializer.setup_eager_loading(Product.objects.all()).order_by('-date_added')
         days = self.request.query_params.get('days', None)
         if days:
             date_threshold = timezone.now() - timedelta(days=int(days))
@@ -439,22 +472,28 @@ class BestSellersView(generics.ListAPIView):
     filterset_fields = ['category', 'sub_category', 'brand']
 
     def get_queryset(self):
-        queryset = Product.objects.annotate(
-            total_sold=Sum('sales__quantity')
-        ).filter(
-            total_sold__gt=0
-        ).order_by('-total_sold')
-
         days = self.request.query_params.get('days', None)
-        if days:
-            date_threshold = timezone.now() - timedelta(days=int(days))
-            queryset = queryset.filter(
-                sales__date_sold__gte=date_threshold
-            ).annotate(
-                recent_sales=Sum('sales__quantity')
-            ).order_by('-recent_sold')
+        try:
+            window = int(days) if days else 0
+        except ValueError:
+            raise serializers.ValidationError({'days': 'A number of days is required.'})
+
+        # Precomputed rankings, see products.bestsellers, summed from the rollups until refreshed
+        if window in WINDOWS and ranking_is_fresh(window):
+            queryset = Product.objects.filter(best_seller_ranks__window=window)
+            if self.request.query_params.get('category'):
+                queryset = queryset.order_by('best_seller_ranks__category_rank')
+            elif self.request.query_params.get('brand'):
+                queryset = queryset.order_by('best_seller_ranks__brand_rank')
+            else:
+                queryset = queryset.order_by('best_seller_ranks__rank')
+        else:
+            totals = sales_over(window_start(window)).filter(product=OuterRef('pk')).values('total_quantity')
+            queryset = Product.objects.annotate(
+                recent_sold=Subquery(totals)
+            ).filter(recent_sold__gt=0).order_by('-recent_sold', 'id')
 
-        return queryset
+        return ProductSerializer.setup_eager_loading(queryset)
 
 
 class FrequentlyBoughtTogetherView(generics.ListAPIView):
@@ -465,14 +504,11 @@ class FrequentlyBoughtTogetherView(generics.ListAPIView):
         if not product_id:
             return Product.objects.none()
 
-        # Get products frequently bought with the specified product
+        # Read from the precomputed neighbours, see products.copurchase
         frequent_products = Product.objects.filter(
-            sales__pill__items__product_id=product_id
-        ).exclude(
-            id=product_id
-        ).annotate(
-            co_purchase_count=Count('id')
-        ).order_by('-co_purchase_count')[:5]
+            co_purchased_with__product_id=product_id
+        ).order_by('co_purchased_with__rank')
+        frequent_products = ProductSerializer.setup_eager_loading(frequent_products)[:5]
 
         return frequent_products
 
@@ -481,43 +517,15 @@ class ProductRecommendationsView(generics.ListAPIView):
     permission_classes = [IsAuthenticated]
 
     def get_queryset(self):
-        user = self.request.user
         current_product_id = self.request.query_params.get('product_id')
-        recommendations = []
-
-        # 1. Similar products (same category/subcategory/brand)
         if current_product_id:
-            current_product = get_object_or_404(Product, id=current_product_id)
-            similar_products = Product.objects.filter(
-                Q(category=current_product.category) |
-                Q(sub_category=current_product.sub_category) |
-                Q(brand=current_product.brand)
-            ).exclude(id=current_product_id).distinct()
-            recommendations.extend(list(similar_products))
-
-        # 2. Products from loved items (using correct related_name)
-        loved_products = Product.objects.filter(
-            lovedproduct__user=user
-        ).exclude(id__in=[p.id for p in recommendations]).distinct()
-        recommendations.extend(list(loved_products))
-
-        # 3. Previously purchased products
-        purchased_products = Product.objects.filter(
-            sales__pill__user=user
-        ).exclude(id__in=[p.id for p in recommendations]).distinct()
-        recommendations.extend(list(purchased_products))
-
-        # Remove duplicates and limit results
-        seen = set()
-        unique_recommendations = []
-        for product in recommendations:
-            if product.id not in seen:
-                seen.add(product.id)
-                unique_recommendations.append(product)
-            if len(unique_recommendations) >= 12:  # Limit to 12 products
-                break
-
-        return unique_recommendations
+            current_product_id = get_object_or_404(Product, id=current_product_id).id
+
+        # Scored over the whole catalog and cached per user, see products.recommendations
+        product_ids = recommend_products(self.request.user, current_product_id)
+        products = ProductSerializer.setup_eager_loading(Product.objects.filter(id__in=product_ids))
+        position = {product_id: index for index, product_id in enumerate(product_ids)}
+        return sorted(products, key=lambda product: position[product.id])
 
 
 class SpinWheelView(APIView):
@@ -599,6 +607,8 @@ class SpinWheelView(APIView):
 class SpinWheelHistoryView(generics.ListAPIView):
     serializer_class = SpinWheelResultSerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = KeysetOrPageNumberPagination
+    cursor_ordering = ('-spin_date', '-id')
 
     def get_queryset(self):
         return SpinWheelResult.objects.filter(
@@ -654,23 +664,21 @@ class ColorRetrieveUpdateDestroyView(generics.RetrieveUpdateDestroyAPIView):
     lookup_field = 'id'
 
 class ProductListCreateView(generics.ListCreateAPIView):
-    queryset = Product.objects.all()
+    queryset = ProductSerializer.setup_eager_loading(Product.objects.all())
     serializer_class = ProductSerializer
-    filter_backends = [DjangoFilterBackend, rest_filters.SearchFilter]
+    filter_backends = [ProductSearchFilter, DjangoFilterBackend]
     filterset_class = ProductFilter
-    search_fields = ['name', 'category__name', 'brand__name', 'description']
     permission_classes = [IsAdminUser] 
 
 class ProductListBreifedView(generics.ListCreateAPIView):
     queryset = Product.objects.all()
     serializer_class = ProductBreifedSerializer
-    filter_backends = [DjangoFilterBackend, rest_filters.SearchFilter]
+    filter_backends = [ProductSearchFilter, DjangoFilterBackend]
     filterset_class = ProductFilter
-    search_fields = ['name', 'category__name', 'brand__name', 'description']
     permission_classes = [IsAdminUser] 
 
 class ProductRetrieveUpdateDestroyView(generics.RetrieveUpdateDestroyAPIView):
-    queryset = Product.objects.all()
+    queryset = ProductSerializer.setup_eager_loading(Product.objects.all())
     serializer_class = ProductSerializer
     permission_classes = [IsAdminUser] 
 
@@ -680,6 +688,52 @@ class ProductImageListCreateView(generics.ListCreateAPIView):
     filterset_fields = ['product']
     permission_classes = [IsAdminUser] 
 
+class ProductImportView(APIView):
+    """
+    Load a CSV or JSONL file of products (`file`) with their availabilities,
+    descriptions and images, see products.imports. `dry_run=true` only
+    validates. Answers with the number of products created and updated and
+    the errors of the rows left out.
+    """
+    permission_classes = [IsAdminUser]
+    parser_classes = [MultiPartParser, FormParser]
+
+    def post(self, request, *args, **kwargs):
+        upload = request.FILES.get('file')
+        if upload is None:
+            return Response({"error": "A CSV or JSONL file is required"}, status=status.HTTP_400_BAD_REQUEST)
+        file_format = 'csv' if upload.name.lower().endswith('.csv') else 'jsonl'
+        dry_run = request.data.get('dry_run', '').lower() in ('1', 'true', 'yes')
+        try:
+            check_encoding(upload)
+        except UnicodeDecodeError:
+            return Response({"error": "The file must be UTF-8 text"}, status=status.HTTP_400_BAD_REQUEST)
+
+        report = import_catalog(read_rows(upload, file_format), dry_run=dry_run)
+        return Response(report, status=status.HTTP_200_OK if not report['failed'] else status.HTTP_207_MULTI_STATUS)
+
+class ProductBulkUpdateView(APIView):
+    """
+    Reprice products and set counted stock levels in one request:
+    `{"prices": [{"id", "price"}], "stock": [{"product", "size", "color", "quantity"}]}`,
+    see products.bulk. Answers with the outcome of every row.
+    """
+    permission_classes = [IsAdminUser]
+
+    def post(self, request, *args, **kwargs):
+        prices = request.data.get('prices') or []
+        stock = request.data.get('stock') or []
+        if not isinstance(prices, list) or not isinstance(stock, list):
+            return Response({"error": "prices and stock must be lists"}, status=status.HTTP_400_BAD_REQUEST)
+        if len(prices) + len(stock) > MAX_ROWS:
+            return Response({"error": f"At most {MAX_ROWS} rows per request"}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            report = bulk_update_catalog(prices, stock)
+        except DjangoValidationError as error:
+            return Response({"error": error.messages}, status=status.HTTP_409_CONFLICT)
+        return Response(report, status=status.HTTP_200_OK if not report['failed'] else status.HTTP_207_MULTI_STATUS)
+
 class ProductImageBulkCreateView(generics.CreateAPIView):
     permission_classes = [IsAdminUser]
 
@@ -765,25 +819,70 @@ class SpecialProductRetrieveUpdateDestroyView(generics.RetrieveUpdateDestroyAPIV
     permission_classes = [IsAdminUser]
 
 class PillListCreateView(generics.ListCreateAPIView):
-    queryset = Pill.objects.all()
+    queryset = PillListSerializer.setup_eager_loading(Pill.objects.order_by('-date_added', '-id'))
     serializer_class = PillCreateSerializer
     filter_backends = [DjangoFilterBackend, rest_filters.SearchFilter]
     filterset_class = PillFilter  
     search_fields = ['pilladdress__phone', 'pilladdress__government', 'pilladdress__name', 'user__name', 'user__username']
     permission_classes = [IsAdminUser]
+    pagination_class = KeysetOrPageNumberPagination
 
     def get_serializer_class(self):
         # Use PillCreateSerializer for POST (create) requests
         if self.request.method == 'POST':
             return PillCreateSerializer
-        # Use PillDetailSerializer for GET (list) requests
-        return PillDetailSerializer
+        # Use PillListSerializer for GET (list) requests
+        return PillListSerializer
+
+class PillExportView(ExportMixin, PillListCreateView):
+    """The filtered pills with their address and totals, as CSV or XLSX"""
+    export_filename = 'pills'
+    export_fields = (
+        ('ID', 'id'), ('Number', 'pill_number'), ('Date', 'date_added'), ('Status', 'status'), ('Paid', 'paid'),
+        ('Username', 'user__username'), ('Name', 'pilladdress__name'), ('Phone', 'pilladdress__phone'),
+        ('Email', 'pilladdress__email'), ('Government', 'pilladdress__government'), ('Address', 'pilladdress__address'),
+        ('Pay Method', 'pilladdress__pay_method'), ('Coupon', 'coupon__coupon'), ('Subtotal', 'export_subtotal'),
+        ('Coupon Discount', 'coupon_discount'), ('Shipping', 'export_shipping'), ('Total', 'export_total'),
+    )
+
+    def get_export_queryset(self):
+        # Frozen totals when there are some, computed in SQL like Pill.final_price otherwise
+        items_total = PillItem.objects.filter(pills=OuterRef('pk')).order_by().values('pills').annotate(
+            total=Sum(F('quantity') * Coalesce('unit_price', 'product__effective_price', 'product__price'))
+        ).values('total')
+        rate = Shipping.objects.filter(government=OuterRef('pilladdress__government')).values('shipping_price')[:1]
+        return super().get_export_queryset().annotate(
+            export_subtotal=Coalesce('subtotal', Subquery(items_total, output_field=FloatField()), 0.0),
+            export_shipping=Coalesce('shipping', Subquery(rate, output_field=FloatField()), 0.0),
+        ).annotate(
+            export_total=Coalesce('total', F('export_subtotal') - Coalesce('coupon_discount', 0.0) + F('export_shipping')),
+        )
 
 class PillRetrieveUpdateDestroyView(generics.RetrieveUpdateDestroyAPIView):
     queryset = Pill.objects.all()
     serializer_class = PillDetailSerializer
     permission_classes = [IsAdminUser] 
 
+    def perform_update(self, serializer):
+        try:
+            serializer.save()
+        except DjangoValidationError as error:
+            raise serializers.ValidationError({'status': error.messages})
+
+class PillBulkStatusView(APIView):
+    permission_classes = [IsAdminUser]
+
+    def post(self, request, *args, **kwargs):
+        serializer = PillBulkStatusSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        try:
+            moved = Pill.transition_many(serializer.validated_data['pills'], serializer.validated_data['status'])
+        except DjangoValidationError as error:
+            return Response({"error": error.messages}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response({"updated": [pill.id for pill in moved]}, status=status.HTTP_200_OK)
+
 class DiscountListCreateView(generics.ListCreateAPIView):
     queryset = Discount.objects.all()
     serializer_class = DiscountSerializer
@@ -837,6 +936,28 @@ class ProductAvailabilityListCreateView(generics.ListCreateAPIView):
     filter_backends = [DjangoFilterBackend]
     filterset_fields = ['product', 'color', 'size']
 
+class ProductAvailabilityExportView(ExportMixin, ProductAvailabilityListCreateView):
+    """The filtered availability batches (the inventory), as CSV or XLSX"""
+    queryset = ProductAvailability.objects.order_by('product_id', 'date_added', 'id')
+    export_filename = 'inventory'
+    export_fields = (
+        ('ID', 'id'), ('Product ID', 'product_id'), ('Product', 'product__name'), ('Size', 'size'),
+        ('Color', 'color__name'), ('Quantity', 'quantity'), ('Native Price', 'native_price'), ('Date Added', 'date_added'),
+    )
+
+class ProductSalesExportView(ExportMixin, generics.ListAPIView):
+    """The filtered product sales with their cost of goods, as CSV or XLSX"""
+    queryset = ProductSales.objects.order_by('-date_sold', '-id')
+    permission_classes = [IsAdminUser]
+    filter_backends = [DjangoFilterBackend]
+    filterset_class = ProductSalesFilter
+    export_filename = 'sales'
+    export_fields = (
+        ('ID', 'id'), ('Date', 'date_sold'), ('Pill', 'pill__pill_number'), ('Product ID', 'product_id'),
+        ('Product', 'product__name'), ('Size', 'size'), ('Color', 'color__name'), ('Quantity', 'quantity'),
+        ('Unit Price', 'price_at_sale'), ('Unit Cost', 'unit_cost'),
+    )
+
 class ProductAvailabilityDetailView(generics.RetrieveUpdateDestroyAPIView):
     queryset = ProductAvailability.objects.all()
     serializer_class = ProductAvailabilitySerializer
@@ -912,23 +1033,28 @@ class ApplyPayRequestView(generics.UpdateAPIView):
         if pill.paid:
             return Response({"error": "This pill is already paid."}, status=status.HTTP_400_BAD_REQUEST)
 
-        # Update the PayRequest to mark it as applied
-        pay_request.is_applied = True
-        pay_request.save()
-
-        # Update the associated Pill to mark it as paid
-        pill.paid = True
-        pill.status = 'p'
-        pill.save()
-        if pill.pilladdress:
-            prepare_whatsapp_message(pill.pilladdress.phone, pill)
+        try:
+            with transaction.atomic():
+                # Update the PayRequest to mark it as applied
+                pay_request.is_applied = True
+                pay_request.save()
+
+                # Mark the associated Pill as paid, which moves an initiated or waiting pill
+                # to paid and queues the WhatsApp confirmation; later statuses are kept
+                pill.paid = True
+                pill.save()
+        except DjangoValidationError as error:
+            # Nothing was applied
+            return Response({"error": error.messages}, status=status.HTTP_400_BAD_REQUEST)
 
         # Return the updated PayRequest
         serializer = self.get_serializer(pay_request)
         return Response(serializer.data, status=status.HTTP_200_OK)
 
 class DashboardLovedProductListView(generics.ListAPIView):
-    queryset = LovedProduct.objects.all()
+    queryset = LovedProduct.objects.prefetch_related(
+        Prefetch('product', queryset=ProductSerializer.setup_eager_loading(Product.objects.all()))
+    )
     serializer_class = LovedProductSerializer
     permission_classes = [IsAdminUser]
     filter_backends = [DjangoFilterBackend]
@@ -945,11 +1071,11 @@ class LowThresholdProductsView(generics.ListAPIView):
     permission_classes = [IsAdminUser]
     
     def get_queryset(self):
-        return Product.objects.annotate(
+        return ProductSerializer.setup_eager_loading(Product.objects.annotate(
             available_quantity=Sum('availabilities__quantity')
         ).filter(
             available_quantity__lte=F('threshold')
-        ).distinct()
+        ).distinct())
 
 
 
@@ -0,0 +1,89 @@
+import threading
+import requests
+from django.conf import settings
+from django.utils.module_loading import import_string
+from requests.adapters import HTTPAdapter
+
+# HTTP statuses worth retrying later, anything else in 4xx is a permanent failure
+RETRYABLE_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+
+
+class GatewayError(Exception):
+    def __init__(self, message, retryable=True):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+class WhatsAppGateway:
+    """
+    Client of the WhatsApp API, sharing one pooled HTTP session per process
+    and bounding every call with a connect/read timeout.
+    """
+    url = "https://whats.easytech-sotfware.com/api/v1/send-text"
+
+    _session = None
+    _session_lock = threading.Lock()
+
+    @classmethod
+    def session(cls):
+        if cls._session is None:
+            with cls._session_lock:
+                if cls._session is None:
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings.WHATSAPP_POOL_SIZE)
+                    session.mount('https://', adapter)
+                    session.mount('http://', adapter)
+                    cls._session = session
+        return cls._session
+
+    def send(self, phone_number, message, idempotency_key=None):
+        params = {
+            "token": settings.WHATSAPP_TOKEN,
+            "instance_id": settings.WHATSAPP_ID,
+            "msg": message,
+            "jid": f"2{phone_number}@s.whatsapp.net"
+        }
+        headers = {'Idempotency-Key': idempotency_key} if idempotency_key else {}
+        try:
+            response = self.session().get(
+                settings.WHATSAPP_API_URL or self.url, params=params, headers=headers,
+                timeout=settings.WHATSAPP_TIMEOUT
+            )
+        except requests.RequestException as error:
+            raise GatewayError(f"{type(error).__name__}: {error}")
+
+        if response.status_code >= 400:
+            raise GatewayError(
+                f"HTTP {response.status_code}: {response.text[:200]}",
+                retryable=response.status_code in RETRYABLE_STATUSES
+            )
+        try:
+            return response.json()
+        except ValueError:
+            return {}
+
+
+class FakeWhatsAppGateway:
+    """
+    Local gateway for tests and development: records the messages instead of
+    sending them, and fails the first `failures` calls when asked to.
+    """
+
+    def __init__(self, failures=0, retryable=True):
+        self.failures = failures
+        self.retryable = retryable
+        self.sent = []
+        self.calls = 0
+
+    def send(self, phone_number, message, idempotency_key=None):
+        self.calls += 1
+        if self.failures:
+            self.failures -= 1
+            raise GatewayError("Fake gateway failure", retryable=self.retryable)
+        self.sent.append({'phone_number': phone_number, 'message': message, 'idempotency_key': idempotency_key})
+        return {'status': 'sent'}
+
+
+def get_gateway():
+    """The gateway configured by WHATSAPP_GATEWAY"""
+    return import_string(settings.WHATSAPP_GATEWAY)()